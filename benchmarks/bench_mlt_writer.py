@@ -0,0 +1,120 @@
+"""
+Benchmark of the int64 .mlt writer against file_processing + DataFrame.to_csv
+
+Both writers get the same parsed file, each measurement runs in a fresh interpreter so
+peak RSS is not polluted by the other writer, and the outputs are checked to be byte
+identical. Run from the project root:
+
+    python -m benchmarks.bench_mlt_writer --scans 3000 --mz 500
+"""
+import argparse
+import filecmp
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_pipeline import _peak_rss_mb
+from benchmarks.synthetic_msv import DEFAULT_NEGATIVE_FRACTION, write_synthetic_msv
+
+
+def pandas_write(msv_data, output_file):
+    from processing.DataWrangler_MS_data_conversion_v1 import write_mlt_pandas
+    return write_mlt_pandas(msv_data, output_file)
+
+
+def int64_write(msv_data, output_file):
+    from processing.mlt_writer import write_mlt_tsv
+    return write_mlt_tsv(msv_data, output_file)
+
+
+WRITERS = {
+    "pandas": pandas_write,
+    "int64": int64_write,
+}
+
+
+def _child(writer, msv_path, output_file):
+    import pandas  # noqa: F401
+    import processing.DataWrangler_MS_data_conversion_v1  # noqa: F401
+    from processing.msv_reader import read_msv
+
+    msv_data = read_msv(msv_path)
+    base_rss, _ = _peak_rss_mb()
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            WRITERS[writer](msv_data, output_file)
+        finally:
+            sys.stdout = stdout
+    elapsed = time.perf_counter() - start
+
+    peak_rss, _ = _peak_rss_mb()
+    print(json.dumps({
+        "writer": writer,
+        "seconds": elapsed,
+        "peak_rss_mb": peak_rss,
+        "rss_growth_mb": None if peak_rss is None else peak_rss - base_rss,
+    }))
+
+
+def run(msv_path, out_dir, writers=tuple(WRITERS), repeat=3):
+    results = []
+    for writer in writers:
+        output_file = os.path.join(out_dir, f"{writer}.mlt")
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-m", "benchmarks.bench_mlt_writer", "--child", writer, msv_path, output_file],
+                                 check=True, capture_output=True, text=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r["seconds"])
+        size_mb = os.path.getsize(output_file) / 1e6
+        best["output_mb"] = size_mb
+        best["mb_per_s"] = size_mb / best["seconds"]
+        best["output_file"] = output_file
+        results.append(best)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scans", type=int, default=2000)
+    parser.add_argument("--mz", type=int, default=500)
+    parser.add_argument("--negative-fraction", type=float, default=DEFAULT_NEGATIVE_FRACTION)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--file", help="benchmark an existing .msv instead of a synthetic one")
+    parser.add_argument("--child", nargs=3, metavar=("WRITER", "MSV", "OUTPUT"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _child(*args.child)
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        msv_path = args.file
+        if msv_path is None:
+            msv_path = os.path.join(tmp, "synthetic.msv")
+            write_synthetic_msv(msv_path, args.scans, args.mz, args.negative_fraction)
+
+        results = run(msv_path, tmp, repeat=args.repeat)
+        print(f"{'writer':<8} {'seconds':>8} {'MB/s':>8} {'peak RSS MB':>12} {'RSS growth MB':>14}")
+        for r in results:
+            rss = "n/a" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}"
+            growth = "n/a" if r["rss_growth_mb"] is None else f"{r['rss_growth_mb']:.1f}"
+            print(f"{r['writer']:<8} {r['seconds']:>8.3f} {r['mb_per_s']:>8.1f} {rss:>12} {growth:>14}")
+
+        reference, fast = results[0], results[1]
+        print(f"Speedup: {reference['seconds'] / fast['seconds']:.1f}x")
+        if not filecmp.cmp(reference["output_file"], fast["output_file"], shallow=False):
+            print("FAIL: the int64 writer's output differs from the pandas writer's")
+            return 1
+        print("Outputs are byte identical")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
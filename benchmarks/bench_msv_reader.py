@@ -0,0 +1,129 @@
+"""
+Benchmark of the streaming MSV reader against the ElementTree + StringIO + read_csv path
+
+Every measurement runs in a fresh interpreter so peak RSS is not polluted by the
+other reader. Run from the project root:
+
+    python -m benchmarks.bench_msv_reader --scans 3000 --mz 500
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.synthetic_msv import write_synthetic_msv
+
+
+def legacy_read(file_path):
+    """The parse done by file_processing before the streaming reader"""
+    import xml.etree.ElementTree as ET
+    import pandas as pd
+
+    tree = ET.parse(file_path)
+    root = tree.getroot()
+    for MSDATA in root.iter('DATA'):
+        raw_data = MSDATA.text
+    df_raw = pd.read_csv(io.StringIO(raw_data), sep=';')
+    return df_raw.drop(['RT(minutes) - NOT USED BY IMPORT', 'RI'], axis=1)
+
+
+def streaming_read(file_path):
+    from processing.msv_reader import read_msv
+    return read_msv(file_path)
+
+
+def chunked_read(file_path, chunk_rows=256):
+    from processing.msv_reader import iter_msv_chunks
+    n = 0
+    for chunk in iter_msv_chunks(file_path, chunk_rows):
+        n += chunk.n_scans
+    return n
+
+
+READERS = {
+    "legacy": legacy_read,
+    "streaming": streaming_read,
+    "chunked": chunked_read,
+}
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _child(reader, file_path):
+    # Import the heavy modules first so the baseline RSS covers them for both readers
+    import pandas  # noqa: F401
+    import processing.msv_reader  # noqa: F401
+    base_rss = _max_rss_mb()
+
+    start = time.perf_counter()
+    READERS[reader](file_path)
+    elapsed = time.perf_counter() - start
+
+    peak_rss = _max_rss_mb()
+    print(json.dumps({
+        "reader": reader,
+        "seconds": elapsed,
+        "peak_rss_mb": peak_rss,
+        "rss_growth_mb": None if peak_rss is None else peak_rss - base_rss,
+    }))
+
+
+def run(file_path, readers=tuple(READERS), repeat=3):
+    size_mb = os.path.getsize(file_path) / 1e6
+    results = []
+    for reader in readers:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-m", "benchmarks.bench_msv_reader", "--child", reader, file_path],
+                                 check=True, capture_output=True, text=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r["seconds"])
+        best["mb_per_s"] = size_mb / best["seconds"]
+        best["file_mb"] = size_mb
+        results.append(best)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scans", type=int, default=2000)
+    parser.add_argument("--mz", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--file", help="benchmark an existing .msv instead of a synthetic one")
+    parser.add_argument("--child", nargs=2, metavar=("READER", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = args.file
+        if file_path is None:
+            file_path = os.path.join(tmp, "synthetic.msv")
+            write_synthetic_msv(file_path, args.scans, args.mz)
+
+        print(f"{'reader':<10} {'seconds':>8} {'MB/s':>8} {'peak RSS MB':>12} {'RSS growth MB':>14}")
+        for r in run(file_path, repeat=args.repeat):
+            rss = "n/a" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}"
+            growth = "n/a" if r["rss_growth_mb"] is None else f"{r['rss_growth_mb']:.1f}"
+            print(f"{r['reader']:<10} {r['seconds']:>8.3f} {r['mb_per_s']:>8.1f} {rss:>12} {growth:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+mzML write time of the psims and template backends, and a check that they agree
+
+Writes the same parsed .msv with both backends for several encodings, dense and with
+--sparse, and compares the files byte for byte. The template backend is only worth using
+while they are identical, so the exit status is 1 when any pair differs. Runs with many
+short scans are where the per-spectrum overhead of psims shows. The numpress encodings
+need pynumpress and are skipped without it. Run from the project root:
+
+    python -m benchmarks.bench_mzml_backends --scans 5000 --mz 100
+    python -m benchmarks.bench_mzml_backends --sparse 5000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+from benchmarks.synthetic_msv import DEFAULT_NEGATIVE_FRACTION, write_synthetic_msv
+from processing.mzml_encoding import DEFAULT_ENCODING, MzMLEncoding
+
+ENCODINGS = (
+    DEFAULT_ENCODING,
+    MzMLEncoding("none", 64, "none", 32),
+    MzMLEncoding("zlib", 32, "zlib", 64),
+    MzMLEncoding("numpress-linear", 64, "numpress-slof", 64),
+)
+
+
+def run(msv_path, out_dir, include_numpress, repeat=3, peak_thresholds=(None,)):
+    from processing.AMDIS_batch_data_formatterv1 import write_mzml
+    from processing.msv_reader import read_msv
+
+    msv_data = read_msv(msv_path)
+    paths = {backend: os.path.join(out_dir, f"{backend}.mzML") for backend in ("psims", "template")}
+    results = []
+    for encoding in ENCODINGS:
+        if encoding.uses_numpress and not include_numpress:
+            continue
+        for peak_threshold in peak_thresholds:
+            times = {}
+            for backend, path in paths.items():
+                write_times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    write_mzml(msv_data, path, 1e16, 3, encoding, peak_threshold, backend=backend)
+                    write_times.append(time.perf_counter() - start)
+                times[backend] = min(write_times)
+            with open(paths["psims"], "rb") as f:
+                reference = f.read()
+            with open(paths["template"], "rb") as f:
+                identical = f.read() == reference
+            results.append({
+                **encoding.as_dict(),
+                "peak_threshold": peak_threshold,
+                "size_mb": len(reference) / 1e6,
+                "psims_seconds": times["psims"],
+                "template_seconds": times["template"],
+                "identical": identical,
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scans", type=int, default=5000)
+    parser.add_argument("--mz", type=int, default=100)
+    parser.add_argument("--negative-fraction", type=float, default=DEFAULT_NEGATIVE_FRACTION)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--file", help="benchmark an existing .msv instead of a synthetic one")
+    parser.add_argument("--sparse", dest="peak_threshold", type=float, nargs="?", const=0.0, default=None, metavar="THRESHOLD",
+                        help="also write only the peaks above THRESHOLD (default 0)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        import pynumpress  # noqa: F401
+        include_numpress = True
+    except ImportError:
+        print("pynumpress is not installed, skipping the MS-Numpress encodings")
+        include_numpress = False
+
+    peak_thresholds = (None,) if args.peak_threshold is None else (None, args.peak_threshold)
+    # psims warns about the chromatogram array units on every file
+    warnings.simplefilter("ignore")
+    with tempfile.TemporaryDirectory() as tmp:
+        msv_path = args.file
+        if msv_path is None:
+            msv_path = os.path.join(tmp, "synthetic.msv")
+            write_synthetic_msv(msv_path, args.scans, args.mz, args.negative_fraction)
+        msv_mb = os.path.getsize(msv_path) / 1e6
+        results = run(msv_path, tmp, include_numpress, args.repeat, peak_thresholds)
+
+    print(f"Source .msv: {msv_mb:.1f} MB")
+    print(f"{'m/z':<20} {'intensity':<20} {'sparse':>8} {'MB':>7} {'psims s':>8} {'template s':>10} {'speedup':>8} {'same':>5}")
+    for r in results:
+        mz = f"{r['mz_compression']} {r['mz_precision']}" if not r["mz_compression"].startswith("numpress") else r["mz_compression"]
+        intensity = (f"{r['intensity_compression']} {r['intensity_precision']}"
+                     if not r["intensity_compression"].startswith("numpress") else r["intensity_compression"])
+        sparse = "-" if r["peak_threshold"] is None else f"{r['peak_threshold']:g}"
+        speedup = r["psims_seconds"] / r["template_seconds"] if r["template_seconds"] > 0 else float("inf")
+        print(f"{mz:<20} {intensity:<20} {sparse:>8} {r['size_mb']:>7.2f} {r['psims_seconds']:>8.3f} "
+              f"{r['template_seconds']:>10.3f} {speedup:>7.1f}x {'yes' if r['identical'] else 'NO':>5}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"source_mb": msv_mb, "results": results}, f, indent=2)
+        print(f"Saved results to {args.output}")
+    if not all(r["identical"] for r in results):
+        print("The template backend wrote different files than psims", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+mzML file size, write time and read time for each binary array encoding
+
+Writes the same parsed .msv with every combination of m/z and intensity compression and
+precision, then reads every spectrum back and reports the largest intensity error against
+the exact values. Reading needs pyteomics, the numpress combinations need pynumpress and
+are skipped without it. --sparse writes only the peaks above the threshold, raise
+--negative-fraction to see what that saves on mostly empty scans. Run from the project root:
+
+    python -m benchmarks.bench_mzml_encoding --scans 2000 --mz 500
+    python -m benchmarks.bench_mzml_encoding --negative-fraction 0.9 --sparse
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from benchmarks.synthetic_msv import DEFAULT_NEGATIVE_FRACTION, write_synthetic_msv
+from processing.mzml_encoding import INTENSITY_COMPRESSIONS, MZ_COMPRESSIONS, PRECISIONS, MzMLEncoding
+
+
+def encodings(include_numpress):
+    for mz_c, int_c, mz_p, int_p in itertools.product(MZ_COMPRESSIONS, INTENSITY_COMPRESSIONS, PRECISIONS, PRECISIONS):
+        # numpress ignores the precision, list it once
+        if (mz_c.startswith("numpress") and mz_p != 64) or (int_c.startswith("numpress") and int_p != 64):
+            continue
+        encoding = MzMLEncoding(mz_c, mz_p, int_c, int_p)
+        if encoding.uses_numpress and not include_numpress:
+            continue
+        yield encoding
+
+
+def read_back(path):
+    """Every spectrum's intensity array, or None without pyteomics"""
+    try:
+        from pyteomics import mzml
+    except ImportError:
+        return None
+    with mzml.read(path) as reader:
+        return np.concatenate([spectrum["intensity array"] for spectrum in reader])
+
+
+def run(msv_path, out_dir, include_numpress, repeat=3, peak_threshold=None):
+    from processing.AMDIS_batch_data_formatterv1 import write_mzml
+    from processing.intensity_processing import process_intensities
+    from processing.msv_reader import read_msv
+
+    msv_data = read_msv(msv_path)
+    expected = process_intensities(msv_data.intensities, 1e16, 3)
+    if peak_threshold is not None:
+        expected = expected[expected > peak_threshold]
+    expected = expected.ravel()
+    results = []
+    for encoding in encodings(include_numpress):
+        path = os.path.join(out_dir, "out.mzML")
+        write_times, read_times = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            write_mzml(msv_data, path, 1e16, 3, encoding, peak_threshold)
+            write_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            intensities = read_back(path)
+            read_times.append(time.perf_counter() - start)
+
+        result = {
+            **encoding.as_dict(),
+            "size_mb": os.path.getsize(path) / 1e6,
+            "write_seconds": min(write_times),
+            "read_seconds": None,
+            "max_relative_error": None,
+            "peak_threshold": peak_threshold,
+        }
+        if intensities is not None:
+            result["read_seconds"] = min(read_times)
+            scale = np.maximum(np.abs(expected), 1.0)
+            result["max_relative_error"] = float(np.max(np.abs(intensities - expected) / scale, initial=0.0))
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scans", type=int, default=2000)
+    parser.add_argument("--mz", type=int, default=500)
+    parser.add_argument("--negative-fraction", type=float, default=DEFAULT_NEGATIVE_FRACTION)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--file", help="benchmark an existing .msv instead of a synthetic one")
+    parser.add_argument("--sparse", dest="peak_threshold", type=float, nargs="?", const=0.0, default=None, metavar="THRESHOLD",
+                        help="only write the peaks above THRESHOLD (default 0)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        import pynumpress  # noqa: F401
+        include_numpress = True
+    except ImportError:
+        print("pynumpress is not installed, skipping the MS-Numpress encodings")
+        include_numpress = False
+
+    # psims warns about the chromatogram array units on every file
+    warnings.simplefilter("ignore")
+    with tempfile.TemporaryDirectory() as tmp:
+        msv_path = args.file
+        if msv_path is None:
+            msv_path = os.path.join(tmp, "synthetic.msv")
+            write_synthetic_msv(msv_path, args.scans, args.mz, args.negative_fraction)
+        msv_mb = os.path.getsize(msv_path) / 1e6
+        results = run(msv_path, tmp, include_numpress, args.repeat, args.peak_threshold)
+
+    print(f"Source .msv: {msv_mb:.1f} MB")
+    print(f"{'m/z':<20} {'intensity':<20} {'MB':>7} {'write s':>8} {'read s':>8} {'max rel err':>12}")
+    for r in results:
+        read = "n/a" if r["read_seconds"] is None else f"{r['read_seconds']:.3f}"
+        error = "n/a" if r["max_relative_error"] is None else f"{r['max_relative_error']:.1e}"
+        mz = f"{r['mz_compression']} {r['mz_precision']}" if not r["mz_compression"].startswith("numpress") else r["mz_compression"]
+        intensity = (f"{r['intensity_compression']} {r['intensity_precision']}"
+                     if not r["intensity_compression"].startswith("numpress") else r["intensity_compression"])
+        print(f"{mz:<20} {intensity:<20} {r['size_mb']:>7.2f} {r['write_seconds']:>8.3f} {read:>8} {error:>12}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"source_mb": msv_mb, "results": results}, f, indent=2)
+        print(f"Saved results to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""
+Benchmark of the conversion stages, one by one and as the full pipeline
+
+Generates a synthetic data set, then times each stage in a fresh interpreter on a fresh
+copy of the inputs and reports files/s, input MB/s and peak RSS. Results can be saved as
+JSON and compared against an earlier run. Run from the project root:
+
+    python -m benchmarks.bench_pipeline --files 20 --scans 2000 --mz 500 --output bench.json
+    python -m benchmarks.bench_pipeline --baseline bench.json --tolerance 0.2
+
+Stages:
+    rename        reanme_msv.rename_msv_files
+    mlt           DataWrangler_MS_data_conversion_v1.batch_processing_MS
+    mzml          AMDIS_batch_data_formatterv1.batch_process_mzml
+    mzml_single   AMDIS_batch_data_formatterv1.process_single_file per file, the successor of process_mzml_file
+    pipeline      runner.run_pipeline, what the GUI Worker runs, with the native mzXML writer
+                  unless --msconvert is given
+    pipeline_cached
+                  the same rerun with another intensity multiplier, after an untimed run has
+                  filled the parse cache
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.synthetic_msv import (DEFAULT_MZ, DEFAULT_NEGATIVE_FRACTION, DEFAULT_SCANS,
+                                      make_msv_folder, make_msv_zip)
+
+
+class NullSignal:
+    def emit(self, value):
+        pass
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process and of its largest child process, e.g. a pool worker"""
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def _msv_files(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".msv"))
+
+
+def stage_rename(work, n_files, options):
+    from processing.reanme_msv import rename_msv_files
+    return lambda: rename_msv_files(work, 1, NullSignal(), NullSignal(), 0, n_files)
+
+
+def stage_mlt(work, n_files, options):
+    from processing.DataWrangler_MS_data_conversion_v1 import batch_processing_MS
+    out = os.path.join(work, "out")
+    os.makedirs(out)
+    return lambda: batch_processing_MS(work, out, NullSignal(), NullSignal(), 0, n_files)
+
+
+def stage_mzml(work, n_files, options):
+    from processing.AMDIS_batch_data_formatterv1 import batch_process_mzml
+    out = os.path.join(work, "out")
+    return lambda: batch_process_mzml(work, out, progress_signal=NullSignal(), message_signal=NullSignal(), total_files=n_files)
+
+
+def stage_mzml_single(work, n_files, options):
+    from processing.AMDIS_batch_data_formatterv1 import process_single_file
+    files = _msv_files(work)
+    out = os.path.join(work, "out")
+    os.makedirs(out)
+
+    def run():
+        for path in files:
+            process_single_file(path, os.path.join(out, os.path.basename(path)[:-4] + ".mzML"), 1e16, 3)
+    return run
+
+
+def stage_pipeline(work, n_files, options):
+    from processing import runner
+    zip_path = make_msv_zip(os.path.join(work, "input.zip"), _msv_files(work))
+    out = os.path.join(work, "out")
+    runner.make_output_dirs(out)
+    backend = "msconvert" if options["msconvert"] else "native"
+    return lambda: runner.run_pipeline(zip_path, out, 1, options["msconvert"], NullSignal(), NullSignal(),
+                                       workers=options["workers"], mzxml_backend=backend, stream_zip=options["stream_zip"],
+                                       memory_budget_mb=options.get("memory_budget_mb"))
+
+
+def stage_pipeline_cached(work, n_files, options):
+    from processing import runner
+    zip_path = make_msv_zip(os.path.join(work, "input.zip"), _msv_files(work))
+    cache_dir = os.path.join(work, "parse_cache")
+    backend = "msconvert" if options["msconvert"] else "native"
+
+    def convert(out, intensity_multiplier):
+        runner.make_output_dirs(out)
+        runner.run_pipeline(zip_path, out, 1, options["msconvert"], NullSignal(), NullSignal(),
+                            workers=options["workers"], mzxml_backend=backend, stream_zip=options["stream_zip"],
+                            intensity_multiplier=intensity_multiplier, parse_cache_dir=cache_dir)
+
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            convert(os.path.join(work, "warm"), 1e16)
+        finally:
+            sys.stdout = stdout
+    return lambda: convert(os.path.join(work, "out"), 1e12)
+
+
+STAGES = {
+    "rename": stage_rename,
+    "mlt": stage_mlt,
+    "mzml": stage_mzml,
+    "mzml_single": stage_mzml_single,
+    "pipeline": stage_pipeline,
+    "pipeline_cached": stage_pipeline_cached,
+}
+
+
+def _child(stage, data_dir, options):
+    # Import the heavy modules before the baseline so peak RSS growth is the stage's own
+    import numpy  # noqa: F401
+    import pandas  # noqa: F401
+    import psims.mzml.writer  # noqa: F401
+    import processing.msv_reader  # noqa: F401
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The stages rename and write next to their inputs, so each run gets its own copy
+        work = os.path.join(tmp, "work")
+        shutil.copytree(data_dir, work)
+        n_files = len(_msv_files(work))
+        run = STAGES[stage](work, n_files, options)
+        base_rss, _ = _peak_rss_mb()
+
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                run()
+            finally:
+                sys.stdout = stdout
+        elapsed = time.perf_counter() - start
+
+    peak_rss, peak_child_rss = _peak_rss_mb()
+    print(json.dumps({
+        "stage": stage,
+        "seconds": elapsed,
+        "peak_rss_mb": peak_rss,
+        "rss_growth_mb": None if peak_rss is None else peak_rss - base_rss,
+        "peak_child_rss_mb": peak_child_rss or None,
+    }))
+
+
+def run(data_dir, stages=tuple(STAGES), repeat=3, options=None):
+    """Best of repeat runs of each stage on the .msv files in data_dir"""
+    options = options or {"workers": 1, "msconvert": "", "stream_zip": False, "memory_budget_mb": None}
+    files = _msv_files(data_dir)
+    size_mb = sum(os.path.getsize(f) for f in files) / 1e6
+    results = []
+    for stage in stages:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-m", "benchmarks.bench_pipeline", "--child", stage, data_dir, json.dumps(options)],
+                                 check=True, capture_output=True, text=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r["seconds"])
+        best["files"] = len(files)
+        best["input_mb"] = size_mb
+        best["files_per_s"] = len(files) / best["seconds"]
+        best["mb_per_s"] = size_mb / best["seconds"]
+        results.append(best)
+    return results
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Stages whose files/s dropped more than tolerance (a fraction) below the baseline"""
+    before = {r["stage"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = before.get(r["stage"])
+        if old is None:
+            continue
+        change = r["files_per_s"] / old["files_per_s"] - 1
+        print(f"{r['stage']:<15} {old['files_per_s']:>9.2f} -> {r['files_per_s']:>9.2f} files/s ({change:+.0%})")
+        if change < -tolerance:
+            regressions.append(r["stage"])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--scans", type=int, default=DEFAULT_SCANS)
+    parser.add_argument("--mz", type=int, default=DEFAULT_MZ)
+    parser.add_argument("--negative-fraction", type=float, default=DEFAULT_NEGATIVE_FRACTION)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the pipeline stage")
+    parser.add_argument("--stream-zip", action="store_true", help="pipeline stage reads the .msv files straight from the ZIP")
+    parser.add_argument("--memory-budget-mb", type=float, help="pipeline stage converts in chunks within this budget")
+    parser.add_argument("--msconvert", default="", help="run the pipeline stage with this msconvert instead of the native mzXML writer")
+    parser.add_argument("--data", help="benchmark the .msv files in this folder instead of synthetic ones")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON from an earlier run to compare against, with the same settings")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="with --baseline, exit with an error if files/s drops by more than this fraction")
+    parser.add_argument("--child", nargs=3, metavar=("STAGE", "DATA", "OPTIONS"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        stage, data_dir, options = args.child
+        _child(stage, data_dir, json.loads(options))
+        return 0
+
+    options = {"workers": args.workers, "msconvert": args.msconvert, "stream_zip": args.stream_zip,
+               "memory_budget_mb": args.memory_budget_mb}
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data
+        if data_dir is None:
+            data_dir = os.path.join(tmp, "data")
+            make_msv_folder(data_dir, args.files, args.scans, args.mz, args.negative_fraction)
+        results = run(data_dir, args.stages, args.repeat, options)
+
+    print(f"{'stage':<15} {'files':>6} {'seconds':>8} {'files/s':>9} {'MB/s':>8} {'peak RSS MB':>12} {'RSS growth MB':>14} {'worker RSS MB':>14}")
+    for r in results:
+        rss = "n/a" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}"
+        growth = "n/a" if r["rss_growth_mb"] is None else f"{r['rss_growth_mb']:.1f}"
+        child = "-" if r["peak_child_rss_mb"] is None else f"{r['peak_child_rss_mb']:.1f}"
+        print(f"{r['stage']:<15} {r['files']:>6} {r['seconds']:>8.3f} {r['files_per_s']:>9.2f} {r['mb_per_s']:>8.1f} {rss:>12} {growth:>14} {child:>14}")
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"files": args.files, "scans": args.scans, "mz": args.mz, "negative_fraction": args.negative_fraction,
+                     "data": args.data, "repeat": args.repeat, **options},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != report["settings"]:
+            print(f"Warning: {args.baseline} was run with other settings, files/s is not directly comparable")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"FAIL: {', '.join(regressions)} slower than the baseline by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
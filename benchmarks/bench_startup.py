@@ -0,0 +1,72 @@
+"""
+Startup time of the headless command line against the GUI's eager imports
+
+Also fails if the CLI imports Qt, pandas, psims or NumPy before any stage runs,
+tests/test_cli_startup.py checks the same for every subcommand.
+Run from the project root:
+
+    python -m benchmarks.bench_startup
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from processing.__main__ import HEAVY_MODULES
+
+CASES = {
+    "cli --help": [sys.executable, "-m", "processing", "--help"],
+    "gui imports": [sys.executable, "-c", "import PySide6.QtWidgets, pandas, numpy, psims.mzml.writer"],
+}
+
+CHECK_LAZY = (
+    "import sys, contextlib, io\n"
+    "from processing.__main__ import main\n"
+    "with contextlib.redirect_stdout(io.StringIO()):\n"
+    "    try:\n"
+    "        main(['--help'])\n"
+    "    except SystemExit:\n"
+    "        pass\n"
+    f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+)
+
+
+def time_command(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def heavy_imports_at_startup():
+    out = subprocess.run([sys.executable, "-c", CHECK_LAZY], check=True, capture_output=True, text=True)
+    return [m for m in out.stdout.strip().split(",") if m]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="exit with an error if the CLI takes longer than this to start")
+    args = parser.parse_args(argv)
+
+    results = {name: time_command(cmd, args.repeat) for name, cmd in CASES.items()}
+    for name, seconds in results.items():
+        print(f"{name:<12} {seconds * 1000:8.1f} ms (median of {args.repeat})")
+
+    failed = False
+    loaded = heavy_imports_at_startup()
+    if loaded:
+        print(f"FAIL: CLI imported {', '.join(loaded)} before running a stage")
+        failed = True
+    if args.max_seconds is not None and results["cli --help"] > args.max_seconds:
+        print(f"FAIL: CLI startup above {args.max_seconds} s")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
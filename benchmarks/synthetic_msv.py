@@ -0,0 +1,81 @@
+"""
+Synthetic .msv generator for the benchmarks
+
+Writes .msv files with a valid <DATA> block: RT(milliseconds), RT(minutes) - NOT USED BY IMPORT,
+RI and one column per m/z, with random intensities of which a given fraction is negative.
+File names follow the instrument's raw naming so rename_msv_files and the ZIP planner accept
+them. Run from the project root to generate a data set by hand:
+
+    python -m benchmarks.synthetic_msv out_folder --files 20 --scans 2000 --mz 500 --zip
+"""
+import argparse
+import os
+import zipfile
+
+import numpy as np
+
+DEFAULT_SCANS = 2000
+DEFAULT_MZ = 500
+DEFAULT_NEGATIVE_FRACTION = 0.3
+
+
+def synthetic_name(i):
+    """Raw instrument style name of the i-th synthetic file"""
+    day = 1 + i % 28
+    return f"2024-03-{day:02d}_10-{i // 28 % 60:02d}-00_SAMPLE_synthetic_A{i % 100:02d}_B{i // 100 % 100:02d}.msv"
+
+
+def write_synthetic_msv(path, n_scans=DEFAULT_SCANS, n_mz=DEFAULT_MZ, negative_fraction=DEFAULT_NEGATIVE_FRACTION, seed=0):
+    """One .msv with n_scans scans over n_mz unit m/z columns starting at 50"""
+    rng = np.random.default_rng(seed)
+    header = ["RT(milliseconds)", "RT(minutes) - NOT USED BY IMPORT", "RI"] + [str(m) for m in range(50, 50 + n_mz)]
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<MSV>\n<DATA>')
+        f.write(";".join(header) + "\n")
+        for i in range(n_scans):
+            rt = 1000 + i * 250
+            row = rng.random(n_mz) * 1e-12
+            row[rng.random(n_mz) < negative_fraction] *= -1
+            f.write(f"{rt};{rt / 60000:.4f};0;" + ";".join(map(repr, row.tolist())) + "\n")
+        f.write("</DATA>\n</MSV>\n")
+
+
+def make_msv_folder(folder, n_files, n_scans=DEFAULT_SCANS, n_mz=DEFAULT_MZ, negative_fraction=DEFAULT_NEGATIVE_FRACTION):
+    """Writes n_files synthetic .msv files to folder and returns their paths"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(n_files):
+        path = os.path.join(folder, synthetic_name(i))
+        write_synthetic_msv(path, n_scans, n_mz, negative_fraction, seed=i)
+        paths.append(path)
+    return paths
+
+
+def make_msv_zip(zip_path, file_paths):
+    """Packs the files into the base folder of a deflated ZIP, like the instrument exports"""
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for path in file_paths:
+            zip_ref.write(path, os.path.basename(path))
+    return zip_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("folder")
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--scans", type=int, default=DEFAULT_SCANS)
+    parser.add_argument("--mz", type=int, default=DEFAULT_MZ)
+    parser.add_argument("--negative-fraction", type=float, default=DEFAULT_NEGATIVE_FRACTION)
+    parser.add_argument("--zip", action="store_true", help="also pack the files into folder.zip")
+    args = parser.parse_args(argv)
+
+    paths = make_msv_folder(args.folder, args.files, args.scans, args.mz, args.negative_fraction)
+    size_mb = sum(os.path.getsize(p) for p in paths) / 1e6
+    print(f"Wrote {len(paths)} files, {size_mb:.1f} MB, to {args.folder}")
+    if args.zip:
+        zip_path = make_msv_zip(args.folder.rstrip("/\\") + ".zip", paths)
+        print(f"Wrote {zip_path}")
+
+
+if __name__ == "__main__":
+    main()
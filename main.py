@@ -1,85 +1,126 @@
 import sys
 import os
-import zipfile
-from PySide6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QWidget,
+import threading
+import time
+from PySide6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget,
                                QPushButton, QLabel, QFileDialog, QMessageBox,
-                               QProgressBar, QSpinBox, QLineEdit)
-from PySide6.QtCore import QDir, QThread, Signal, QObject, QSettings
-from processing import reanme_msv, DataWrangler_MS_data_conversion_v1,AMDIS_batch_data_formatterv1, msconvert_python
+                               QProgressBar, QSpinBox, QLineEdit, QComboBox, QCheckBox,
+                               QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView)
+from PySide6.QtCore import QThread, Signal, QObject, QSettings
+from processing import runner
+from processing.instrumentation import RunReport
 
 
-class Worker(QObject):
-    progress = Signal(int)
-    message = Signal(str)
-    finished = Signal()
+class ConversionJob:
+    """One archive in the queue, with the settings it was added with"""
 
-    def __init__(self, zip_path, extract_dir, start_idx, ms_convert_path):
-        super().__init__()
+    def __init__(self, zip_path, extract_dir, start_idx, resume=False, options=None):
         self.zip_path = zip_path
         self.extract_dir = extract_dir
         self.start_idx = start_idx
-        self.ms_convert_path = ms_convert_path
-
-        # Check if the EXACT path exists (including msconvert.exe)
-        print(f"Checking for executable at: {ms_convert_path}")
-
-        if not os.path.isfile(ms_convert_path):
-            QMessageBox.critical(None, "Error",f"Executable not found at: {ms_convert_path}")
-            raise FileNotFoundError(f"Executable not found at {ms_convert_path}")
-
-        # Make directories
-        try:
-            os.makedirs(extract_dir + "/1-msv", exist_ok=False)
-            os.makedirs(extract_dir + "/3-mlt", exist_ok=False)
-            os.makedirs(extract_dir + "/5-mzmlv2", exist_ok=False)
-            os.makedirs(extract_dir + "/6-mzxml", exist_ok=False)
-        except OSError:
-            QMessageBox.critical(None, "Error", "Directory already exists. Make a new folder.")
-            raise
+        # Reuse an existing output folder, only converting what its manifest says is missing
+        self.resume = resume
+        # Keyword arguments of run_pipeline: mzXML backend, streaming, sparse peaks, parse cache, memory budget
+        self.options = dict(options or {})
+        self.status = "Queued"
+        self.cancel = threading.Event()
 
-    def run(self):
-        try:
-            # Extract with progress
-            with zipfile.ZipFile(self.zip_path, 'r') as zip_ref:
-                # Get only files in the base folder
-                base_files = [f for f in zip_ref.namelist() if not f.endswith('/') and '/' not in f]
 
-                if not base_files:
-                    self.message.emit("No files to extract in the base folder")
-                    return
+class JobSignal:
+    """Passes the value run_pipeline emits on to a Worker signal, together with the job's row"""
 
-                total_files = len(base_files)
-                processed_files = 0
+    def __init__(self, signal, row):
+        self.signal = signal
+        self.row = row
 
-                for file in base_files:
-                    zip_ref.extract(file, self.extract_dir + "/1-msv")
-                    processed_files += 1
-                    progress = int((processed_files / total_files) * 100)
-                    self.progress.emit(progress)
-                    self.message.emit(f"Extracting: {file}")
+    def emit(self, value):
+        self.signal.emit(self.row, value)
 
-            # Process files in msv
-            files = QDir(self.extract_dir + "/1-msv").entryList(QDir.Files)
-            total_files = len(files) * 4
 
-            pf_count = reanme_msv.rename_msv_files(self.extract_dir + "/1-msv", self.start_idx, self.progress, self.message, 0, total_files)
-            pf_count = DataWrangler_MS_data_conversion_v1.batch_processing_MS(self.extract_dir + "/1-msv", self.extract_dir + "/3-mlt", self.progress, self.message, pf_count, total_files)
-            pf_count = AMDIS_batch_data_formatterv1.batch_process_mzml(input_root = self.extract_dir + "/1-msv", output_root = self.extract_dir + "/5-mzmlv2", progress_signal = self.progress, message_signal = self.message, pstart = pf_count, total_files = total_files)
-            msconvert_python.convert_mzml_to_mzxml(self.extract_dir + "/5-mzmlv2", self.extract_dir + "/6-mzxml", self.ms_convert_path, self.progress, self.message, pf_count, total_files)
+class Worker(QObject):
+    progress = Signal(int, int)
+    message = Signal(int, str)
+    job_started = Signal(int)
+    job_finished = Signal(int, str, str)
+    totals = Signal(str)
+    finished = Signal()
 
+    MZXML_BACKENDS = runner.MZXML_BACKENDS
+    MZML_BACKENDS = runner.MZML_BACKENDS
 
+    def __init__(self, jobs, lock, ms_convert_path, workers=1, msconvert_batch_size=1):
+        super().__init__()
+        # Shared with the window, which adds and cancels jobs while the queue runs. lock guards their status
+        self.jobs = jobs
+        self.lock = lock
+        self.ms_convert_path = ms_convert_path
+        # Number of processes used for the per-file MSV -> MLT/mzML conversion, kept up for the whole queue
+        self.workers = workers
+        # Number of mzML files handed to each msconvert process
+        self.msconvert_batch_size = msconvert_batch_size
+
+    def next_job(self):
+        """Row and job of the first queued job, marked as running. (None, None) when the queue is empty"""
+        with self.lock:
+            for row, job in enumerate(self.jobs):
+                if job.status == "Queued":
+                    job.status = "Running"
+                    return row, job
+        return None, None
 
+    def run(self):
+        started = time.perf_counter()
+        done = files = bytes_written = 0
+        try:
+            # The worker processes start once and stay warm from one archive to the next
+            with runner.WorkerPools(self.workers) as pools:
+                pools.warm_up()
+                row, job = self.next_job()
+                while job is not None:
+                    report = RunReport()
+                    self.job_started.emit(row)
+                    status = self.run_job(row, job, pools, report)
+                    with self.lock:
+                        job.status = status
+                    self.job_finished.emit(row, status, report.summary())
+
+                    done += 1
+                    files += sum(1 for m in report.files if m.stage in ("parse", "cache"))
+                    bytes_written += sum(m.bytes_written for m in report.files)
+                    seconds = time.perf_counter() - started
+                    self.totals.emit(f"{done} archives, {files} files, {bytes_written / 1e6:.0f} MB written in {seconds:.0f} s "
+                                     f"({files / seconds:.1f} files/s, {bytes_written / 1e6 / seconds:.1f} MB/s)")
+                    row, job = self.next_job()
+        finally:
             self.finished.emit()
+
+    def run_job(self, row, job, pools, report):
+        """Converts one archive on the shared pools. Returns its final status"""
+        try:
+            runner.make_output_dirs(job.extract_dir, job.resume, job.options.get("archives"))
+        except OSError:
+            self.message.emit(row, "Directory already exists. Make a new folder or resume into it.")
+            return "Failed"
+        try:
+            runner.run_pipeline(job.zip_path, job.extract_dir, job.start_idx, self.ms_convert_path,
+                                JobSignal(self.progress, row), JobSignal(self.message, row),
+                                msconvert_batch_size=self.msconvert_batch_size, run_report=report, pools=pools,
+                                cancel=job.cancel, **job.options)
         except Exception as e:
-            self.message.emit(f"Error: {str(e)}")
-            self.finished.emit()
+            self.message.emit(row, f"Error: {str(e)}")
+            return "Failed"
+        return "Cancelled" if job.cancel.is_set() else "Done"
 
 class ZipExtractorApp(QMainWindow):
     SETTINGS_KEY = "msconvert_path"
+    JOB_COLUMNS = ("ZIP", "Output folder", "Start index", "Status", "Progress")
+    # Output layouts: a file per sample in each stage folder, or one archive per stage
+    OUTPUT_LAYOUTS = {"Separate files": None, "One ZIP per output": "zip", "One uncompressed ZIP per output": "zip-stored",
+                      "One tar per output": "tar"}
     def __init__(self):
         super().__init__()
         self.setWindowTitle("UNM data conversion")
-        self.setGeometry(100, 100, 400, 300)
+        self.setGeometry(100, 100, 700, 600)
 
         #init settings
         self.settings = QSettings("UNM", "city data converter")
@@ -101,20 +142,30 @@ class ZipExtractorApp(QMainWindow):
 
 
         # Widgets
-        self.zip_label = QLabel("No ZIP file selected")
-        self.select_button = QPushButton("Select ZIP File")
+        self.add_button = QPushButton("Add ZIP Files")
+        self.jobs_table = QTableWidget(0, len(self.JOB_COLUMNS))
+        self.jobs_table.setHorizontalHeaderLabels(self.JOB_COLUMNS)
+        self.jobs_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.jobs_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.jobs_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.extract_process_button = QPushButton("Extract and Process")
         self.extract_process_button.setEnabled(False)
+        self.cancel_button = QPushButton("Cancel Selected")
         self.progress_bar = QProgressBar()
         self.status_label = QLabel("Ready")
+        self.totals_label = QLabel("")
         self.layout.addWidget(self.path_edit)
 
         # Add widgets to layout
-        self.layout.addWidget(self.zip_label)
-        self.layout.addWidget(self.select_button)
-        self.layout.addWidget(self.extract_process_button)
+        self.layout.addWidget(self.add_button)
+        self.layout.addWidget(self.jobs_table)
+        queue_buttons = QHBoxLayout()
+        queue_buttons.addWidget(self.extract_process_button)
+        queue_buttons.addWidget(self.cancel_button)
+        self.layout.addLayout(queue_buttons)
         self.layout.addWidget(self.progress_bar)
         self.layout.addWidget(self.status_label)
+        self.layout.addWidget(self.totals_label)
 
         # start index spinbox
         self.label = QLabel("Enter an integer value for start index:")
@@ -125,74 +176,226 @@ class ZipExtractorApp(QMainWindow):
         self.idxspinbox.setValue(1)
         self.layout.addWidget(self.idxspinbox)
 
+        # worker process count spinbox
+        self.workers_label = QLabel("Worker processes:")
+        self.layout.addWidget(self.workers_label)
+        self.workers_spinbox = QSpinBox()
+        self.workers_spinbox.setMinimum(1)
+        self.workers_spinbox.setMaximum(os.cpu_count() or 1)
+        self.workers_spinbox.setValue(os.cpu_count() or 1)
+        self.layout.addWidget(self.workers_spinbox)
+
+        # mzML files handed to each msconvert process, through a filelist when above 1
+        self.msconvert_batch_label = QLabel("mzML files per msconvert run:")
+        self.layout.addWidget(self.msconvert_batch_label)
+        self.msconvert_batch_spinbox = QSpinBox()
+        self.msconvert_batch_spinbox.setMinimum(1)
+        self.msconvert_batch_spinbox.setMaximum(1000)
+        self.msconvert_batch_spinbox.setValue(1)
+        self.layout.addWidget(self.msconvert_batch_spinbox)
+
+        # mzXML backend selection
+        self.backend_label = QLabel("mzXML writer:")
+        self.layout.addWidget(self.backend_label)
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItems(Worker.MZXML_BACKENDS)
+        self.layout.addWidget(self.backend_combo)
+        self.mzml_backend_label = QLabel("mzML writer:")
+        self.layout.addWidget(self.mzml_backend_label)
+        self.mzml_backend_combo = QComboBox()
+        self.mzml_backend_combo.addItems(Worker.MZML_BACKENDS)
+        self.layout.addWidget(self.mzml_backend_combo)
+
+        # ZIP streaming options
+        self.stream_checkbox = QCheckBox("Read .msv files straight from the ZIP")
+        self.layout.addWidget(self.stream_checkbox)
+        self.keep_msv_checkbox = QCheckBox("Keep renamed .msv copies in 1-msv")
+        self.keep_msv_checkbox.setChecked(True)
+        self.keep_msv_checkbox.setEnabled(False)
+        self.stream_checkbox.toggled.connect(self.keep_msv_checkbox.setEnabled)
+        self.layout.addWidget(self.keep_msv_checkbox)
+
+        # Archive-packed outputs for network shares
+        self.layout_label = QLabel("Output files:")
+        self.layout.addWidget(self.layout_label)
+        self.layout_combo = QComboBox()
+        self.layout_combo.addItems(self.OUTPUT_LAYOUTS)
+        self.layout.addWidget(self.layout_combo)
+
+        # Incremental reruns into an existing output folder
+        self.resume_checkbox = QCheckBox("Resume into existing output folder")
+        self.layout.addWidget(self.resume_checkbox)
+
+        # Sparse spectra, only the nonzero peaks
+        self.sparse_checkbox = QCheckBox("Write only nonzero peaks to mzML/mzXML")
+        self.layout.addWidget(self.sparse_checkbox)
+
+        # Parsed .msv cache for reruns with other settings
+        self.cache_checkbox = QCheckBox("Cache parsed .msv files for faster reruns")
+        self.layout.addWidget(self.cache_checkbox)
+        self.clear_cache_button = QPushButton("Clear parse cache")
+        self.clear_cache_button.clicked.connect(self.clear_parse_cache)
+        self.layout.addWidget(self.clear_cache_button)
+
+        # Chunked conversion for runs too large to load whole
+        self.budget_label = QLabel("Memory budget per worker in MB (0 loads whole files):")
+        self.layout.addWidget(self.budget_label)
+        self.budget_spinbox = QSpinBox()
+        self.budget_spinbox.setMinimum(0)
+        self.budget_spinbox.setMaximum(1024 * 1024)
+        self.budget_spinbox.setSingleStep(256)
+        self.budget_spinbox.setValue(0)
+        self.layout.addWidget(self.budget_spinbox)
+
 
         # Connect signals
-        self.select_button.clicked.connect(self.select_zip_file)
+        self.add_button.clicked.connect(self.select_zip_files)
         self.extract_process_button.clicked.connect(self.start_extraction)
+        self.cancel_button.clicked.connect(self.cancel_selected)
 
         # Instance variables
-        self.zip_file_path = ""
-        self.extract_dir = ""
+        self.jobs = []
+        self.jobs_lock = threading.Lock()
+        self.job_summaries = {}
         self.worker = None
         self.thread = None
 
-    def select_zip_file(self):
-        """Open file dialog to select ZIP file"""
-        file_dialog = QFileDialog()
-        file_dialog.setFileMode(QFileDialog.ExistingFile)
-        file_dialog.setNameFilter("ZIP files (*.zip)")
+    def select_zip_files(self):
+        """Queue ZIP files with the current settings, each converted into its own output folder"""
+        zip_paths, _ = QFileDialog.getOpenFileNames(self, "Select ZIP Files", "", "ZIP files (*.zip)")
+        if not zip_paths:
+            return
+        output_dir = QFileDialog.getExistingDirectory(self, "Output folder")
+        if not output_dir:
+            return
 
-        if file_dialog.exec():
-            self.zip_file_path = file_dialog.selectedFiles()[0]
-            self.zip_label.setText(f"Selected: {os.path.basename(self.zip_file_path)}")
-            self.extract_process_button.setEnabled(True)
+        for zip_path in zip_paths:
+            # Several archives get a subfolder each, named after the archive
+            extract_dir = output_dir if len(zip_paths) == 1 else os.path.join(output_dir, os.path.splitext(os.path.basename(zip_path))[0])
+            job = ConversionJob(zip_path, extract_dir, self.idxspinbox.value(), resume=self.resume_checkbox.isChecked(),
+                                options=self.job_options())
+            with self.jobs_lock:
+                self.jobs.append(job)
+            self.add_job_row(job)
+        self.extract_process_button.setEnabled(self.thread is None)
+
+    def job_options(self):
+        """run_pipeline settings of the widgets, for jobs added now"""
+        return dict(mzxml_backend=self.backend_combo.currentText(), mzml_backend=self.mzml_backend_combo.currentText(),
+                    stream_zip=self.stream_checkbox.isChecked(), keep_msv=self.keep_msv_checkbox.isChecked(),
+                    peak_threshold=0.0 if self.sparse_checkbox.isChecked() else None,
+                    parse_cache_dir=self.get_parse_cache_dir() if self.cache_checkbox.isChecked() else None,
+                    memory_budget_mb=self.budget_spinbox.value() or None, archives=self.archive_options())
+
+    def archive_options(self):
+        """Every output stage mapped to the chosen archive format, None for separate files"""
+        archive_format = self.OUTPUT_LAYOUTS[self.layout_combo.currentText()]
+        return None if archive_format is None else dict.fromkeys(runner.STAGE_DIRS, archive_format)
+
+    def add_job_row(self, job):
+        row = self.jobs_table.rowCount()
+        self.jobs_table.insertRow(row)
+        for column, text in enumerate((os.path.basename(job.zip_path), job.extract_dir, str(job.start_idx), job.status)):
+            self.jobs_table.setItem(row, column, QTableWidgetItem(text))
+        self.jobs_table.setCellWidget(row, 4, QProgressBar())
+
+    def set_job_status(self, row, status):
+        self.jobs_table.item(row, 3).setText(status)
 
     def start_extraction(self):
-        """Start the extraction and processing in a separate thread"""
-        if not self.zip_file_path:
-            QMessageBox.warning(self, "Error", "No ZIP file selected!")
+        """Start working through the queued jobs in a separate thread"""
+        with self.jobs_lock:
+            queued = [job for job in self.jobs if job.status == "Queued"]
+        if not queued:
+            QMessageBox.warning(self, "Error", "No ZIP files queued!")
             return
 
-        # Ask for extraction directory
-        dir_dialog = QFileDialog()
-        dir_dialog.setFileMode(QFileDialog.Directory)
-        dir_dialog.setOption(QFileDialog.ShowDirsOnly, True)
-
-        if dir_dialog.exec():
-            self.extract_dir = dir_dialog.selectedFiles()[0]
-            self.progress_bar.setValue(0)
-            self.status_label.setText("Preparing...")
+        # msconvert is not needed by the native mzXML writer
+        if any(job.options["mzxml_backend"] == "msconvert" for job in queued):
+            try:
+                runner.check_msconvert(self.get_msconvert_path())
+            except FileNotFoundError:
+                QMessageBox.critical(self, "Error", f"Executable not found at: {self.get_msconvert_path()}")
+                return
 
-            # Create and start worker thread
-            self.thread = QThread()
-            self.worker = Worker(self.zip_file_path, self.extract_dir, self.idxspinbox.value(), self.get_msconvert_path())
-            self.worker.moveToThread(self.thread)
+        self.progress_bar.setValue(0)
+        self.status_label.setText("Preparing...")
+        self.job_summaries = {}
 
-            # Connect signals
-            self.worker.progress.connect(self.update_progress)
-            self.worker.message.connect(self.update_status)
-            self.worker.finished.connect(self.thread.quit)
-            self.worker.finished.connect(self.worker.deleteLater)
-            self.worker.finished.connect(self.thread.deleteLater)
-            self.worker.finished.connect(self.on_finished)
+        # Create and start worker thread
+        self.thread = QThread()
+        self.worker = Worker(self.jobs, self.jobs_lock, self.get_msconvert_path(), self.workers_spinbox.value(),
+                             self.msconvert_batch_spinbox.value())
+        self.worker.moveToThread(self.thread)
 
-            self.thread.started.connect(self.worker.run)
-            self.thread.start()
+        # Connect signals
+        self.worker.progress.connect(self.update_progress)
+        self.worker.message.connect(self.update_status)
+        self.worker.job_started.connect(lambda row: self.set_job_status(row, "Running"))
+        self.worker.job_finished.connect(self.on_job_finished)
+        self.worker.totals.connect(self.totals_label.setText)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(self.worker.deleteLater)
+        self.worker.finished.connect(self.thread.deleteLater)
+        self.worker.finished.connect(self.on_finished)
+
+        self.thread.started.connect(self.worker.run)
+        self.thread.start()
 
-            self.extract_process_button.setEnabled(False)
+        self.extract_process_button.setEnabled(False)
 
-    def update_progress(self, value):
-        """Update progress bar"""
+    def cancel_selected(self):
+        """Cancel the selected jobs. A running job stops after its current files and removes its partial outputs"""
+        rows = sorted({index.row() for index in self.jobs_table.selectedIndexes()})
+        for row in rows:
+            with self.jobs_lock:
+                job = self.jobs[row]
+                if job.status == "Queued":
+                    job.status = "Cancelled"
+                    self.set_job_status(row, "Cancelled")
+                elif job.status == "Running":
+                    job.cancel.set()
+                    self.set_job_status(row, "Cancelling...")
+
+    def update_progress(self, row, value):
+        """Update the job's and the main progress bar"""
+        self.jobs_table.cellWidget(row, 4).setValue(value)
         self.progress_bar.setValue(value)
 
-    def update_status(self, message):
+    def update_status(self, row, message):
         """Update status label"""
-        self.status_label.setText(message)
+        self.status_label.setText(f"{os.path.basename(self.jobs[row].zip_path)}: {message}")
+
+    def on_job_finished(self, row, status, summary):
+        """Keep the per-stage summary of the job for the completion message"""
+        self.set_job_status(row, status)
+        if summary:
+            self.job_summaries[row] = summary
 
     def on_finished(self):
-        """Called when processing is complete"""
-        self.extract_process_button.setEnabled(True)
-        QMessageBox.information(self, "Complete", "Extraction and processing finished!")
+        """Called when the queue is empty"""
+        self.thread = None
+        self.worker = None
+        with self.jobs_lock:
+            self.extract_process_button.setEnabled(any(job.status == "Queued" for job in self.jobs))
+        box = QMessageBox(QMessageBox.Information, "Complete", "Extraction and processing finished!", parent=self)
+        if self.totals_label.text():
+            box.setText(f"Extraction and processing finished!\n{self.totals_label.text()}")
+        if self.job_summaries:
+            box.setInformativeText("Timings per stage are in run_report.json and run_report.csv in each output folder.")
+            box.setDetailedText("\n\n".join(f"{os.path.basename(self.jobs[row].zip_path)} ({self.jobs[row].status})\n{summary}"
+                                              for row, summary in sorted(self.job_summaries.items())))
+        box.exec()
+
+    def get_parse_cache_dir(self):
+        from processing.parse_cache import default_cache_dir
+        return default_cache_dir()
+
+    def clear_parse_cache(self):
+        """Delete everything in the parse cache"""
+        from processing.parse_cache import ParseCache
+        removed, freed = ParseCache(self.get_parse_cache_dir()).clear()
+        QMessageBox.information(self, "Parse cache", f"Removed {removed} files ({freed / 1e6:.0f} MB)")
 
     def save_settings(self):
         """Save the current path to settings file"""
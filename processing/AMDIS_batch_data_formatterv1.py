@@ -1,14 +1,17 @@
 import os
-import pandas as pd
-import xml.etree.ElementTree as ET
-import io
 import numpy as np
+from contextlib import ExitStack
 from pathlib import Path
 from psims.mzml.writer import MzMLWriter
 from psims.mzml.components import InstrumentConfiguration, ComponentList, Source, Analyzer, Detector
+from processing.msv_reader import MSVData, read_msv
+from processing.intensity_processing import ProcessedScans, ScanStats, process_scans
+from processing.mzml_encoding import COMPRESSIONS, DEFAULT_ENCODING, MzMLEncoding
 
 
-def batch_process_mzml(input_root: str, output_root: str, intensity_multiplier: float = 1e16, decimal_places: int = 3, progress_signal = None, message_signal = None, pstart = 0, total_files = 0):
+def batch_process_mzml(input_root: str, output_root: str, intensity_multiplier: float = 1e16, decimal_places: int = 3, progress_signal = None, message_signal = None, pstart = 0, total_files = 0,
+                       encoding: MzMLEncoding = DEFAULT_ENCODING, peak_threshold: float = None, parse_cache=None,
+                       backend: str = "psims"):
     """
     Recursively processes all .tst files in directory tree
 
@@ -17,6 +20,10 @@ def batch_process_mzml(input_root: str, output_root: str, intensity_multiplier:
         output_root (str): Output directory for mzML files
         intensity_multiplier (float): Scaling factor for intensity values
         decimal_places (int): Decimal places for rounding
+        encoding (MzMLEncoding): Compression and precision of the binary arrays
+        peak_threshold (float): Only write peaks above this processed intensity, None writes the full m/z axis
+        parse_cache (ParseCache): Read the parsed files through this cache
+        backend (str): "psims", or "template" for the faster templated writer with the same output, see mzml_template
     """
     processed_files = pstart
     errors = []
@@ -41,7 +48,11 @@ def batch_process_mzml(input_root: str, output_root: str, intensity_multiplier:
                         input_path=input_path,
                         output_path=output_path,
                         intensity_multiplier=intensity_multiplier,
-                        decimal_places=decimal_places
+                        decimal_places=decimal_places,
+                        encoding=encoding,
+                        peak_threshold=peak_threshold,
+                        parse_cache=parse_cache,
+                        backend=backend
                     )
                     processed_files += 1
                     progress = int((processed_files / total_files) * 100)
@@ -64,49 +75,118 @@ def batch_process_mzml(input_root: str, output_root: str, intensity_multiplier:
 def process_single_file(input_path: str,
                         output_path: str,
                         intensity_multiplier: float,
-                        decimal_places: int):
-    """Process individual TST file to mzML format"""
-    # XML data extraction
-    tree = ET.parse(input_path)
-    root = tree.getroot()
-
-    # Data processing
-    for MSDATA in root.iter('DATA'):
-        raw_data = MSDATA.text
+                        decimal_places: int,
+                        encoding: MzMLEncoding = DEFAULT_ENCODING,
+                        peak_threshold: float = None,
+                        parse_cache=None,
+                        backend: str = "psims"):
+    """Process individual MSV file to mzML format"""
+    msv_data = parse_cache.read(input_path)[0] if parse_cache is not None else read_msv(input_path)
+    write_mzml(msv_data, output_path, intensity_multiplier, decimal_places, encoding, peak_threshold, backend=backend)
+
+
+def write_mzml(msv_data: MSVData,
+               output_path: str,
+               intensity_multiplier: float,
+               decimal_places: int,
+               encoding: MzMLEncoding = DEFAULT_ENCODING,
+               peak_threshold: float = None,
+               scans: ProcessedScans = None,
+               backend: str = "psims"):
+    """
+    Write already parsed MSV data to mzML format
 
-    df_raw = pd.read_csv(io.StringIO(raw_data), sep=';')
-    df_processed = process_dataframe(df_raw, intensity_multiplier, decimal_places)
-    df_long = pd.melt(df_processed, id_vars="Retention Time",
-                      var_name="m/z", value_name="intensity")
+    With peak_threshold only the peaks above it are written for each spectrum, 0 drops the
+    zero intensities. The TIC, the base peaks and the chromatograms are still computed from
+    every value. scans can give the file already processed with the same settings, see
+    process_scans, so the mzXML writer can share it. backend "template" writes the same
+    file with mzml_template instead of psims.
+    """
+    if backend == "template":
+        from processing.mzml_template import write_mzml_template
+        return write_mzml_template(msv_data, output_path, intensity_multiplier, decimal_places, encoding, peak_threshold, scans)
+    if backend != "psims":
+        raise ValueError(f"Unknown mzML backend: {backend}")
+    if scans is None:
+        scans = process_scans(msv_data, intensity_multiplier, decimal_places, peak_threshold)
 
     # mzML writing
     with open(output_path, 'wb') as outfile, MzMLWriter(outfile) as writer:
-        write_mzml_metadata(writer)
+        write_mzml_metadata(writer, encoding, peak_threshold)
         with writer.run(id="run1", instrument_configuration="instrument1"):
-            write_spectra(writer, df_long.groupby('Retention Time'))
-            write_chromatogram(writer, df_processed)
-
-    # Process the written file to move scan time
-    process_mzml_file(output_path, os.path.dirname(output_path))
+            write_spectra(writer, msv_data.mz, scans, encoding)
+            write_chromatograms(writer, scans.rt_seconds, scans.stats, encoding)
 
 
-def process_dataframe(df: pd.DataFrame,
-                      multiplier: float,
-                      decimals: int) -> pd.DataFrame:
-    """Process and clean raw dataframe"""
-    df = df.drop(['RT(minutes) - NOT USED BY IMPORT', 'RI'], axis=1)
-    df = df.rename(columns={'RT(milliseconds)': 'Retention Time'})
-
-    # Process numerical data
-    subset = df.iloc[:, 1:].mask(df.iloc[:, 1:] < 0, 0.000)
-    df.iloc[:, 1:] = subset.mul(multiplier).round(decimals)
-    #Time is converted to seconds
-    df['Retention Time'] = df['Retention Time'].astype(float) / 1000
-
-    return df
+class MzMLChunkWriter:
+    """
+    Writes an mzML a chunk of scans at a time, for files too large to convert in one piece
 
+    The spectrum list is opened with the scan count given up front, see msv_reader.survey_msv,
+    and every chunk's spectra are written as soon as it is parsed. The retention times and
+    scan stats, a few values per scan, are collected on the way and written as the
+    chromatograms by close(), which also checks that n_scans spectra were written. The
+    output is the same as write_mzml's for the whole file.
+    """
 
-def write_mzml_metadata(writer: MzMLWriter):
+    def __init__(self, output_path, mz, n_scans, intensity_multiplier: float, decimal_places: int,
+                 encoding: MzMLEncoding = DEFAULT_ENCODING, peak_threshold: float = None):
+        self.output_path = output_path
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.n_scans = n_scans
+        self.intensity_multiplier = intensity_multiplier
+        self.decimal_places = decimal_places
+        self.encoding = encoding
+        self.peak_threshold = peak_threshold
+        self.rt_seconds = []
+        self.stats = []
+        self.written = 0
+
+        # The run outlives the spectrum list, the chromatogram list goes between them
+        self._run = ExitStack()
+        self._spectra = ExitStack()
+        try:
+            outfile = self._run.enter_context(open(output_path, 'wb'))
+            self.writer = self._run.enter_context(MzMLWriter(outfile))
+            write_mzml_metadata(self.writer, encoding, peak_threshold)
+            self._run.enter_context(self.writer.run(id="run1", instrument_configuration="instrument1"))
+            self._spectra.enter_context(self.writer.spectrum_list(count=n_scans))
+        except BaseException:
+            self.abort()
+            raise
+
+    def write(self, chunk: MSVData):
+        """Writes the spectra of a chunk of parsed rows"""
+        self.write_scans(process_scans(chunk, self.intensity_multiplier, self.decimal_places, self.peak_threshold))
+
+    def write_scans(self, scans: ProcessedScans):
+        """Writes the spectra of a chunk already processed with this writer's settings"""
+        write_spectrum_rows(self.writer, self.mz, scans, self.encoding, self.written + 1)
+        self.written += len(scans.intensities)
+        self.rt_seconds.append(scans.rt_seconds)
+        self.stats.append(scans.stats)
+
+    def close(self):
+        """Closes the spectrum list and writes the TIC and base peak chromatograms"""
+        if self.written != self.n_scans:
+            raise ValueError(f"Expected {self.n_scans} scans, got {self.written}")
+        self._spectra.close()
+        rt_seconds = np.concatenate(self.rt_seconds) if self.rt_seconds else np.zeros(0)
+        write_chromatograms(self.writer, rt_seconds, ScanStats.concatenate(self.stats), self.encoding)
+        self._run.close()
+
+    def abort(self):
+        """Closes and removes the partial output"""
+        try:
+            self._spectra.close()
+            self._run.close()
+        except Exception:
+            pass
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+def write_mzml_metadata(writer: MzMLWriter, encoding: MzMLEncoding = DEFAULT_ENCODING, peak_threshold: float = None):
     """Write common mzML metadata"""
     writer.controlled_vocabularies()
     writer.file_description(file_contents=["MS1 Spectrum"])
@@ -122,104 +202,85 @@ def write_mzml_metadata(writer: MzMLWriter):
     writer.register("InstrumentConfiguration", "instrument1")
     writer.instrument_configuration_list([instrument])
 
-    # Data processing info
+    # Data processing info, including how the binary arrays were encoded
     processing = writer.ProcessingMethod(1, "psims_converter",
-                                         ["Conversion to mzML", "centroid spectrum"])
+                                         ["Conversion to mzML", "centroid spectrum"] +
+                                         [{"name": name, "value": value} for name, value in encoding.describe().items()] +
+                                         ([{"low intensity data point removal": peak_threshold}] if peak_threshold is not None else []))
     writer.data_processing_list([writer.DataProcessing([processing], 'DP1')])
 
 
-def write_spectra(writer: MzMLWriter, grouped_data):
-    """Write spectrum data to mzML"""
-    with writer.spectrum_list(count=len(grouped_data)):
-        for i, (rt, group) in enumerate(grouped_data):
-            writer.write_spectrum(
-                group['m/z'].values,
-                group['intensity'].values,
-                id=f"scan={i + 1}",
-                params=[
-                    "MS1 Spectrum",
-                    {"ms level": 1},
-                    {"total ion current": np.sum(group['intensity'].values)},
-                    {"scan start time": rt, "unitName": "second"}
-                ]
-            )
+def _psims_arrays(names, arrays):
+    """psims compression and encoding mappings for (compression, precision) pairs keyed by array name"""
+    compression = {name: COMPRESSIONS[c] for name, (c, _) in zip(names, arrays)}
+    dtype = {name: np.float64 if precision == 64 else np.float32 for name, (_, precision) in zip(names, arrays)}
+    return compression, dtype
 
 
-def write_chromatogram(writer: MzMLWriter, df: pd.DataFrame):
-    """Write chromatogram data to mzML"""
-    rt_array = df['Retention Time'].values.astype(float)
-    int_array = df.iloc[:, 1:].sum(axis=1).values.astype(float)
+def write_spectra(writer: MzMLWriter, mz: np.ndarray, scans: ProcessedScans, encoding: MzMLEncoding = DEFAULT_ENCODING):
+    """
+    Write one spectrum per row of the intensity matrix, all sharing the same m/z array
 
-    with writer.chromatogram_list(1):
-        writer.write_chromatogram(
-            rt_array,
-            int_array,
-            id="TIC",
-            chromatogram_type="total ion current chromatogram",
+    With scans.peaks, each spectrum only holds that scan's stored peaks instead of the full m/z axis.
+    """
+    with writer.spectrum_list(count=len(scans.intensities)):
+        write_spectrum_rows(writer, mz, scans, encoding)
+
+
+def write_spectrum_rows(writer: MzMLWriter, mz: np.ndarray, scans: ProcessedScans,
+                        encoding: MzMLEncoding = DEFAULT_ENCODING, first_scan: int = 1):
+    """The spectra of write_spectra inside an already open spectrum list, numbered from first_scan"""
+    mz = np.asarray(mz, dtype=np.float64)
+    compression, dtype = _psims_arrays(("m/z array", "intensity array"), encoding.spectrum_arrays())
+    intensities, rt_seconds, peaks = scans.intensities, scans.rt_seconds, scans.peaks
+    tic = scans.stats.tic
+    base_peak_mz = scans.stats.base_peak_mz(mz)
+    base_peak_intensity = scans.stats.base_peak_intensity
+    for i in range(len(intensities)):
+        if peaks is None:
+            scan_mz, scan_intensities = mz, intensities[i]
+        else:
+            columns, scan_intensities = peaks.row(i)
+            scan_mz = mz[columns]
+        writer.write_spectrum(
+            scan_mz,
+            scan_intensities,
+            id=f"scan={first_scan + i}",
             params=[
-                {"time array": {"unitName": "second"}},
-                {"intensity array": {"unitName": "counts"}}
-            ]
+                "MS1 Spectrum",
+                {"ms level": 1},
+                {"total ion current": tic[i]},
+                {"base peak m/z": base_peak_mz[i], "unitName": "m/z"},
+                {"base peak intensity": base_peak_intensity[i], "unitName": "number of detector counts"},
+                {"scan start time": rt_seconds[i], "unitName": "second"}
+            ],
+            # The scan start time also goes in <scan>, written here so the file never
+            # has to be re-parsed and psims' index offsets stay valid
+            scan_params=[
+                {"scan start time": rt_seconds[i], "unitName": "second"}
+            ],
+            compression=compression,
+            encoding=dtype
         )
-# mzML default namespace of the files so ET can match it
-NS_URI = "http://psi.hupo.org/ms/mzml"
-XSI_URI = "http://www.w3.org/2001/XMLSchema-instance"
-
-# ET requires a defined prefix mapping for XPath
-NS = {"mzml": NS_URI}
-
-def process_mzml_file(filepath, output_dir):
-    tree = ET.parse(filepath)
-    root = tree.getroot()  # <indexedmzML>
 
-    # Get inner <mzML> element
-    mzml_elem = root.find("mzml:mzML", NS)
-    if mzml_elem is None:
-        print(f"Skipped: <mzML> not found in {filepath}")
-        return
 
-    # Find all <spectrum> elements using the namespace
-    spectra = mzml_elem.findall(".//mzml:spectrum", NS)
-
-
-    #Loop over <spectrum> elements
-    for spectrum in spectra:
-        # Get all <cvParam> children of this <spectrum>
-        cv_params = spectrum.findall("mzml:cvParam", NS)
-
-        # Find all "scan start time" cvParams
-        scan_start_params = [cv for cv in cv_params if cv.attrib.get("accession") == "MS:1000016"]
-
-        #Loop to find <scan> in spectrum element data
-        for scan_start in scan_start_params:
-            # Remove the original from spectrum if needed
-            #spectrum.remove(scan_start)
-
-            # Find <scan> inside <scanList>
-            scan_elem = spectrum.find(".//mzml:scan", NS)
-
-            # If <scan> exists, append the line
-            if scan_elem is not None:
-                scan_elem.append(scan_start)
-
-    # Save to output directory
-    base_name = os.path.basename(filepath)
-    out_path = os.path.join(output_dir, f"{base_name}")
-
-    #Have to do this next part because ET strips some namespaces and they need to be forced back in
-
-    # Register default and xsi namespaces
-    ET.register_namespace('', NS_URI)
-    ET.register_namespace('xsi', XSI_URI)
-
-    # Set schemaLocation on both indexedmzML and mzML
-    root.set(f"{{{XSI_URI}}}schemaLocation","http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.3_idx.xsd")
-
-    mzml_elem.set("xmlns", NS_URI)  # default namespace
-    mzml_elem.set("xmlns:xsi", XSI_URI)  # explicitly sets xmlns:xsi
-    mzml_elem.set(f"{{{XSI_URI}}}schemaLocation",
-                  "http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.1.xsd")
-
-    #write file
-    tree.write(out_path, encoding="utf-8", xml_declaration=True)
-    print(f"Processed: {base_name}")
+def write_chromatograms(writer: MzMLWriter, rt_seconds: np.ndarray, stats: ScanStats,
+                        encoding: MzMLEncoding = DEFAULT_ENCODING):
+    """Write the TIC and base peak chromatograms to mzML"""
+    compression, dtype = _psims_arrays(("time array", "intensity array"), encoding.chromatogram_arrays())
+    chromatograms = [("TIC", "total ion current chromatogram", stats.tic),
+                     ("BPC", "basepeak chromatogram", stats.base_peak_intensity)]
+    with writer.chromatogram_list(len(chromatograms)):
+        for chromatogram_id, chromatogram_type, values in chromatograms:
+            writer.write_chromatogram(
+                rt_seconds.astype(float),
+                values.astype(float),
+                id=chromatogram_id,
+                chromatogram_type=chromatogram_type,
+                params=[
+                    {"time array": {"unitName": "second"}},
+                    {"intensity array": {"unitName": "counts"}}
+                ],
+                compression=compression,
+                encoding=dtype
+            )
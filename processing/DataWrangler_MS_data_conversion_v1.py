@@ -1,37 +1,24 @@
 #importing all needed libraries
 import os
 import glob
-import xml.etree.ElementTree as ET
 import pandas as pd
-import io
+from processing.msv_reader import MSVData, RT_COLUMN, read_msv
+from processing.mlt_writer import NotRepresentable, write_mlt_tsv
 
 
 #Creating a function for the data extraction that each file will undergo
-def file_processing(file_path):
+def file_processing(msv_data: MSVData):
 
-    # Parsing the XML files to get the root of each XML file loaded into python
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+    # Building the dataframe from the already parsed .msv data so the file is only read once per run.
+    # The time (minutes) and the RI columns are not kept by the reader since they are not needed in the matlab file
+    df_processed = pd.DataFrame(msv_data.intensities, columns=msv_data.mz_labels)
+    df_processed.insert(0, RT_COLUMN, msv_data.rt_ms)
 
-    # Extracting the needed MS data from the <DATA> tag text content into the variable MSDATA and then saving it to the variable raw_data
-    for MSDATA in root.iter('DATA'):
-        raw_data = MSDATA.text
-
-    #if no text is found in DATA tag or data tag doesn't exist, return an empty Dataframe so the batch process doesn't freeze
-    if not raw_data:
-        print(f'No data found in {file_path}. Skipping file...')
+    #if no scans were found, return an empty Dataframe so the batch process doesn't freeze
+    if df_processed.empty:
+        print(f'No data found in {msv_data.source}. Skipping file...')
         return pd.DataFrame()
 
-    # assigning the Raw_data as a dataframe using pandas and IO. The string values are separated by ";", so we must set sep=";"
-    # assigning the Raw_data as a dataframe using pandas and IO. The string values are separated by ";", so we must set sep=";"
-    df_raw = pd.read_csv(io.StringIO(raw_data), sep=';')
-
-    # Checking df_raw for troubleshooting. May comment out when actually running
-    # print(df_raw.head(10))
-
-    # Removing the time (minutes) and the RI columns from the dataframe. These are not needed in the matlab file
-    df_processed = df_raw.drop(['RT(minutes) - NOT USED BY IMPORT', 'RI'], axis=1)
-
     # checking the results (comment out when running actual code)
     # df_processed.info(verbose=True)
 
@@ -79,29 +66,48 @@ def file_processing(file_path):
 # We are now defining the batch processing where the above function will be ran on every file in the specified input folder
 # and then the extracted data from the tag folder will be saved to the output tsv file in the output folder
 # The "**" and recursive = True allows for us to search through all folders in the directory with files ending in .tst
-def batch_processing_MS(input_folder,output_folder, progress_signal, message_signal, pstart, total_files):
+def write_mlt(msv_data: MSVData, output_file):
+    """Write the .mlt TSV for already parsed .msv data. Returns False if there was nothing to write"""
+    # The int64 writer produces the same bytes much faster, pandas handles what it can't represent exactly
+    try:
+        if not write_mlt_tsv(msv_data, output_file):
+            print(f'No data found in {msv_data.source}. Skipping file...')
+            return False
+        print(f"Saved output to: {output_file}")
+        return True
+    except NotRepresentable:
+        return write_mlt_pandas(msv_data, output_file)
+
+
+def write_mlt_pandas(msv_data: MSVData, output_file):
+    """Reference .mlt writer through file_processing and DataFrame.to_csv"""
+    df = file_processing(msv_data)
+
+    # if the dataframe is empty, skip it and move on to the next file
+    if df.empty:
+        return False
+
+    #Saving the dataframe generated by each file to their respective TSV files
+    df.to_csv(output_file, sep='\t', index=False)
+    print(f"Saved output to: {output_file}")
+    return True
+
+def batch_processing_MS(input_folder,output_folder, progress_signal, message_signal, pstart, total_files, parse_cache=None):
     processed_files = pstart
     for file_path in glob.glob(os.path.join(input_folder,"**",'*.msv'),recursive= True):
         try:
             print(f'Currently Processing File: {file_path}')
 
-            #invoking the above function for individual file processing
-            df = file_processing(file_path)
-
-            # if the dataframe is empty, skip it and move on to the next file
-            if df.empty:
-                continue
-
             # creating a file name for the output files using the input file name as the base
             base_name = os.path.basename(file_path.replace('.msv','.mlt'))
 
             # Specifying which name to name the files should be saved to using the argument "output folder" defined in the function
             output_file = os.path.join(output_folder, base_name)
 
-
-            #Saving the dataframe generated by each file to their respective TSV files
-            df.to_csv(output_file, sep='\t', index=False)
-            print(f"Saved output to: {output_file}")
+            #invoking the above functions for individual file processing, through the parse cache when one is given
+            msv_data = parse_cache.read(file_path)[0] if parse_cache is not None else read_msv(file_path)
+            if not write_mlt(msv_data, output_file):
+                continue
 
             processed_files += 1
             progress = int((processed_files / total_files) * 100)
@@ -109,4 +115,4 @@ def batch_processing_MS(input_folder,output_folder, progress_signal, message_sig
             message_signal.emit(f"Processed {output_file}")
         except Exception as e:
             print(f'Error processing {file_path}: {e}')
-    return processed_files
\ No newline at end of file
+    return processed_files
@@ -0,0 +1,192 @@
+"""
+Headless command line entry point
+
+    python -m processing convert data.zip output_dir --start-index 1 --msconvert C:/path/to/msconvert.exe
+    python -m processing watch inbox_dir output_dir --msconvert C:/path/to/msconvert.exe
+    python -m processing clear-cache
+
+Runs the same stages as the GUI without importing Qt. Heavy modules are only imported
+when the stage that needs them starts, so --help and argument errors return immediately.
+"""
+import argparse
+import os
+import sys
+
+from processing import runner
+from processing.instrumentation import RunReport
+from processing.mzml_encoding import INTENSITY_COMPRESSIONS, MZ_COMPRESSIONS, PRECISIONS, MzMLEncoding
+from processing.output_sink import ARCHIVE_FORMATS
+
+# Modules the command line must not import before a stage runs
+HEAVY_MODULES = ("PySide6", "pandas", "psims", "numpy")
+
+
+class ConsoleSignal:
+    """Stands in for a Qt signal, anything with an emit method works for the pipeline"""
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+
+    def emit(self, value):
+        print(self.fmt.format(value), flush=True)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m processing", description="UNM data conversion without the GUI")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="convert a ZIP of .msv files")
+    convert.add_argument("zip", help="ZIP with the .msv files in its base folder")
+    convert.add_argument("output", help="output folder, the stage folders must not exist yet unless resuming")
+    add_conversion_options(convert)
+    convert.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                         help="worker processes and concurrent msconvert runs (default: CPU count)")
+    convert.add_argument("--msconvert-batch-size", type=int, default=1, help="mzML files per msconvert process (default 1)")
+    convert.add_argument("--stream-zip", action="store_true", help="read .msv files straight from the ZIP instead of extracting them")
+    convert.add_argument("--no-keep-msv", dest="keep_msv", action="store_false",
+                         help="with --stream-zip, do not write the renamed .msv copies to 1-msv")
+    convert.add_argument("--resume", action="store_true",
+                         help="reuse an existing output folder and only convert new, changed or unfinished files")
+    convert.add_argument("--parse-cache", action="store_true",
+                         help="keep the parsed .msv matrices in the parse cache so reruns with other settings skip parsing")
+    convert.add_argument("--cache-dir", help="parse cache folder (default: the per-user cache folder)")
+    convert.add_argument("--cache-size-gb", type=float, default=10.0,
+                         help="least recently used files are evicted from the parse cache above this size (default 10)")
+    convert.add_argument("--memory-budget-mb", type=float, metavar="MB",
+                         help="convert each file in chunks of scans that keep every worker process within about MB "
+                              "of working memory, for runs too large to load whole")
+    convert.add_argument("--profile-slowest", type=int, default=0, metavar="N",
+                         help="profile every file with cProfile and keep the dumps of the N slowest in output/profiles")
+    convert.add_argument("--archive", action="append", type=archive_option, default=[], metavar="[STAGE=]FORMAT",
+                         help=f"pack a stage's outputs ({', '.join(runner.STAGE_DIRS)}) into one archive in the output folder "
+                              f"instead of a file each, FORMAT is one of {', '.join(ARCHIVE_FORMATS)}. Without STAGE every "
+                              "stage is packed, repeat the option for several stages")
+    convert.add_argument("--dry-run", action="store_true",
+                         help="list the files that would be converted and their new names without writing anything")
+    convert.add_argument("--quiet", action="store_true", help="only print errors and the final status")
+
+    watch = commands.add_parser("watch", help="convert .msv files as they land in an inbox folder, until interrupted")
+    watch.add_argument("inbox", help="folder the instrument writes .msv files to")
+    watch.add_argument("output", help="output folder, created when missing and reused across restarts")
+    add_conversion_options(watch)
+    watch.add_argument("--poll-seconds", type=float, default=2.0, help="seconds between looks at the inbox (default 2)")
+    watch.add_argument("--settle-seconds", type=float, default=5.0,
+                       help="convert a file once its size has not changed for this long (default 5)")
+    watch.add_argument("--once", action="store_true", help="convert what is in the inbox and exit instead of watching")
+
+    clear_cache = commands.add_parser("clear-cache", help="delete everything in the parse cache")
+    clear_cache.add_argument("--cache-dir", help="parse cache folder (default: the per-user cache folder)")
+    return parser
+
+
+def add_conversion_options(parser):
+    """Options shared by every command that converts files"""
+    parser.add_argument("--start-index", type=int, default=1, help="index of the first renamed file (default 1)")
+    parser.add_argument("--msconvert", default="", help="path to the msconvert executable")
+    parser.add_argument("--mzxml-backend", choices=runner.MZXML_BACKENDS, default="msconvert")
+    parser.add_argument("--mzml-backend", choices=runner.MZML_BACKENDS, default="psims",
+                        help="mzML writer, template writes the same files as psims faster (default psims)")
+    parser.add_argument("--intensity-multiplier", type=float, default=1e16, help="mzML/mzXML intensity scaling (default 1e16)")
+    parser.add_argument("--decimal-places", type=int, default=3, help="mzML/mzXML intensity rounding (default 3)")
+    parser.add_argument("--mz-compression", choices=MZ_COMPRESSIONS, default="zlib", help="mzML m/z array compression (default zlib)")
+    parser.add_argument("--mz-precision", type=int, choices=PRECISIONS, default=64, help="mzML m/z float bits (default 64)")
+    parser.add_argument("--intensity-compression", choices=INTENSITY_COMPRESSIONS, default="zlib",
+                        help="mzML intensity array compression (default zlib)")
+    parser.add_argument("--intensity-precision", type=int, choices=PRECISIONS, default=32, help="mzML intensity float bits (default 32)")
+    parser.add_argument("--sparse", dest="peak_threshold", type=float, nargs="?", const=0.0, default=None, metavar="THRESHOLD",
+                        help="only write spectrum peaks above THRESHOLD (default 0, dropping the zeros) instead of the full m/z axis")
+
+
+def archive_option(value):
+    """[STAGE=]FORMAT of --archive as a dict of stage name to archive format"""
+    stage, _, archive_format = value.rpartition("=")
+    if stage and stage not in runner.STAGE_DIRS:
+        raise argparse.ArgumentTypeError(f"unknown stage {stage!r}, choose from {', '.join(runner.STAGE_DIRS)}")
+    if archive_format not in ARCHIVE_FORMATS:
+        raise argparse.ArgumentTypeError(f"unknown format {archive_format!r}, choose from {', '.join(ARCHIVE_FORMATS)}")
+    return {name: archive_format for name in ([stage] if stage else runner.STAGE_DIRS)}
+
+
+def conversion_encoding(args):
+    """The checked mzML encoding of the options, also checks msconvert when it is the mzXML backend"""
+    mzml_encoding = MzMLEncoding(args.mz_compression, args.mz_precision, args.intensity_compression, args.intensity_precision)
+    mzml_encoding.check_available()
+    if args.mzxml_backend == "msconvert":
+        runner.check_msconvert(args.msconvert)
+    return mzml_encoding
+
+
+def convert(args):
+    mzml_encoding = conversion_encoding(args)
+    archives = {stage: archive_format for option in args.archive for stage, archive_format in option.items()}
+    if not args.dry_run:
+        runner.make_output_dirs(args.output, args.resume, archives)
+
+    progress = ConsoleSignal("[{:3d}%]")
+    message = ConsoleSignal("{}")
+    if args.quiet:
+        progress.emit = message.emit = lambda value: None
+
+    parse_cache_dir = None
+    if args.parse_cache:
+        from processing.parse_cache import default_cache_dir
+        parse_cache_dir = args.cache_dir or default_cache_dir()
+
+    report = RunReport()
+    runner.run_pipeline(args.zip, args.output, args.start_index, args.msconvert, progress, message,
+                        workers=args.workers, msconvert_batch_size=args.msconvert_batch_size, mzxml_backend=args.mzxml_backend,
+                        stream_zip=args.stream_zip, keep_msv=args.keep_msv,
+                        intensity_multiplier=args.intensity_multiplier, decimal_places=args.decimal_places,
+                        run_report=report, profile_slowest=args.profile_slowest, mzml_encoding=mzml_encoding,
+                        peak_threshold=args.peak_threshold, parse_cache_dir=parse_cache_dir,
+                        parse_cache_max_bytes=int(args.cache_size_gb * 1024 ** 3), dry_run=args.dry_run,
+                        memory_budget_mb=args.memory_budget_mb, archives=archives, mzml_backend=args.mzml_backend)
+    if args.dry_run:
+        print("Dry run finished, nothing was written")
+        return
+    print("Extraction and processing finished!")
+    if report.stages:
+        print(report.summary())
+
+
+def watch(args):
+    from processing.watch import watch_inbox
+
+    mzml_encoding = conversion_encoding(args)
+    try:
+        converted = watch_inbox(args.inbox, args.output, args.start_index, args.msconvert, ConsoleSignal("{}"),
+                                mzxml_backend=args.mzxml_backend, intensity_multiplier=args.intensity_multiplier,
+                                decimal_places=args.decimal_places, mzml_encoding=mzml_encoding, peak_threshold=args.peak_threshold,
+                                poll_seconds=args.poll_seconds, settle_seconds=args.settle_seconds, once=args.once,
+                                mzml_backend=args.mzml_backend)
+    except KeyboardInterrupt:
+        print("Stopped watching, rerun the same command to carry on")
+        return
+    print(f"Converted {converted} files")
+
+
+def clear_cache(args):
+    from processing.parse_cache import ParseCache, default_cache_dir
+
+    cache_dir = args.cache_dir or default_cache_dir()
+    removed, freed = ParseCache(cache_dir).clear()
+    print(f"Removed {removed} files ({freed / 1e6:.0f} MB) from {cache_dir}")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if args.command == "convert":
+            convert(args)
+        elif args.command == "watch":
+            watch(args)
+        elif args.command == "clear-cache":
+            clear_cache(args)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+Per-stage and per-file instrumentation of a conversion run
+
+Every stage of run_pipeline and every per-file call (extracting, parsing, writing the
+.mlt, mzML and mzXML, each msconvert run) is recorded as a Measurement with its wall time,
+CPU time, bytes read and written and the peak memory of the process that ran it. The
+per-file calls run in pool workers, so their measurements are plain picklable objects
+sent back with the results and gathered into a RunReport in the calling process. The
+report is written to the output root as run_report.json and run_report.csv.
+
+Peak memory is the process high-water mark once the call finished, so a call that raised
+the peak is the one responsible for it. It is None where the platform gives no figure.
+"""
+import cProfile
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPORT_JSON = "run_report.json"
+REPORT_CSV = "run_report.csv"
+PROFILE_DIR = "profiles"
+
+
+@dataclass
+class Measurement:
+    """One timed stage or per-file call
+
+    Attributes:
+        stage (str): Stage name, e.g. "parse", "mlt", "mzml", "mzxml", "msconvert", or "cache"
+            for a parse served by the parse cache
+        file (str): File the call worked on, empty for a whole stage
+        wall_seconds (float): Elapsed time
+        cpu_seconds (float): CPU time of the calling thread, or of the child processes it ran
+        bytes_read (int): Input bytes
+        bytes_written (int): Output bytes
+        peak_rss_mb (float): Peak resident memory in MB of the process that did the work
+        error (str): Exception message when the call failed
+        n_files (int): Files the call worked on, more than 1 for a batched msconvert run labelled
+            after its first file
+    """
+    stage: str
+    file: str = ''
+    wall_seconds: float = 0.0
+    cpu_seconds: float = None
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss_mb: float = None
+    error: str = ''
+    n_files: int = 1
+
+
+def peak_rss_mb(children=False):
+    """High-water mark of the resident memory of this process, or of its largest reaped child"""
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+    if sys.platform == "win32" and not children:
+        return _windows_peak_working_set_mb()
+    return None
+
+
+def _windows_peak_working_set_mb():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                                                 "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                                                 "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize / (1024 * 1024)
+
+
+def _children_cpu_seconds():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def measure(measurements, stage, file='', bytes_read=0, output=None):
+    """
+    Times the body and appends its Measurement to measurements
+
+    The Measurement is yielded so the body can fill in bytes_read or bytes_written when it
+    only knows them afterwards. With output, bytes_written is the size of that file. An
+    exception is recorded in the Measurement and raised again.
+    """
+    m = Measurement(stage, str(file), bytes_read=bytes_read)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield m
+    except Exception as e:
+        m.error = str(e)
+        raise
+    finally:
+        m.wall_seconds = time.perf_counter() - start_wall
+        m.cpu_seconds = time.thread_time() - start_cpu
+        if output is not None and os.path.exists(output):
+            m.bytes_written = os.path.getsize(output)
+        m.peak_rss_mb = peak_rss_mb()
+        measurements.append(m)
+
+
+@contextmanager
+def accumulate(m):
+    """Adds the wall and CPU time of the body to an existing Measurement, for work done in many small steps"""
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield m
+    finally:
+        m.wall_seconds += time.perf_counter() - start_wall
+        m.cpu_seconds = (m.cpu_seconds or 0.0) + time.thread_time() - start_cpu
+
+
+@contextmanager
+def profile_file(profile_dir, stem):
+    """Runs the body under cProfile and dumps the stats to profile_dir/stem.prof, a no-op without profile_dir"""
+    if profile_dir is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(profile_dir, f"{stem}.prof"))
+
+
+class RunReport:
+    """Stage and per-file measurements of one run"""
+
+    def __init__(self, settings=None):
+        self.settings = dict(settings or {})
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+        self.files = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures a whole stage. CPU time includes the pool workers and msconvert processes
+        the stage started, peak memory is the larger of this process and its children.
+        """
+        m = Measurement(name)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time() + _children_cpu_seconds()
+        first_file = len(self.files)
+        try:
+            yield m
+        except Exception as e:
+            m.error = str(e)
+            raise
+        finally:
+            m.wall_seconds = time.perf_counter() - start_wall
+            m.cpu_seconds = time.process_time() + _children_cpu_seconds() - start_cpu
+            m.bytes_read = sum(f.bytes_read for f in self.files[first_file:])
+            m.bytes_written = sum(f.bytes_written for f in self.files[first_file:])
+            m.peak_rss_mb = max((rss for rss in (peak_rss_mb(), peak_rss_mb(children=True)) if rss is not None), default=None)
+            self.stages.append(m)
+
+    def add(self, measurements):
+        self.files.extend(measurements)
+
+    def slowest_files(self, n):
+        """
+        The n files with the highest wall time summed over their per-file calls, as (file, seconds)
+
+        Calls covering several files are left out, their time belongs to no single file.
+        """
+        totals = {}
+        for m in self.files:
+            if m.n_files != 1:
+                continue
+            key = os.path.splitext(os.path.basename(m.file))[0]
+            totals[key] = totals.get(key, 0.0) + m.wall_seconds
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def summary(self, slowest=3):
+        """Short per-stage text summary for the GUI and the command line"""
+        lines = []
+        for m in self.stages:
+            peak = "" if m.peak_rss_mb is None else f", peak {m.peak_rss_mb:.0f} MB"
+            lines.append(f"{m.stage}: {m.wall_seconds:.1f} s wall, {m.cpu_seconds:.1f} s CPU{peak}")
+        by_stage = {}
+        for m in self.files:
+            by_stage.setdefault(m.stage, []).append(m)
+        for stage, calls in by_stage.items():
+            total = sum(m.wall_seconds for m in calls)
+            worst = max(calls, key=lambda m: m.wall_seconds)
+            failed = sum(1 for m in calls if m.error)
+            line = f"  {stage}: {len(calls)} calls, {total:.1f} s, slowest {os.path.basename(worst.file)} {worst.wall_seconds:.2f} s"
+            lines.append(line + (f", {failed} failed" if failed else ""))
+        if self.files:
+            lines.append("Slowest files: " + ", ".join(f"{name} ({seconds:.1f} s)" for name, seconds in self.slowest_files(slowest)))
+        return "\n".join(lines)
+
+    def write(self, output_root):
+        """Writes run_report.json (everything) and run_report.csv (one row per call) to the output root"""
+        with open(os.path.join(output_root, REPORT_JSON), "w", encoding="utf-8") as f:
+            json.dump({
+                "started": self.started,
+                "settings": self.settings,
+                "stages": [asdict(m) for m in self.stages],
+                "files": [asdict(m) for m in self.files],
+            }, f, indent=1)
+        with open(os.path.join(output_root, REPORT_CSV), "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(Measurement)])
+            writer.writeheader()
+            for m in self.files:
+                writer.writerow(asdict(m))
+
+
+def keep_slowest_profiles(profile_dir, report, n):
+    """Deletes the dumped profiles of all but the n slowest files of the report"""
+    keep = {f"{name}.prof" for name, _ in report.slowest_files(n)}
+    for fname in os.listdir(profile_dir):
+        if fname.endswith(".prof") and fname not in keep:
+            os.remove(os.path.join(profile_dir, fname))
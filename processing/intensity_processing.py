@@ -0,0 +1,114 @@
+"""Intensity processing shared by the mzML and mzXML writers, NumPy only"""
+from dataclasses import dataclass
+
+import numpy as np
+
+
+def process_intensities(intensities: np.ndarray,
+                        multiplier: float,
+                        decimals: int) -> np.ndarray:
+    """Clip negative intensities to 0, scale and round. Returns a new float64 matrix"""
+    processed = np.where(intensities < 0, 0.000, intensities)
+    np.multiply(processed, multiplier, out=processed)
+    np.round(processed, decimals, out=processed)
+    return processed
+
+
+@dataclass
+class ScanStats:
+    """Per-scan summary of a processed intensity matrix, computed once for the mzML and mzXML writers
+
+    Attributes:
+        tic (np.ndarray): Total ion current of every scan, missing values count as 0
+        base_peak_index (np.ndarray): m/z column of every scan's most intense value, the first
+            column for scans without any value
+        base_peak_intensity (np.ndarray): That value, NaN for scans whose values are all missing
+    """
+    tic: np.ndarray
+    base_peak_index: np.ndarray
+    base_peak_intensity: np.ndarray
+
+    def base_peak_mz(self, mz: np.ndarray) -> np.ndarray:
+        return mz[self.base_peak_index] if len(mz) else np.zeros(len(self.tic))
+
+    @classmethod
+    def concatenate(cls, parts):
+        """The stats of consecutive chunks as one"""
+        if not parts:
+            return cls(np.zeros(0), np.zeros(0, dtype=np.intp), np.zeros(0))
+        return cls(*(np.concatenate([getattr(part, name) for part in parts]) for name in ("tic", "base_peak_index", "base_peak_intensity")))
+
+
+def scan_stats(intensities: np.ndarray) -> ScanStats:
+    """
+    TIC and base peak of every scan of a processed intensity matrix
+
+    One sum and one argmax over the matrix. Only when the sum shows missing values is a
+    NaN-free copy made for the argmax.
+    """
+    n_scans = len(intensities)
+    if intensities.size == 0:
+        return ScanStats(np.zeros(n_scans), np.zeros(n_scans, dtype=np.intp), np.zeros(n_scans))
+    tic = intensities.sum(axis=1)
+    values = intensities
+    if np.isnan(tic).any():
+        tic = np.nansum(intensities, axis=1)
+        values = np.nan_to_num(intensities, nan=-np.inf)
+    base_peak_index = np.argmax(values, axis=1)
+    return ScanStats(tic, base_peak_index, intensities[np.arange(n_scans), base_peak_index])
+
+
+@dataclass
+class ProcessedScans:
+    """Scans processed once and written by both the mzML and the mzXML writer
+
+    Attributes:
+        rt_seconds (np.ndarray): Retention time of every scan in seconds
+        intensities (np.ndarray): Clipped, scaled and rounded intensities, see process_intensities
+        stats (ScanStats): TIC and base peak of every scan, taken from every value
+        peaks (PeakMatrix): The peaks above the threshold in sparse peak mode, otherwise None
+    """
+    rt_seconds: np.ndarray
+    intensities: np.ndarray
+    stats: ScanStats
+    peaks: "PeakMatrix" = None
+
+
+def process_scans(msv_data, multiplier: float, decimals: int, peak_threshold: float = None) -> ProcessedScans:
+    """Processes the intensities of parsed MSV data and summarises every scan, for all the spectrum writers"""
+    intensities = process_intensities(msv_data.intensities, multiplier, decimals)
+    #Time is converted to seconds
+    return ProcessedScans(msv_data.rt_ms / 1000, intensities, scan_stats(intensities),
+                          sparse_peaks(intensities, peak_threshold) if peak_threshold is not None else None)
+
+
+@dataclass
+class PeakMatrix:
+    """Compressed sparse row form of a processed intensity matrix, only the kept peaks are stored
+
+    Attributes:
+        indptr (np.ndarray): Peaks of scan i are data[indptr[i]:indptr[i + 1]]
+        indices (np.ndarray): m/z column of every stored peak
+        data (np.ndarray): Intensity of every stored peak
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+
+    def row(self, i):
+        """(m/z columns, intensities) of the peaks of scan i"""
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:stop], self.data[start:stop]
+
+
+def sparse_peaks(intensities: np.ndarray, threshold: float = 0.0) -> PeakMatrix:
+    """
+    Keeps the intensities above threshold, scan by scan, as a PeakMatrix
+
+    Built with one comparison and one gather over the whole matrix, missing values are
+    dropped. The TIC must still be taken from the dense matrix so it stays exact.
+    """
+    keep = intensities > threshold
+    indptr = np.zeros(len(intensities) + 1, dtype=np.int64)
+    np.cumsum(keep.sum(axis=1), out=indptr[1:])
+    return PeakMatrix(indptr, np.nonzero(keep)[1], intensities[keep])
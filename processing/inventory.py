@@ -0,0 +1,28 @@
+"""
+Listing of the .msv files in a folder
+
+scan_files lists a folder, or a folder tree, with os.scandir, which reads the file type
+together with the names, and matches the names against a precompiled pattern. The watch
+command polls its inbox with it. ZIP runs list the archive's central directory instead
+and plan every name up front, see manifest.Manifest.plan.
+"""
+import os
+import re
+
+MSV_FILE = re.compile(r"\.msv\Z", re.IGNORECASE)
+
+
+def scan_files(root, pattern=MSV_FILE, recursive=True):
+    """Sorted paths of the files under root whose name matches pattern, symlinked folders are not followed"""
+    found = []
+    folders = [os.fspath(root)]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        folders.append(entry.path)
+                elif pattern.search(entry.name) and entry.is_file():
+                    found.append(entry.path)
+    found.sort()
+    return found
@@ -0,0 +1,111 @@
+"""
+Run manifest for resumable, incremental conversions
+
+manifest.json in the output root records, for every .msv member of the ZIP, its content
+fingerprint, the index and name it was given, the parameters it was converted with and
+which stage outputs are complete. A rerun into the same output root only converts members
+that are new, changed, converted with other parameters or missing a stage output.
+
+The fingerprint is the CRC-32 and size stored in the ZIP's central directory, so deciding
+what to do never has to decompress a member.
+"""
+import json
+import os
+import time
+
+from processing.reanme_msv import is_renamed, msv_new_name
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+STAGES = ("mlt", "mzml", "mzxml")
+
+# Minimum seconds between manifest writes while a batch is running
+SAVE_INTERVAL = 5.0
+
+
+def fingerprint(info):
+    """Content hash of a ZIP member from its central directory entry"""
+    return f"crc32:{info.CRC:08x}:{info.file_size}"
+
+
+class Manifest:
+    """State of one output root, keyed by the member name inside the ZIP"""
+
+    def __init__(self, path, files=None):
+        self.path = path
+        self.files = files if files is not None else {}
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls, output_root):
+        """Loads the output root's manifest, or an empty one when there is none yet"""
+        path = os.path.join(output_root, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version in {path}")
+        return cls(path, data["files"])
+
+    def save(self, force=True):
+        """Writes the manifest atomically. Without force, skips writes closer than SAVE_INTERVAL apart"""
+        now = time.monotonic()
+        if not force and now - self._last_save < SAVE_INTERVAL:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self._last_save = now
+
+    def plan(self, infos, start_idx, params):
+        """
+        Decides which members need converting
+
+        Parameters:
+            infos (list): ZipInfo of every .msv member, in the order indices are assigned
+            start_idx (int): Index of the first renamed file when the manifest has none yet
+            params (dict): Conversion parameters, a member converted with different ones is redone
+
+        Returns the (member, new name) pairs to convert. Members seen before keep their index
+        and name, new members continue after the highest index so far. Entries of the pending
+        members are reset so stage completion is recorded from scratch.
+        """
+        indices = [entry["index"] for entry in self.files.values() if entry.get("index") is not None]
+        next_idx = max([int(start_idx)] + [i + 1 for i in indices])
+
+        pending = []
+        for info in infos:
+            member = info.filename
+            entry = self.files.get(member)
+            if (entry is not None and entry["fingerprint"] == fingerprint(info) and entry["params"] == params
+                    and all(stage in entry["stages"] for stage in STAGES)):
+                continue
+
+            if entry is not None:
+                index, msv_name = entry["index"], entry["msv_name"]
+            elif is_renamed(member):
+                index, msv_name = None, member
+            else:
+                index, msv_name = next_idx, msv_new_name(member, next_idx)
+                next_idx += 1
+
+            self.files[member] = {
+                "fingerprint": fingerprint(info),
+                "index": index,
+                "msv_name": msv_name,
+                "params": dict(params),
+                "stages": [],
+                "errors": [],
+            }
+            pending.append((member, msv_name))
+        return pending
+
+    def complete(self, member, stages, errors=()):
+        """Records finished stage outputs and errors for a member"""
+        entry = self.files[member]
+        for stage in stages:
+            if stage not in entry["stages"]:
+                entry["stages"].append(stage)
+        entry["errors"].extend(errors)
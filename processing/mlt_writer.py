@@ -0,0 +1,172 @@
+"""
+.mlt writer on plain NumPy int64 arrays
+
+Writes the same tab separated file as file_processing followed by DataFrame.to_csv, byte
+for byte: a scan count column headed by the number of scans, the TIC column headed by the
+total of all TICs, RT(milliseconds) headed by the last retention time and one column per
+m/z. Intensities are clipped at 0, scaled by 1e16 and rounded, a chunk of rows at a time,
+into an int64 matrix, and the rows are formatted with one %-format call per chunk and
+written through a large buffer, instead of building an Int64 DataFrame. MltChunkWriter
+writes the same file from a stream of chunks.
+
+Missing intensities are written as empty fields like pandas writes <NA>. Files the int64
+path cannot represent exactly, a retention time that is missing or not a whole number of
+milliseconds or intensities beyond the int64 range, are left to the pandas path.
+"""
+import csv
+import os
+import shutil
+
+import numpy as np
+
+from processing.msv_reader import MSVData
+
+MLT_MULTIPLIER = 1e16
+
+# Rows converted and formatted per step
+DEFAULT_CHUNK_ROWS = 1024
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Largest float64 that still converts to int64 exactly
+_INT64_LIMIT = float(2 ** 63 - 1024)
+
+
+class NotRepresentable(ValueError):
+    """The data cannot be written exactly by the int64 path"""
+
+
+def mlt_intensities(intensities: np.ndarray, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+    """
+    Clips, scales and rounds the raw intensities into a new int64 matrix
+
+    The float work happens in a chunk sized scratch buffer, so apart from the result no
+    copy of the whole matrix is made. Returns the int64 matrix and a boolean mask of the
+    missing values, or None when nothing is missing. Missing values are 0 in the matrix.
+    """
+    n_scans, n_mz = intensities.shape
+    values = np.empty((n_scans, n_mz), dtype=np.int64)
+    missing = None
+    scratch = np.empty((min(chunk_rows, n_scans), n_mz), dtype=np.float64)
+    for start in range(0, n_scans, chunk_rows):
+        stop = min(start + chunk_rows, n_scans)
+        buf = scratch[:stop - start]
+        # Same operations as file_processing: negatives to 0 (NaN stays NaN), scale, round half to even
+        np.maximum(intensities[start:stop], 0.0, out=buf)
+        np.multiply(buf, MLT_MULTIPLIER, out=buf)
+        np.round(buf, 0, out=buf)
+
+        nan = np.isnan(buf)
+        if nan.any():
+            if missing is None:
+                missing = np.zeros((n_scans, n_mz), dtype=bool)
+            missing[start:stop] = nan
+            buf[nan] = 0.0
+        if buf.size and buf.max() > _INT64_LIMIT:
+            raise NotRepresentable("intensity out of the int64 range")
+        values[start:stop] = buf
+    return values, missing
+
+
+def mlt_retention_times(rt_ms: np.ndarray):
+    """Retention times as int64, they are written as whole milliseconds"""
+    if not np.isfinite(rt_ms).all() or (rt_ms != np.round(rt_ms)).any() or (np.abs(rt_ms) > _INT64_LIMIT).any():
+        raise NotRepresentable("retention times are not whole milliseconds")
+    return rt_ms.astype(np.int64)
+
+
+def _format_rows(first_scan: int, tic: np.ndarray, rt: np.ndarray, values: np.ndarray, missing: np.ndarray = None):
+    """The .mlt lines of consecutive scans, numbered from first_scan, in one %-format call"""
+    n_rows, n_mz = values.shape
+    n_columns = n_mz + 3
+    rows = np.empty((n_rows, n_columns), dtype=np.int64)
+    rows[:, 0] = np.arange(first_scan, first_scan + n_rows)
+    rows[:, 1] = tic
+    rows[:, 2] = rt
+    rows[:, 3:] = values
+
+    if missing is not None and missing.any():
+        # Missing intensities become empty fields, like <NA> in to_csv
+        cells = rows.astype(object)
+        cells[:, 3:][missing] = ""
+        return ("\t".join(["%s"] * n_columns) + os.linesep) * n_rows % tuple(cells.ravel().tolist())
+    return ("\t".join(["%d"] * n_columns) + os.linesep) * n_rows % tuple(rows.ravel().tolist())
+
+
+def _write_header(f, n_scans, tic_total, rt_max, mz_labels):
+    # The csv module quotes the labels exactly like to_csv does
+    header = [n_scans, tic_total, rt_max, *mz_labels]
+    csv.writer(f, delimiter="\t", lineterminator=os.linesep).writerow(str(label) for label in header)
+
+
+def write_mlt_tsv(msv_data: MSVData, output_file, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+    """
+    Writes the .mlt for parsed .msv data. Returns False if there were no scans
+
+    Raises NotRepresentable, before anything is written, for data only the pandas path handles.
+    """
+    n_scans = msv_data.n_scans
+    if n_scans == 0:
+        return False
+
+    rt = mlt_retention_times(msv_data.rt_ms)
+    values, missing = mlt_intensities(msv_data.intensities, chunk_rows)
+    tic = values.sum(axis=1)
+
+    with open(output_file, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+        _write_header(f, n_scans, tic.sum(), rt.max(), msv_data.mz_labels)
+        for start in range(0, n_scans, chunk_rows):
+            stop = min(start + chunk_rows, n_scans)
+            f.write(_format_rows(start + 1, tic[start:stop], rt[start:stop], values[start:stop],
+                                 None if missing is None else missing[start:stop]))
+    return True
+
+
+class MltChunkWriter:
+    """
+    Writes the .mlt of a file that arrives a chunk of scans at a time
+
+    The header holds totals over the whole file, so the rows go to a temporary body file
+    next to the output and the header is written once the last chunk is in, followed by
+    a copy of the body. Only one chunk is ever held in memory. Data the int64 path cannot
+    represent raises NotRepresentable, there is no pandas fallback without the whole file.
+    """
+
+    def __init__(self, output_file, mz_labels):
+        self.output_file = output_file
+        self.mz_labels = mz_labels
+        self.body_file = f"{output_file}.body"
+        self.body = open(self.body_file, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+        self.n_scans = 0
+        self.tic_total = 0
+        self.rt_max = None
+
+    def write(self, chunk: MSVData):
+        rt = mlt_retention_times(chunk.rt_ms)
+        values, missing = mlt_intensities(chunk.intensities)
+        tic = values.sum(axis=1)
+        self.body.write(_format_rows(self.n_scans + 1, tic, rt, values, missing))
+        self.n_scans += len(rt)
+        self.tic_total += int(tic.sum())
+        chunk_max = int(rt.max())
+        self.rt_max = chunk_max if self.rt_max is None else max(self.rt_max, chunk_max)
+
+    def close(self):
+        """Writes the header and the body to the output. Returns False if there were no scans"""
+        self.body.close()
+        try:
+            if self.n_scans == 0:
+                return False
+            with open(self.output_file, "w", newline="", encoding="utf-8") as f:
+                _write_header(f, self.n_scans, self.tic_total, self.rt_max, self.mz_labels)
+            with open(self.body_file, "rb") as body, open(self.output_file, "ab") as f:
+                shutil.copyfileobj(body, f, WRITE_BUFFER_SIZE)
+            return True
+        finally:
+            os.remove(self.body_file)
+
+    def abort(self):
+        """Closes and removes the partial output"""
+        self.body.close()
+        for path in (self.body_file, self.output_file):
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,51 +1,110 @@
 import os
 import subprocess
-from glob import glob
-
-def convert_mzml_to_mzxml(input_dir, output_dir, msconvert_exe_path, progress_signal, message_signal, pstart, total_files):
-    # Normalize paths
-    input_dir = os.path.normpath(input_dir)
-    output_dir = os.path.normpath(output_dir)
-
-    # Find all mzML files in input directory
-    mzml_files = glob(os.path.join(input_dir, "*.mzML"))
-
-    processed_files = pstart
-
-    for mzml_file in mzml_files:
-        # Get just the filename without path
-        filename = os.path.basename(mzml_file)
-        # Remove extension and add .mzXML
-        output_filename = os.path.splitext(filename)[0] + ".mzXML"
-        # Full output path in the output directory
-        output_file = os.path.join(output_dir, output_filename)
-
-        # Run msconvert command with absolute path https://proteowizard.sourceforge.io/tools/msconvert.html
-        cmd = [
-            msconvert_exe_path,
-            mzml_file,
-            "--outfile", output_file,
-            "--mzXML"
-        ]
-
-        # Change working directory to output directory - msconvert saves in working directory
-        original_dir = os.getcwd()
-        try:
-            os.chdir(output_dir)
-            processed_files += 1
-            progress = int((processed_files / total_files) * 100)
-            progress_signal.emit(progress)
-            message_signal.emit(f"Processing: {filename}")
-
-            subprocess.run(cmd, check=True)
-
-            # Verify file was created
-            if os.path.exists(output_filename):
-                print(f"Successfully saved to {output_file}")
-            else:
-                print(f"File not created in output directory")
-        except subprocess.CalledProcessError as e:
-            print(f"Error converting {mzml_file}: {e}")
-        finally:
-            # Always return to original directory
-            os.chdir(original_dir)
\ No newline at end of file
+import sys
+import tempfile
+import time
+
+from processing.instrumentation import Measurement
+
+# Seconds an output may look older than the msconvert launch, FAT keeps 2 second modification times
+MTIME_TOLERANCE = 2.0
+
+
+def msconvert_command(msconvert_exe_path, mzml_files, output_dir, filelist_path=None):
+    """
+    Builds the msconvert command line https://proteowizard.sourceforge.io/tools/msconvert.html
+
+    Output goes to output_dir through -o so the working directory never has to change.
+    When filelist_path is given the inputs are read by msconvert from that file (-f)
+    instead of being passed on the command line.
+    """
+    cmd = [msconvert_exe_path]
+    if filelist_path is not None:
+        cmd += ["-f", filelist_path]
+    else:
+        cmd += list(mzml_files)
+    cmd += ["-o", output_dir, "--mzXML"]
+    return cmd
+
+
+def mzxml_path(output_dir, mzml_file):
+    """Where msconvert writes the mzXML of mzml_file"""
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(mzml_file))[0] + ".mzXML")
+
+
+def run_msconvert(msconvert_exe_path, mzml_files, output_dir):
+    """
+    Runs one msconvert process for a batch of mzML files
+
+    A single file is passed on the command line, several files go through a temporary
+    filelist so msconvert's startup cost is paid once for the whole batch.
+    Returns (converted files, error strings, Measurement of the msconvert process).
+
+    Existing mzXML files of the batch, left by an earlier run that may have crashed, are
+    removed first. When msconvert exits with an error a single file counts as failed
+    even if its mzXML exists, and a batch only keeps the outputs written since the launch.
+    """
+    label = mzml_files[0] if len(mzml_files) == 1 else f"{mzml_files[0]} (+{len(mzml_files) - 1} more)"
+    measurement = Measurement("msconvert", label, bytes_read=sum(os.path.getsize(f) for f in mzml_files if os.path.exists(f)),
+                              n_files=len(mzml_files))
+    outputs = {mzml_file: mzxml_path(output_dir, mzml_file) for mzml_file in mzml_files}
+    filelist_path = None
+    start = time.perf_counter()
+    try:
+        for output_file in outputs.values():
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        launched = time.time()
+        if len(mzml_files) > 1:
+            fd, filelist_path = tempfile.mkstemp(suffix=".txt", prefix="msconvert_filelist_")
+            with os.fdopen(fd, "w") as filelist:
+                filelist.write("\n".join(mzml_files) + "\n")
+
+        cmd = msconvert_command(msconvert_exe_path, mzml_files, output_dir, filelist_path)
+        returncode, stderr = _run_measured(cmd, measurement)
+        errors = []
+        if returncode != 0:
+            errors.append(f"{', '.join(mzml_files)} - msconvert exited with {returncode}: {stderr.strip()}")
+    except OSError as e:
+        measurement.error = str(e)
+        return [], [f"{', '.join(mzml_files)} - {e}"], measurement
+    finally:
+        measurement.wall_seconds = time.perf_counter() - start
+        if filelist_path is not None:
+            os.remove(filelist_path)
+
+    # Verify the files were created
+    converted = []
+    for mzml_file, output_file in outputs.items():
+        if returncode != 0 and len(mzml_files) == 1:
+            # The exit status is the file's error, whatever msconvert left behind
+            break
+        if os.path.exists(output_file) and os.path.getmtime(output_file) >= launched - MTIME_TOLERANCE:
+            converted.append(mzml_file)
+            measurement.bytes_written += os.path.getsize(output_file)
+        else:
+            errors.append(f"{mzml_file} - file not created in output directory")
+    if errors:
+        measurement.error = errors[0]
+    return converted, errors, measurement
+
+
+def _run_measured(cmd, measurement):
+    """
+    Runs cmd and returns (return code, stderr)
+
+    Where os.wait4 exists the child is reaped with it, which fills in the CPU time and peak
+    memory of that msconvert process alone even while other msconvert runs are going.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=stderr)
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            measurement.cpu_seconds = usage.ru_utime + usage.ru_stime
+            # kilobytes on Linux, bytes on macOS
+            measurement.peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        else:
+            proc.wait()
+        stderr.seek(0)
+        return proc.returncode, stderr.read().decode(errors="replace")
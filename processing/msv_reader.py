@@ -0,0 +1,258 @@
+"""
+Streaming reader for .msv files
+
+A .msv file is an XML document whose <DATA> element holds a semicolon separated
+table with the columns RT(milliseconds), RT(minutes) - NOT USED BY IMPORT, RI and
+one column per m/z value. Instead of building an ElementTree, copying the <DATA>
+text into a StringIO and handing it to pandas, the file is scanned as bytes for
+the <DATA> element and its lines are parsed straight into NumPy arrays, a chunk
+of rows at a time. iter_msv_chunks only ever holds one chunk of text and its
+parsed rows, read_msv additionally joins the chunks into one matrix. survey_msv goes
+through a file without parsing any numbers, for writers that need the scan count before
+the first chunk.
+"""
+import hashlib
+import os
+from dataclasses import dataclass, replace
+from xml.sax.saxutils import unescape
+
+import numpy as np
+
+# Columns of the <DATA> block that are not m/z intensity columns
+RT_COLUMN = 'RT(milliseconds)'
+DROP_COLUMNS = ['RT(minutes) - NOT USED BY IMPORT', 'RI']
+
+# Rows parsed per NumPy call when reading a whole file
+DEFAULT_CHUNK_ROWS = 2048
+
+_DATA_OPEN = b'<DATA'
+_DATA_CLOSE = b'</DATA>'
+# Bytes that can follow the element name in the opening tag, anything else is a longer name like <DATAINFO>
+_NAME_END = (b'>', b'/', b' ', b'\t', b'\r', b'\n')
+
+
+@dataclass
+class MSVData:
+    """Parsed contents of one .msv file, shared by the .mlt and mzML writers
+
+    Attributes:
+        source (str): Path of the .msv file the data was read from
+        rt_ms (np.ndarray): Retention time of each scan in milliseconds
+        mz (np.ndarray): Float m/z axis, one value per intensity column
+        mz_labels (list): Original m/z column headers, kept so the .mlt header is unchanged
+        intensities (np.ndarray): Raw (n_scans, n_mz) float64 intensity matrix
+        source_sha1 (str): SHA-1 of the raw .msv bytes when the reader already had them, else empty
+    """
+    source: str
+    rt_ms: np.ndarray
+    mz: np.ndarray
+    mz_labels: list
+    intensities: np.ndarray
+    source_sha1: str = ''
+
+    @property
+    def n_scans(self) -> int:
+        return self.intensities.shape[0]
+
+
+@dataclass
+class MSVSurvey:
+    """What a chunked conversion needs to know before the first chunk is parsed
+
+    Attributes:
+        n_scans (int): Number of rows in the <DATA> table
+        n_mz (int): Number of m/z columns
+        first_rt_ms (float): Retention time of the first scan, None without scans
+        last_rt_ms (float): Retention time of the last scan, None without scans
+        sha1 (str): SHA-1 of the raw .msv bytes
+    """
+    n_scans: int
+    n_mz: int
+    first_rt_ms: float
+    last_rt_ms: float
+    sha1: str
+
+
+def survey_msv(file_path) -> MSVSurvey:
+    """
+    Counts the scans of a .msv file and hashes it in one pass over the bytes
+
+    Only the header and the retention time of the first and last rows are split, the
+    rest of the table is just counted, so this costs a small part of a parse. file_path
+    can also be an open binary file object.
+    """
+    if not hasattr(file_path, 'read'):
+        with open(file_path, 'rb') as f:
+            return survey_msv(f)
+
+    sha1 = hashlib.sha1()
+
+    def hashed_lines():
+        for line in file_path:
+            sha1.update(line)
+            yield line
+
+    lines = hashed_lines()
+    data_lines = _iter_data_lines(lines)
+    header = next(data_lines, None)
+    n_scans = n_mz = 0
+    first = last = None
+    if header is not None:
+        columns = _parse_header(header)
+        n_mz = sum(1 for c in columns if c != RT_COLUMN and c not in DROP_COLUMNS)
+        for last in data_lines:
+            if first is None:
+                first = last
+            n_scans += 1
+    for _ in lines:
+        pass
+
+    def rt(line):
+        if line is None:
+            return None
+        field = line.split(b';')[columns.index(RT_COLUMN)].strip()
+        return float(field) if field else float('nan')
+
+    return MSVSurvey(n_scans, n_mz, rt(first), rt(last), sha1.hexdigest())
+
+
+def read_msv(file_path, chunk_rows: int = DEFAULT_CHUNK_ROWS, source: str = None) -> MSVData:
+    """Read and tokenize the <DATA> block of a .msv file once"""
+    chunks = list(iter_msv_chunks(file_path, chunk_rows, source))
+    if not chunks:
+        raise ValueError(f'No data found in {source or file_path}')
+    if len(chunks) == 1:
+        return chunks[0]
+
+    return replace(
+        chunks[0],
+        rt_ms=np.concatenate([c.rt_ms for c in chunks]),
+        intensities=np.concatenate([c.intensities for c in chunks]),
+    )
+
+
+def iter_msv_chunks(file_path, chunk_rows: int = DEFAULT_CHUNK_ROWS, source: str = None):
+    """
+    Yields the <DATA> block of a .msv file as MSVData chunks of at most chunk_rows scans
+
+    file_path can also be an open binary file object, for example a ZipFile.open member,
+    in which case source names it in the parsed data. Every chunk shares the same m/z
+    axis and labels. Nothing is yielded if the file has no <DATA> element or the
+    element is empty.
+    """
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows must be at least 1")
+
+    if hasattr(file_path, 'read'):
+        yield from _iter_chunks(file_path, chunk_rows, source or getattr(file_path, 'name', ''))
+    else:
+        with open(file_path, 'rb') as f:
+            yield from _iter_chunks(f, chunk_rows, source or os.fspath(file_path))
+
+
+def _iter_chunks(f, chunk_rows: int, source: str):
+    lines = _iter_data_lines(f)
+
+    header = next(lines, None)
+    if header is None:
+        return
+    columns = _parse_header(header)
+    n_cols = len(columns)
+
+    rt_idx = columns.index(RT_COLUMN)
+    mz_idx = [i for i, c in enumerate(columns) if c != RT_COLUMN and c not in DROP_COLUMNS]
+    mz_labels = [columns[i] for i in mz_idx]
+    mz = np.asarray(mz_labels, dtype=np.float64)
+
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) == chunk_rows:
+            table = _parse_rows(block, n_cols)
+            block = []
+            yield MSVData(source, table[:, rt_idx].copy(), mz, mz_labels, _take_columns(table, mz_idx))
+    if block:
+        table = _parse_rows(block, n_cols)
+        yield MSVData(source, table[:, rt_idx].copy(), mz, mz_labels, _take_columns(table, mz_idx))
+
+
+def _find_data_open(line: bytes) -> int:
+    """Position of the first <DATA opening tag in line, -1 when there is none"""
+    start = line.find(_DATA_OPEN)
+    while start != -1:
+        if line[start + len(_DATA_OPEN):start + len(_DATA_OPEN) + 1] in _NAME_END:
+            return start
+        start = line.find(_DATA_OPEN, start + len(_DATA_OPEN))
+    return -1
+
+
+def _iter_data_lines(f):
+    """Yields the non-blank lines inside the first <DATA> element as bytes"""
+    # Skip ahead to the opening tag. The table usually starts on the same line.
+    for line in f:
+        start = _find_data_open(line)
+        if start != -1:
+            break
+    else:
+        return
+
+    # Attributes can carry the tag on over several lines
+    line = line[start + len(_DATA_OPEN):]
+    tag_end = line.find(b'>')
+    while tag_end == -1:
+        line = next(f, None)
+        if line is None:
+            return
+        tag_end = line.find(b'>')
+    if line[tag_end - 1:tag_end] == b'/':
+        return  # <DATA/>
+    line = line[tag_end + 1:]
+
+    while True:
+        end = line.find(_DATA_CLOSE)
+        if end != -1:
+            line = line[:end]
+        line = line.strip()
+        if line:
+            yield line
+        if end != -1:
+            return
+        line = next(f, None)
+        if line is None:
+            return
+
+
+def _parse_header(line: bytes) -> list:
+    """Column names of the table, de-duplicated the same way pandas.read_csv does"""
+    names = [unescape(c) for c in line.decode('utf-8').split(';')]
+    seen = {}
+    columns = []
+    for name in names:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        columns.append(name if count == 0 else f"{name}.{count}")
+    return columns
+
+
+def _parse_rows(block: list, n_cols: int) -> np.ndarray:
+    """Parse a list of semicolon separated lines into an (n_rows, n_cols) float64 array"""
+    try:
+        table = np.loadtxt(block, delimiter=';', dtype=np.float64, ndmin=2, comments=None)
+        if table.shape[1] == n_cols:
+            return table
+    except ValueError:
+        pass
+
+    # Empty cells or ragged rows: parse line by line, missing values become NaN like pandas
+    table = np.full((len(block), n_cols), np.nan)
+    for row, line in enumerate(block):
+        fields = line.split(b';')[:n_cols]
+        table[row, :len(fields)] = [float(x) if x.strip() else np.nan for x in fields]
+    return table
+
+
+def _take_columns(table: np.ndarray, idx: list) -> np.ndarray:
+    """Contiguous copy of the intensity columns. Slices are used when the columns are a single run."""
+    if idx and idx == list(range(idx[0], idx[-1] + 1)):
+        return np.ascontiguousarray(table[:, idx[0]:idx[-1] + 1])
+    return table[:, idx]
@@ -0,0 +1,93 @@
+"""
+Binary array encoding options for the mzML writer
+
+Each array type gets its own compression and float precision. The defaults are what
+the writer always used: zlib for both arrays, 64-bit m/z and 32-bit intensities, with
+the TIC chromatogram in 32-bit floats. MS-Numpress needs the optional pynumpress
+package and always encodes from 64-bit values, psims does not zlib its output on top.
+
+Kept free of psims and NumPy imports so the command line can parse and check the
+options before any heavy module is loaded.
+"""
+from dataclasses import asdict, dataclass
+
+# Option value -> psims compression name
+COMPRESSIONS = {
+    "none": "none",
+    "zlib": "zlib",
+    "numpress-linear": "MS-Numpress linear prediction compression",
+    "numpress-slof": "MS-Numpress short logged float compression",
+    "numpress-pic": "MS-Numpress positive integer compression",
+}
+MZ_COMPRESSIONS = ("none", "zlib", "numpress-linear")
+INTENSITY_COMPRESSIONS = ("none", "zlib", "numpress-slof", "numpress-pic")
+PRECISIONS = (32, 64)
+
+
+@dataclass(frozen=True)
+class MzMLEncoding:
+    """Compression and precision of the m/z and intensity arrays
+
+    Attributes:
+        mz_compression (str): One of MZ_COMPRESSIONS
+        mz_precision (int): 32 or 64 bit floats for m/z
+        intensity_compression (str): One of INTENSITY_COMPRESSIONS
+        intensity_precision (int): 32 or 64 bit floats for the intensities
+
+    The TIC chromatogram's time array is compressed like the m/z array and its intensity
+    array like the spectrum intensities, both at the intensity precision.
+    """
+    mz_compression: str = "zlib"
+    mz_precision: int = 64
+    intensity_compression: str = "zlib"
+    intensity_precision: int = 32
+
+    def __post_init__(self):
+        if self.mz_compression not in MZ_COMPRESSIONS:
+            raise ValueError(f"Unknown m/z compression: {self.mz_compression}")
+        if self.intensity_compression not in INTENSITY_COMPRESSIONS:
+            raise ValueError(f"Unknown intensity compression: {self.intensity_compression}")
+        if self.mz_precision not in PRECISIONS or self.intensity_precision not in PRECISIONS:
+            raise ValueError(f"Precision must be one of {PRECISIONS}")
+
+    @property
+    def uses_numpress(self):
+        return self.mz_compression.startswith("numpress") or self.intensity_compression.startswith("numpress")
+
+    def check_available(self):
+        """Raises ValueError when a chosen compression needs a package that is not installed"""
+        if self.uses_numpress:
+            try:
+                import pynumpress  # noqa: F401
+            except ImportError:
+                raise ValueError("MS-Numpress compression needs the pynumpress package (pip install pynumpress)")
+
+    def as_dict(self):
+        return asdict(self)
+
+    def spectrum_arrays(self):
+        """(compression, precision) of the m/z and intensity arrays of a spectrum, numpress at 64 bit"""
+        return (_array(self.mz_compression, self.mz_precision),
+                _array(self.intensity_compression, self.intensity_precision))
+
+    def chromatogram_arrays(self):
+        """(compression, precision) of the time and intensity arrays of the TIC chromatogram"""
+        return (_array(self.mz_compression, self.intensity_precision),
+                _array(self.intensity_compression, self.intensity_precision))
+
+    def describe(self):
+        """Text recorded in the data processing metadata for each array type"""
+        (mz_c, mz_p), (int_c, int_p) = self.spectrum_arrays()
+        (time_c, time_p), _ = self.chromatogram_arrays()
+        return {
+            "m/z array encoding": f"{mz_c}, {mz_p}-bit float",
+            "intensity array encoding": f"{int_c}, {int_p}-bit float",
+            "time array encoding": f"{time_c}, {time_p}-bit float",
+        }
+
+
+def _array(compression, precision):
+    return compression, 64 if compression.startswith("numpress") else precision
+
+
+DEFAULT_ENCODING = MzMLEncoding()
@@ -0,0 +1,326 @@
+"""
+Templated mzML writer, a faster alternative to writing every spectrum through psims
+
+For each spectrum psims builds component objects, resolves the CV terms of every param
+and encodes the arrays one call at a time, which dominates runs of thousands of short
+scans. This writer produces the same document, byte for byte:
+
+- the metadata up to <run> is rendered by psims once per encoding and threshold,
+- the CV terms of the spectra and chromatograms are resolved once into precompiled XML
+  fragments, so every spectrum is a single string format,
+- the m/z array of a full-axis file is encoded once for all of its spectra, and the
+  intensity arrays of a chunk are converted in one call and base64 encoded in one pass,
+- the byte offset of every <spectrum> and <chromatogram> is kept while writing for the
+  indexList, and the SHA-1 of the file is computed on the way like psims does.
+
+psims remains the reference backend. tests/test_mzml_template.py checks that both write
+identical files, benchmarks/bench_mzml_backends.py times them.
+"""
+import base64
+import hashlib
+import io
+import os
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+from processing.intensity_processing import ProcessedScans, ScanStats, process_scans
+from processing.msv_reader import MSVData
+from processing.mzml_encoding import COMPRESSIONS, DEFAULT_ENCODING, MzMLEncoding
+
+# Sections of the spectrum list start and end, as psims indents them
+SPECTRUM_LIST_OPEN = '      <spectrumList count="{}" defaultDataProcessingRef="DP1">\n'
+CHROMATOGRAM_LIST_OPEN = '      </spectrumList>\n      <chromatogramList count="{}" defaultDataProcessingRef="DP1">\n'
+RUN_CLOSE = '      </chromatogramList>\n    </run>\n  </mzML>\n'
+# CV names of the compressions psims names differently, the numpress ones are CV names already
+COMPRESSION_TERMS = {"none": "no compression", "zlib": "zlib compression"}
+
+
+@lru_cache(maxsize=None)
+def _cv():
+    from psims.controlled_vocabulary.controlled_vocabulary import load_psims
+    return load_psims()
+
+
+def _param(name, value="", unit=None):
+    """A cvParam resolved against the PSI-MS vocabulary, value may be a format field"""
+    term = _cv()[name]
+    text = f'<cvParam cvRef="PSI-MS" accession="{term.id}" name="{term.name}" value="{value}"'
+    if unit is not None:
+        # psims refers units to PSI-MS as well, which imports the unit ontology
+        unit_term = _cv()[unit]
+        text += f' unitCvRef="PSI-MS" unitAccession="{unit_term.id}" unitName="{unit_term.name}"'
+    return text + "/>"
+
+
+def _escape_braces(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def _array_fragment(array_name, unit, compression, precision, indent):
+    """Format string of a binaryDataArray, with fields for the encoded length and the base64 text"""
+    pad = " " * indent
+    return (f'{pad}<binaryDataArray encodedLength="{{}}">\n'
+            f'{pad}  {_param(array_name, unit=unit)}\n'
+            f'{pad}  {_param(COMPRESSION_TERMS.get(compression, COMPRESSIONS[compression]))}\n'
+            f'{pad}  {_param(f"{precision}-bit float")}\n'
+            f'{pad}  <binary>{{}}</binary>\n'
+            f'{pad}</binaryDataArray>\n')
+
+
+class _Fragments:
+    """The precompiled XML of one encoding's spectra and chromatograms"""
+
+    def __init__(self, encoding: MzMLEncoding):
+        (mz_c, mz_p), (int_c, int_p) = encoding.spectrum_arrays()
+        (time_c, time_p), (chrom_c, chrom_p) = encoding.chromatogram_arrays()
+        self.spectrum_arrays = ((mz_c, mz_p), (int_c, int_p))
+        self.chromatogram_arrays = ((time_c, time_p), (chrom_c, chrom_p))
+        self.spectrum = (
+            '        <spectrum index="{}" defaultArrayLength="{}" id="scan={}">\n'
+            f'          {_param("MS1 Spectrum")}\n'
+            f'          {_param("ms level", 1)}\n'
+            f'          {_param("total ion current", "{}")}\n'
+            f'          {_param("base peak m/z", "{}", "m/z")}\n'
+            f'          {_param("base peak intensity", "{}", "number of detector counts")}\n'
+            f'          {_param("scan start time", "{}", "second")}\n'
+            f'          {_param("positive scan")}\n'
+            f'          {_param("centroid spectrum")}\n'
+            '          <scanList count="1">\n'
+            f'            {_param("no combination")}\n'
+            '            <scan>\n'
+            f'              {_param("scan start time", "{}", "second")}\n'
+            '            </scan>\n'
+            '          </scanList>\n'
+            '          <binaryDataArrayList count="2">\n'
+            '{}{}'
+            '          </binaryDataArrayList>\n'
+            '        </spectrum>\n')
+        self.mz_array = _array_fragment("m/z array", "m/z", mz_c, mz_p, 12)
+        self.intensity_array = _array_fragment("intensity array", "number of detector counts", int_c, int_p, 12)
+
+        # The chromatogram params as write_chromatograms passes them, psims writes the unit mappings as the value
+        self.chromatogram = (
+            '        <chromatogram index="{}" defaultArrayLength="{}" id="{}">\n'
+            f'          {_escape_braces(_param("time array", {"unitName": "second"}, "second"))}\n'
+            f'          {_escape_braces(_param("intensity array", {"unitName": "counts"}, "number of detector counts"))}\n'
+            '          {}\n'
+            '          <binaryDataArrayList count="2">\n'
+            '{}{}'
+            '          </binaryDataArrayList>\n'
+            '        </chromatogram>\n')
+        # psims' default time unit for chromatogram arrays
+        self.time_array = _array_fragment("time array", "minute", time_c, time_p, 12)
+        self.chromatogram_intensity_array = _array_fragment("intensity array", "number of detector counts",
+                                                            chrom_c, chrom_p, 12)
+        self.chromatogram_types = {name: _param(name) for name in ("total ion current chromatogram", "basepeak chromatogram")}
+
+
+@lru_cache(maxsize=None)
+def _fragments(encoding: MzMLEncoding):
+    return _Fragments(encoding)
+
+
+@lru_cache(maxsize=None)
+def _header(encoding: MzMLEncoding, peak_threshold):
+    """Everything before the spectrum list, rendered by psims from the same metadata as write_mzml"""
+    from psims.mzml.writer import MzMLWriter
+    from processing.AMDIS_batch_data_formatterv1 import write_mzml_metadata
+
+    buffer = io.BytesIO()
+    with MzMLWriter(buffer, close=False) as writer:
+        write_mzml_metadata(writer, encoding, peak_threshold)
+        with writer.run(id="run1", instrument_configuration="instrument1"):
+            with writer.spectrum_list(count=0):
+                pass
+    document = buffer.getvalue()
+    return document[:document.index(b"      <spectrumList")]
+
+
+def encode_rows(rows, compression, precision):
+    """
+    base64 text of each array in rows, encoded the way psims encodes binaryDataArrays
+
+    The (compressed) bytes of every row are padded to a multiple of 3 bytes so the whole
+    batch goes through one b64encode call, then the padding is turned back into '=' on
+    the slice of each row. The numpress compressions go through psims row by row.
+    """
+    if compression.startswith("numpress"):
+        from psims.mzml.binary_encoding import encode_array
+        return [encode_array(row, COMPRESSIONS[compression], np.float64).decode("ascii") for row in rows]
+
+    dtype = f"<f{precision // 8}"
+    if compression == "zlib":
+        blobs = [zlib.compress(np.asarray(row, dtype=dtype).tobytes()) for row in rows]
+    else:
+        blobs = [np.asarray(row, dtype=dtype).tobytes() for row in rows]
+    text = base64.b64encode(b"".join(blob + b"\0" * (-len(blob) % 3) for blob in blobs)).decode("ascii")
+
+    encoded = []
+    position = 0
+    for blob in blobs:
+        padding = -len(blob) % 3
+        length = (len(blob) + padding) // 3 * 4
+        chunk = text[position:position + length]
+        position += length
+        encoded.append(chunk[:length - padding] + "=" * padding if padding else chunk)
+    return encoded
+
+
+class _HashingFile:
+    """Binary file wrapper that tracks the byte position and the running SHA-1"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.position = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data: bytes):
+        self.handle.write(data)
+        self.sha1.update(data)
+        self.position += len(data)
+
+
+class MzMLTemplateWriter:
+    """
+    Writes an mzML from precompiled fragments, a chunk of scans at a time
+
+    Takes the same arguments and has the same methods as MzMLChunkWriter, so it stands in
+    for it in chunked mode, and write_mzml_template hands it a whole file. The spectrum
+    count is written up front and close() checks that n_scans spectra were written.
+    """
+
+    def __init__(self, output_path, mz, n_scans, intensity_multiplier: float, decimal_places: int,
+                 encoding: MzMLEncoding = DEFAULT_ENCODING, peak_threshold: float = None):
+        self.output_path = output_path
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.n_scans = n_scans
+        self.intensity_multiplier = intensity_multiplier
+        self.decimal_places = decimal_places
+        self.encoding = encoding
+        self.peak_threshold = peak_threshold
+        self.fragments = _fragments(encoding)
+        self.rt_seconds = []
+        self.stats = []
+        self.spectrum_offsets = []
+        self._mz_array = None
+
+        header = _header(encoding, peak_threshold)
+        self.handle = open(output_path, "wb")
+        self.out = _HashingFile(self.handle)
+        self.out.write(header)
+        self.out.write(SPECTRUM_LIST_OPEN.format(n_scans).encode("ascii"))
+
+    def write(self, chunk: MSVData):
+        """Writes the spectra of a chunk of parsed rows"""
+        self.write_scans(process_scans(chunk, self.intensity_multiplier, self.decimal_places, self.peak_threshold))
+
+    def write_scans(self, scans: ProcessedScans):
+        """Writes the spectra of a chunk already processed with this writer's settings"""
+        fragments = self.fragments
+        (mz_c, mz_p), (int_c, int_p) = fragments.spectrum_arrays
+        n_rows = len(scans.intensities)
+        if scans.peaks is None:
+            if self._mz_array is None:
+                # Every spectrum of a full-axis file has the same m/z array
+                encoded, = encode_rows([self.mz], mz_c, mz_p)
+                self._mz_array = fragments.mz_array.format(len(encoded), encoded)
+            mz_arrays = [self._mz_array] * n_rows
+            lengths = [len(self.mz)] * n_rows
+            intensity_rows = list(np.asarray(scans.intensities))
+        else:
+            rows = [scans.peaks.row(i) for i in range(n_rows)]
+            mz_arrays = [fragments.mz_array.format(len(encoded), encoded)
+                         for encoded in encode_rows([self.mz[columns] for columns, _ in rows], mz_c, mz_p)]
+            lengths = [len(columns) for columns, _ in rows]
+            intensity_rows = [values for _, values in rows]
+        intensity_arrays = [fragments.intensity_array.format(len(encoded), encoded)
+                            for encoded in encode_rows(intensity_rows, int_c, int_p)]
+
+        stats = scans.stats
+        rt = scans.rt_seconds.tolist()
+        tic = stats.tic.tolist()
+        base_peak_mz = stats.base_peak_mz(self.mz).tolist()
+        base_peak_intensity = stats.base_peak_intensity.tolist()
+        first = len(self.spectrum_offsets)
+        parts = []
+        position = self.out.position
+        for i in range(n_rows):
+            index = first + i
+            text = fragments.spectrum.format(index, lengths[i], index + 1, tic[i], base_peak_mz[i], base_peak_intensity[i],
+                                             rt[i], rt[i], mz_arrays[i], intensity_arrays[i])
+            # The indexList points at the '<' of each spectrum, after its 8 spaces of indentation
+            self.spectrum_offsets.append(position + 8)
+            position += len(text)
+            parts.append(text)
+        self.out.write("".join(parts).encode("ascii"))
+        self.rt_seconds.append(scans.rt_seconds)
+        self.stats.append(stats)
+
+    def close(self):
+        """Writes the TIC and base peak chromatograms, the indexList and the checksum"""
+        if len(self.spectrum_offsets) != self.n_scans:
+            raise ValueError(f"Expected {self.n_scans} scans, got {len(self.spectrum_offsets)}")
+        fragments = self.fragments
+        (time_c, time_p), (chrom_c, chrom_p) = fragments.chromatogram_arrays
+        rt_seconds = np.concatenate(self.rt_seconds) if self.rt_seconds else np.zeros(0)
+        stats = ScanStats.concatenate(self.stats)
+        chromatograms = [("TIC", "total ion current chromatogram", stats.tic),
+                         ("BPC", "basepeak chromatogram", stats.base_peak_intensity)]
+
+        out = self.out
+        out.write(CHROMATOGRAM_LIST_OPEN.format(len(chromatograms)).encode("ascii"))
+        time_array, = encode_rows([rt_seconds.astype(float)], time_c, time_p)
+        time_fragment = fragments.time_array.format(len(time_array), time_array)
+        chromatogram_offsets = []
+        for index, (chromatogram_id, chromatogram_type, values) in enumerate(chromatograms):
+            encoded, = encode_rows([values.astype(float)], chrom_c, chrom_p)
+            chromatogram_offsets.append((chromatogram_id, out.position + 8))
+            out.write(fragments.chromatogram.format(index, len(rt_seconds), chromatogram_id,
+                                                    fragments.chromatogram_types[chromatogram_type], time_fragment,
+                                                    fragments.chromatogram_intensity_array.format(len(encoded), encoded)
+                                                    ).encode("ascii"))
+        out.write(RUN_CLOSE.encode("ascii"))
+
+        # psims' indexListOffset counts up to the end of </mzML>, before its line break
+        index_offset = out.position - 1
+        indices = [("spectrum", [(f"scan={i + 1}", offset) for i, offset in enumerate(self.spectrum_offsets)]),
+                   ("chromatogram", chromatogram_offsets)]
+        indices = [(name, offsets) for name, offsets in indices if offsets]
+        lines = [f'  <indexList count="{len(indices)}">\n']
+        for name, offsets in indices:
+            lines.append(f'    <index name="{name}">\n')
+            lines.extend(f'      <offset idRef="{ref}">{offset}</offset>\n' for ref, offset in offsets)
+            lines.append('    </index>\n')
+        lines.append(f'  </indexList>\n  <indexListOffset>{index_offset}</indexListOffset>\n  <fileChecksum>')
+        out.write("".join(lines).encode("ascii"))
+        # The checksum covers the file up to and including the opening <fileChecksum> tag
+        self.handle.write(f'{out.sha1.hexdigest()}</fileChecksum>\n</indexedmzML>'.encode("ascii"))
+        self.handle.close()
+
+    def abort(self):
+        """Closes and removes the partial output"""
+        self.handle.close()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+def write_mzml_template(msv_data: MSVData,
+                        output_path: str,
+                        intensity_multiplier: float,
+                        decimal_places: int,
+                        encoding: MzMLEncoding = DEFAULT_ENCODING,
+                        peak_threshold: float = None,
+                        scans: ProcessedScans = None):
+    """write_mzml with the templated writer, same arguments and same output"""
+    if scans is None:
+        scans = process_scans(msv_data, intensity_multiplier, decimal_places, peak_threshold)
+    writer = MzMLTemplateWriter(output_path, msv_data.mz, len(scans.intensities), intensity_multiplier, decimal_places,
+                                encoding, peak_threshold)
+    try:
+        writer.write_scans(scans)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
@@ -0,0 +1,199 @@
+"""
+Native mzXML 3.2 writer
+
+Writes mzXML straight from parsed MSV data, as an in-process alternative to writing an
+mzML and converting it with msconvert. Peaks are stored as base64 encoded m/z-intensity
+pairs in network byte order, optionally zlib compressed. Byte offsets of every <scan>
+are kept while writing so the <index>, <indexOffset> and <sha1> can be written at the end.
+MzXMLChunkWriter takes the scans a chunk at a time, write_mzxml hands it the whole file.
+"""
+import base64
+import hashlib
+import os
+import zlib
+
+import numpy as np
+
+from processing.msv_reader import MSVData
+from processing.intensity_processing import ProcessedScans, process_scans
+
+MZXML_NS = "http://sashimi.sourceforge.net/schema_revision/mzXML_3.2"
+MZXML_SCHEMA = "http://sashimi.sourceforge.net/schema_revision/mzXML_3.2/mzXML_idx_3.2.xsd"
+XSI_URI = "http://www.w3.org/2001/XMLSchema-instance"
+
+
+class _IndexingWriter:
+    """Binary file wrapper that tracks the byte position and the running SHA-1"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.position = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, text: str):
+        data = text.encode("ISO-8859-1")
+        self.handle.write(data)
+        self.sha1.update(data)
+        self.position += len(data)
+
+
+def write_mzxml(msv_data: MSVData,
+                output_path: str,
+                intensity_multiplier: float = 1e16,
+                decimal_places: int = 3,
+                precision: int = 64,
+                compress: bool = False,
+                peak_threshold: float = None,
+                scans: ProcessedScans = None):
+    """
+    Write already parsed MSV data to mzXML format
+
+    Parameters:
+        msv_data (MSVData): Parsed .msv file
+        output_path (str): Path of the mzXML file to write
+        intensity_multiplier (float): Scaling factor for intensity values, same as the mzML
+        decimal_places (int): Decimal places for rounding intensities, same as the mzML
+        precision (int): 32 or 64 bit floats for the peak pairs
+        compress (bool): zlib compress the peak pairs
+        peak_threshold (float): Only write peaks above this processed intensity, None writes the
+            full m/z axis. The TIC and base peak are still taken from every value
+        scans (ProcessedScans): The file already processed with the same settings, for
+            example by write_mzml, processed here when None
+    """
+    rt_ms = msv_data.rt_ms
+    n_scans = msv_data.n_scans
+    writer = MzXMLChunkWriter(output_path, msv_data.mz, n_scans, rt_ms[0] if n_scans else None, rt_ms[-1] if n_scans else None,
+                              msv_data.source, msv_data.source_sha1 or _file_sha1(msv_data.source),
+                              intensity_multiplier, decimal_places, precision, compress, peak_threshold)
+    try:
+        if scans is None:
+            writer.write(msv_data)
+        else:
+            writer.write_scans(scans)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+class MzXMLChunkWriter:
+    """
+    Writes an mzXML a chunk of scans at a time
+
+    The scan count, the first and last retention time and the parent file's SHA-1 are part
+    of the header, so they are given up front, see msv_reader.survey_msv. The other
+    parameters are the same as write_mzxml. close() checks that n_scans scans were written.
+    """
+
+    def __init__(self, output_path, mz, n_scans, start_rt_ms, end_rt_ms, source, source_sha1,
+                 intensity_multiplier: float = 1e16, decimal_places: int = 3, precision: int = 64,
+                 compress: bool = False, peak_threshold: float = None):
+        if precision not in (32, 64):
+            raise ValueError("precision must be 32 or 64")
+        self.output_path = output_path
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.n_scans = n_scans
+        self.intensity_multiplier = intensity_multiplier
+        self.decimal_places = decimal_places
+        self.precision = precision
+        self.compress = compress
+        self.peak_threshold = peak_threshold
+        self.low_mz = self.mz.min() if self.mz.size else 0.0
+        self.high_mz = self.mz.max() if self.mz.size else 0.0
+        # Interleaved m/z-intensity pairs, the m/z half is the same for every scan unless only peaks are written
+        self.pairs = np.empty((len(self.mz), 2), dtype=f">f{precision // 8}")
+        self.pairs[:, 0] = self.mz
+        self.offsets = []
+
+        self.handle = open(output_path, "wb")
+        out = self.out = _IndexingWriter(self.handle)
+        cutoff = f' intensityCutoff="{float(peak_threshold)}"' if peak_threshold is not None else ""
+        out.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n')
+        out.write(f'<mzXML xmlns="{MZXML_NS}"\n'
+                  f'       xmlns:xsi="{XSI_URI}"\n'
+                  f'       xsi:schemaLocation="{MZXML_NS} {MZXML_SCHEMA}">\n')
+        start = f' startTime="{_duration(start_rt_ms / 1000)}" endTime="{_duration(end_rt_ms / 1000)}"' if n_scans else ""
+        out.write(f'  <msRun scanCount="{n_scans}"{start}>\n')
+        out.write(f'    <parentFile fileName="{_escape(os.path.basename(source))}" fileType="RAWData" fileSha1="{source_sha1}"/>\n')
+        out.write(f'    <dataProcessing centroided="1"{cutoff}>\n'
+                  '      <software type="conversion" name="UNM data conversion" version="1.0"/>\n'
+                  '    </dataProcessing>\n')
+
+    def write(self, chunk: MSVData):
+        """Writes the scans of a chunk of parsed rows"""
+        self.write_scans(process_scans(chunk, self.intensity_multiplier, self.decimal_places, self.peak_threshold))
+
+    def write_scans(self, scans: ProcessedScans):
+        """Writes the scans of a chunk already processed with this writer's settings"""
+        intensities, rt_seconds, peaks = scans.intensities, scans.rt_seconds, scans.peaks
+        tic = scans.stats.tic
+        base_mz = scans.stats.base_peak_mz(self.mz)
+        base_intensity = scans.stats.base_peak_intensity
+        mz = self.mz
+        n_rows = len(intensities)
+        compression_type = "zlib" if self.compress else "none"
+
+        out = self.out
+        for i in range(n_rows):
+            if peaks is None:
+                self.pairs[:, 1] = intensities[i]
+                scan_pairs = self.pairs
+            else:
+                columns, scan_intensities = peaks.row(i)
+                scan_pairs = self.pairs[:len(columns)]
+                scan_pairs[:, 0] = mz[columns]
+                scan_pairs[:, 1] = scan_intensities
+            peak_bytes = scan_pairs.tobytes()
+            if self.compress:
+                peak_bytes = zlib.compress(peak_bytes)
+            self.offsets.append(out.position + 4)
+            out.write(f'    <scan num="{len(self.offsets)}" scanType="Full" centroided="1" msLevel="1" peaksCount="{len(scan_pairs)}" polarity="+"'
+                      f' retentionTime="{_duration(rt_seconds[i])}" lowMz="{self.low_mz}" highMz="{self.high_mz}"'
+                      f' basePeakMz="{base_mz[i]}" basePeakIntensity="{base_intensity[i]}" totIonCurrent="{tic[i]}">\n'
+                      f'      <peaks compressionType="{compression_type}" compressedLen="{len(peak_bytes) if self.compress else 0}"'
+                      f' precision="{self.precision}" byteOrder="network" contentType="m/z-int">'
+                      f'{base64.b64encode(peak_bytes).decode("ascii")}</peaks>\n'
+                      '    </scan>\n')
+
+    def close(self):
+        """Writes the scan index and the checksum"""
+        if len(self.offsets) != self.n_scans:
+            raise ValueError(f"Expected {self.n_scans} scans, got {len(self.offsets)}")
+        out = self.out
+        out.write('  </msRun>\n')
+        index_offset = out.position + 2
+        out.write('  <index name="scan">\n')
+        for i, offset in enumerate(self.offsets):
+            out.write(f'    <offset id="{i + 1}">{offset}</offset>\n')
+        out.write('  </index>\n')
+        out.write(f'  <indexOffset>{index_offset}</indexOffset>\n')
+        # The checksum covers the file up to and including the opening <sha1> tag
+        out.write('  <sha1>')
+        self.handle.write(f'{out.sha1.hexdigest()}</sha1>\n</mzXML>\n'.encode("ISO-8859-1"))
+        self.handle.close()
+
+    def abort(self):
+        """Closes and removes the partial output"""
+        self.handle.close()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+def _duration(seconds) -> str:
+    """xs:duration in seconds, the way mzXML stores retention times"""
+    return f"PT{float(seconds)}S"
+
+
+def _escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace('"', "&quot;").replace("<", "&lt;")
+
+
+def _file_sha1(path) -> str:
+    """SHA-1 of the parent .msv, empty when it is not a file on disk"""
+    if not path or not os.path.isfile(path):
+        return ""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
@@ -0,0 +1,212 @@
+"""
+Where a stage's output files end up
+
+By default every stage writes one file per sample into its own directory. On SMB and NFS
+shares the create and close of each small file costs more than writing it, so a stage can
+instead be packed into a single archive in the output root, for example 5-mzmlv2.zip.
+
+The writers and msconvert always write plain files, into the sink's staging_dir, and the
+run commits each file once every stage that reads it is done. A DirectorySink stages in
+the stage directory itself and committing does nothing. An ArchiveSink stages in a local
+temporary directory and committing appends the file to the archive and deletes it, so the
+share only ever sees the one archive. Only one thread may commit to an ArchiveSink, in the
+pipeline that is the thread running the scheduler.
+
+Next to every archive an index, <archive>.index.json, lists each member with the offset
+and size of its data in the archive. For tar and uncompressed ZIP members that is the file
+itself, which can be read with a plain seek without opening the archive.
+
+Neither format can replace a member in place, so a file committed again, because a resumed
+run redoes its sample, is appended as a second member of the same name, and a discarded
+file stays in the archive. When that happened the sink rewrites the archive on close with
+only the latest copy of every member that was not discarded.
+"""
+import copy
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import warnings
+import zipfile
+
+# Archive formats: deflated ZIP, uncompressed ZIP and uncompressed tar
+ARCHIVE_FORMATS = ("zip", "zip-stored", "tar")
+ZIP_COMPRESSION = {"zip": zipfile.ZIP_DEFLATED, "zip-stored": zipfile.ZIP_STORED}
+INDEX_SUFFIX = ".index.json"
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def archive_path(directory, archive_format):
+    """Archive replacing a stage directory, the directory name with .zip or .tar"""
+    return f"{os.path.normpath(directory)}.{'tar' if archive_format == 'tar' else 'zip'}"
+
+
+class DirectorySink:
+    """Files stay where they were written, in the stage directory"""
+
+    archived = False
+
+    def __init__(self, directory):
+        self.staging_dir = directory
+        # Where the files end up, for messages
+        self.location = directory
+
+    def path(self, name):
+        """Where the file called name is written before it is committed"""
+        return os.path.join(self.staging_dir, name)
+
+    def commit(self, name):
+        """Returns whether the file exists"""
+        return os.path.exists(self.path(name))
+
+    def discard(self, name):
+        """Removes the file, returns whether there was one"""
+        path = self.path(name)
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+        return True
+
+    def close(self):
+        pass
+
+
+class ArchiveSink(DirectorySink):
+    """
+    Packs committed files into one ZIP or tar
+
+    Parameters:
+        path (str): The archive. It must not exist yet unless resuming
+        archive_format (str): One of ARCHIVE_FORMATS
+        resume (bool): Append to an existing archive. A member committed again, because its
+            sample was redone, replaces the earlier copy once the sink is closed
+        staging_root (str): Parent of the staging directory, the system temporary folder when None
+    """
+
+    archived = True
+
+    def __init__(self, path, archive_format="zip", resume=False, staging_root=None):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {archive_format}")
+        self.archive_path = self.location = path
+        self.archive_format = archive_format
+        self.index_path = path + INDEX_SUFFIX
+        self.members = {}
+        # Names in the archive, and names of members that are superseded or discarded and are
+        # dropped by rewriting the archive on close
+        self.archived_names = set()
+        self.dropped = set()
+        self.stale = False
+        appending = resume and os.path.exists(path)
+        if appending and os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.members = json.load(f)["members"]
+        try:
+            if archive_format == "tar":
+                self.archive = tarfile.open(path, "a" if appending else "x")
+                names = [member.name for member in self.archive.getmembers()]
+            else:
+                self.archive = zipfile.ZipFile(path, "a" if appending else "x", compression=ZIP_COMPRESSION[archive_format])
+                names = self.archive.namelist()
+        except (zipfile.BadZipFile, tarfile.ReadError) as e:
+            raise ValueError(f"Cannot append to {path}, it was not closed properly ({e}). Move it away to start over") from e
+        self.archived_names = set(names)
+        # Left over duplicates, or an archive whose index is missing, get rewritten with a new index
+        self.stale = len(self.archived_names) != len(names) or self.archived_names != set(self.members)
+        self.staging_dir = tempfile.mkdtemp(prefix="unm_staging_", dir=staging_root)
+
+    def commit(self, name):
+        """Moves the staged file into the archive. Returns False when nothing was staged under name"""
+        staged = self.path(name)
+        if not os.path.exists(staged):
+            return False
+        if name in self.archived_names:
+            # The earlier copy goes when the archive is rewritten on close
+            self.stale = True
+        with open(staged, "rb") as src:
+            if self.archive_format == "tar":
+                self._add(self.archive, self.archive.gettarinfo(staged, arcname=name), src)
+            else:
+                with warnings.catch_warnings():
+                    # Until then the archive holds both copies under the same name
+                    warnings.simplefilter("ignore", UserWarning)
+                    self._add(self.archive, zipfile.ZipInfo.from_file(staged, arcname=name), src)
+        self.archived_names.add(name)
+        self.dropped.discard(name)
+        os.remove(staged)
+        return True
+
+    def discard(self, name):
+        """Removes the staged file, and a copy already in the archive once the sink is closed"""
+        staged = super().discard(name)
+        if name not in self.archived_names or name in self.dropped:
+            return staged
+        self.dropped.add(name)
+        self.members.pop(name, None)
+        self.stale = True
+        return True
+
+    def _add(self, archive, info, src):
+        """Writes the data of src as member info and records where it is in the archive"""
+        if self.archive_format == "tar":
+            archive.addfile(info, src)
+            # addfile leaves the archive at the end of the 512 byte padded data
+            offset = archive.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.members[info.name] = {"offset": offset, "size": info.size, "stored_size": info.size}
+        else:
+            info.compress_type = archive.compression
+            with archive.open(info, "w") as dest:
+                offset = archive.fp.tell()
+                shutil.copyfileobj(src, dest, COPY_BLOCK_SIZE)
+            self.members[info.filename] = {"offset": offset, "size": info.file_size, "stored_size": info.compress_size,
+                                           "crc32": f"{info.CRC:08x}"}
+
+    def _rewrite(self):
+        """Replaces the archive with a copy holding only the latest copy of every member that was not discarded"""
+        tmp_path = self.archive_path + ".rewrite"
+        self.members = {}
+        if self.archive_format == "tar":
+            with tarfile.open(self.archive_path, "r") as old, tarfile.open(tmp_path, "w") as new:
+                latest = {member.name: member for member in old.getmembers() if member.isfile()}
+                for name, member in latest.items():
+                    if name not in self.dropped:
+                        self._add(new, copy.copy(member), old.extractfile(member))
+        else:
+            # Deflated members are decompressed and compressed again, zipfile cannot copy them raw
+            with zipfile.ZipFile(self.archive_path) as old, \
+                    zipfile.ZipFile(tmp_path, "w", compression=ZIP_COMPRESSION[self.archive_format]) as new:
+                latest = {info.filename: info for info in old.infolist()}
+                for name, info in latest.items():
+                    if name in self.dropped:
+                        continue
+                    new_info = zipfile.ZipInfo(name, info.date_time)
+                    new_info.external_attr = info.external_attr
+                    new_info.file_size = info.file_size
+                    with old.open(info) as src:
+                        self._add(new, new_info, src)
+        os.replace(tmp_path, self.archive_path)
+
+    def close(self):
+        """
+        Finishes the archive, rewrites it when members were superseded or discarded, writes
+        its index and removes the staging directory
+        """
+        try:
+            self.archive.close()
+            if self.stale:
+                self._rewrite()
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"archive": os.path.basename(self.archive_path), "format": self.archive_format,
+                           "members": self.members}, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+        finally:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+def open_sink(directory, archive_format=None, resume=False):
+    """ArchiveSink packing what would go to directory, or a DirectorySink when archive_format is None"""
+    if archive_format is None:
+        return DirectorySink(directory)
+    return ArchiveSink(archive_path(directory, archive_format), archive_format, resume)
@@ -0,0 +1,168 @@
+"""
+On-disk cache of parsed .msv matrices
+
+Parsing the <DATA> text is the slowest part of converting a file, and rerunning the same
+archive with another intensity multiplier or rounding parses every file again. The cache
+keeps the retention times, m/z axis and raw intensity matrix of each parsed file as .npy
+files, and a warm run opens them with np.load(mmap_mode='r') instead of reading any text.
+
+Entries are keyed by the CRC-32 and size of the raw .msv bytes, the same content hash the
+run manifest reads from the ZIP's central directory, so ZIP members are looked up without
+decompressing them and an extracted file finds the entry its streamed member wrote. Each
+entry is a directory with rt_ms.npy, mz.npy, intensities.npy and meta.json (the m/z
+labels and the SHA-1 of the raw file). Two different files can share a CRC-32 and size,
+so a hit is only used once the SHA-1 of the file being converted matches the one in
+meta.json, see load. Entries are written under a temporary name and
+renamed into place, so parallel workers never load a half written entry. Loading an entry
+touches its meta.json and evict() removes the least recently used entries until the cache
+fits its size limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+from processing.msv_reader import MSVData, read_msv
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+META_NAME = "meta.json"
+ARRAYS = ("rt_ms", "mz", "intensities")
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def default_cache_dir():
+    """Per-user cache folder, under LOCALAPPDATA on Windows and XDG_CACHE_HOME or ~/.cache elsewhere"""
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "unm_data_conversion", "parse_cache")
+
+
+def member_key(info):
+    """Cache key of a ZIP member from its central directory entry"""
+    return f"{info.CRC:08x}-{info.file_size}"
+
+
+def file_digests(file_path):
+    """Cache key and SHA-1 of a file on disk, both from one read"""
+    crc = 0
+    size = 0
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            sha1.update(block)
+    return f"{crc:08x}-{size}", sha1.hexdigest()
+
+
+class ParseCache:
+    """Parsed .msv matrices under root, at most max_bytes of them after evict()"""
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries_dir = os.path.join(root, f"v{CACHE_VERSION}")
+
+    def load(self, key, source, sha1=None):
+        """
+        The cached MSVData for key with memory-mapped arrays, None on a miss. With sha1, an
+        entry stored for another file with the same key is a miss too
+        """
+        entry = os.path.join(self.entries_dir, key)
+        meta_path = os.path.join(entry, META_NAME)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = {name: np.load(os.path.join(entry, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        except (OSError, ValueError):
+            return None
+        if sha1 is not None and meta["sha1"] != sha1:
+            return None
+        try:
+            # The modification time of meta.json is the entry's last use
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return MSVData(source, arrays["rt_ms"], arrays["mz"], meta["mz_labels"], arrays["intensities"], meta["sha1"])
+
+    def store(self, key, msv_data: MSVData):
+        """
+        Adds parsed data under key. Failing to write, for example because another worker
+        stored the same file first or the disk is full, only loses the cache entry.
+        """
+        entry = os.path.join(self.entries_dir, key)
+        if os.path.isdir(entry):
+            return
+        try:
+            os.makedirs(self.entries_dir, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix=f".{key}-", dir=self.entries_dir)
+        except OSError:
+            return
+        try:
+            for name in ARRAYS:
+                np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(getattr(msv_data, name)))
+            with open(os.path.join(tmp, META_NAME), "w", encoding="utf-8") as f:
+                json.dump({"mz_labels": list(msv_data.mz_labels), "sha1": msv_data.source_sha1}, f)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def read(self, file_path):
+        """Reads a .msv file through the cache. Returns (MSVData, True when it came from the cache)"""
+        key, sha1 = file_digests(file_path)
+        msv_data = self.load(key, os.fspath(file_path), sha1)
+        if msv_data is not None:
+            return msv_data, True
+        msv_data = read_msv(file_path)
+        msv_data.source_sha1 = sha1
+        self.store(key, msv_data)
+        return msv_data, False
+
+    def entries(self):
+        """(last use, bytes, path) of every complete entry, least recently used first"""
+        if not os.path.isdir(self.entries_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            path = os.path.join(self.entries_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                last_use = os.path.getmtime(os.path.join(path, META_NAME))
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+            except OSError:
+                continue
+            entries.append((last_use, size, path))
+        entries.sort()
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Removes the least recently used entries until the cache fits. Returns (entries removed, bytes freed)"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = freed = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            # Entries still memory-mapped by a running conversion cannot be removed on Windows, they go next time
+            shutil.rmtree(path, ignore_errors=True)
+            if not os.path.exists(path):
+                removed += 1
+                freed += size
+                total -= size
+        return removed, freed
+
+    def clear(self):
+        """Removes every entry and any temporary entry left by an interrupted run. Returns (entries removed, bytes freed)"""
+        removed, freed = self.evict(0)
+        shutil.rmtree(self.entries_dir, ignore_errors=True)
+        return removed, freed
@@ -0,0 +1,310 @@
+import os
+import zipfile
+from contextlib import closing
+from pathlib import Path
+from processing.msv_reader import iter_msv_chunks, read_msv, survey_msv
+from processing.parse_cache import member_key
+from processing import zip_stream
+from processing.instrumentation import Measurement, accumulate, measure, peak_rss_mb, profile_file
+from processing.mzml_encoding import DEFAULT_ENCODING
+
+
+def write_outputs(msv_data, stem, mlt_folder, mzml_folder, intensity_multiplier: float = 1e16, decimal_places: int = 3,
+                  mzxml_folder=None, mzml_encoding=None, peak_threshold=None, mzml_backend="psims"):
+    """
+    Writes the .mlt and mzML (and the native mzXML when mzxml_folder is given) for one parsed file
+
+    mzml_encoding is the MzMLEncoding of the mzML binary arrays, None keeps the defaults.
+    With peak_threshold the mzML and mzXML spectra only hold the peaks above it. The
+    intensities are processed and summarised once and both writers share them, see
+    process_scans. The .mlt keeps its own raw-intensity TIC. mzml_backend picks the mzML
+    writer, "psims" or the faster "template" with the same output.
+
+    Returns a (stage, progress message) pair for every output that was written, stage being
+    "mlt", "mzml" or "mzxml", a list of error strings and a Measurement of every writer call.
+    """
+    # Imported here so pandas and psims are only loaded once a file is actually written
+    from processing.DataWrangler_MS_data_conversion_v1 import write_mlt
+    from processing.AMDIS_batch_data_formatterv1 import write_mzml
+    from processing.mzxml_writer import write_mzxml
+    from processing.intensity_processing import process_scans
+
+    written = []
+    errors = []
+    metrics = []
+    label = msv_data.source
+    scans = None
+
+    try:
+        mlt_file = os.path.join(mlt_folder, f"{stem}.mlt")
+        with measure(metrics, "mlt", label, output=mlt_file):
+            mlt_written = write_mlt(msv_data, mlt_file)
+        if mlt_written:
+            written.append(("mlt", f"Processed {mlt_file}"))
+    except Exception as e:
+        errors.append(f"{label} (mlt) - {str(e)}")
+
+    try:
+        mzml_file = os.path.join(mzml_folder, f"{stem}.mzML")
+        with measure(metrics, "mzml", label, output=mzml_file):
+            # Timed with the mzML, the mzXML reuses it
+            scans = process_scans(msv_data, intensity_multiplier, decimal_places, peak_threshold)
+            write_mzml(msv_data, mzml_file, intensity_multiplier, decimal_places, mzml_encoding or DEFAULT_ENCODING,
+                       peak_threshold, scans, mzml_backend)
+        written.append(("mzml", f"Processed: {label} → {mzml_file}"))
+    except Exception as e:
+        errors.append(f"{label} (mzML) - {str(e)}")
+
+    if mzxml_folder is not None:
+        try:
+            mzxml_file = os.path.join(mzxml_folder, f"{stem}.mzXML")
+            with measure(metrics, "mzxml", label, output=mzxml_file):
+                write_mzxml(msv_data, mzxml_file, intensity_multiplier, decimal_places, peak_threshold=peak_threshold,
+                            scans=scans)
+            written.append(("mzxml", f"Processed: {label} → {mzxml_file}"))
+        except Exception as e:
+            errors.append(f"{label} (mzXML) - {str(e)}")
+
+    return written, errors, metrics
+
+
+# Rough bytes held per intensity value of a chunk in chunked mode: the text lines, the parsed
+# table, the processed copy the mzML and mzXML writers share and the formatted .mlt rows
+BYTES_PER_VALUE = 160
+
+
+def chunk_rows_for_budget(memory_budget_mb, n_mz):
+    """Scans per chunk that keep the working set of one chunk within memory_budget_mb"""
+    return max(1, int(memory_budget_mb * 1024 * 1024 // (max(n_mz, 1) * BYTES_PER_VALUE)))
+
+
+def write_outputs_chunked(chunks, survey, parse, label, stem, mlt_folder, mzml_folder, intensity_multiplier: float = 1e16,
+                          decimal_places: int = 3, mzxml_folder=None, mzml_encoding=None, peak_threshold=None,
+                          mzml_backend="psims"):
+    """
+    Writes the same outputs as write_outputs from a stream of parsed chunks, one chunk at a time
+
+    chunks yields the MSVData chunks of one file and survey is its MSVSurvey, which the mzML
+    and mzXML headers need before the first chunk. Time spent parsing the chunks is added
+    to the parse Measurement. A writer that fails drops out and removes its partial file
+    while the others carry on, a parse error fails the whole file. Returns the same as
+    write_outputs, with one Measurement per output summed over all chunks. Each chunk is
+    processed once for the mzML and mzXML writers, timed with the first of them.
+    """
+    from processing.mlt_writer import MltChunkWriter
+    from processing.AMDIS_batch_data_formatterv1 import MzMLChunkWriter
+    from processing.mzml_template import MzMLTemplateWriter
+    from processing.mzxml_writer import MzXMLChunkWriter
+    from processing.intensity_processing import process_scans
+
+    outputs = {"mlt": os.path.join(mlt_folder, f"{stem}.mlt"), "mzml": os.path.join(mzml_folder, f"{stem}.mzML")}
+    if mzxml_folder is not None:
+        outputs["mzxml"] = os.path.join(mzxml_folder, f"{stem}.mzXML")
+    names = {"mlt": "mlt", "mzml": "mzML", "mzxml": "mzXML"}
+    messages = {"mlt": f"Processed {outputs['mlt']}", "mzml": f"Processed: {label} → {outputs['mzml']}",
+                "mzxml": f"Processed: {label} → {outputs.get('mzxml')}"}
+    metrics = {stage: Measurement(stage, label) for stage in outputs}
+    writers = {}
+    written = []
+    errors = []
+
+    def open_writer(stage, first):
+        if stage == "mlt":
+            return MltChunkWriter(outputs[stage], first.mz_labels)
+        if stage == "mzml":
+            writer_class = MzMLTemplateWriter if mzml_backend == "template" else MzMLChunkWriter
+            return writer_class(outputs[stage], first.mz, survey.n_scans, intensity_multiplier, decimal_places,
+                                mzml_encoding or DEFAULT_ENCODING, peak_threshold)
+        return MzXMLChunkWriter(outputs[stage], first.mz, survey.n_scans, survey.first_rt_ms, survey.last_rt_ms,
+                                label, survey.sha1, intensity_multiplier, decimal_places, peak_threshold=peak_threshold)
+
+    def fail(stage, e):
+        errors.append(f"{label} ({names[stage]}) - {str(e)}")
+        writer = writers.pop(stage, None)
+        if writer is not None:
+            writer.abort()
+
+    first = True
+    with closing(iter(chunks)) as chunks:
+        while True:
+            try:
+                with accumulate(parse):
+                    chunk = next(chunks, None)
+            except Exception as e:
+                parse.error = str(e)
+                for writer in writers.values():
+                    writer.abort()
+                return [], [f"{label} - {str(e)}"], list(metrics.values())
+            if chunk is None:
+                break
+            if first:
+                first = False
+                for stage in outputs:
+                    with accumulate(metrics[stage]):
+                        try:
+                            writers[stage] = open_writer(stage, chunk)
+                        except Exception as e:
+                            fail(stage, e)
+            scans = None
+            for stage in list(writers):
+                with accumulate(metrics[stage]):
+                    try:
+                        if stage == "mlt":
+                            writers[stage].write(chunk)
+                            continue
+                        if scans is None:
+                            scans = process_scans(chunk, intensity_multiplier, decimal_places, peak_threshold)
+                        writers[stage].write_scans(scans)
+                    except Exception as e:
+                        fail(stage, e)
+
+    if first:
+        return [], [f"{label} - No data found in {label}"], list(metrics.values())
+
+    for stage, writer in writers.items():
+        with accumulate(metrics[stage]):
+            try:
+                if writer.close() is not False:
+                    written.append((stage, messages[stage]))
+            except Exception as e:
+                writer.abort()
+                errors.append(f"{label} ({names[stage]}) - {str(e)}")
+    for stage, m in metrics.items():
+        if os.path.exists(outputs[stage]):
+            m.bytes_written = os.path.getsize(outputs[stage])
+        m.peak_rss_mb = parse.peak_rss_mb = peak_rss_mb()
+    return written, errors, list(metrics.values())
+
+
+def convert_msv_file(file_path, mlt_folder, mzml_folder, intensity_multiplier: float = 1e16, decimal_places: int = 3,
+                     mzxml_folder=None, profile_dir=None, mzml_encoding=None, peak_threshold=None, parse_cache=None,
+                     memory_budget_mb=None, mzml_backend="psims"):
+    """
+    Converts one .msv file to .mlt and mzML, parsing it only once
+
+    When mzxml_folder is given the mzXML is written from the same parsed data by the
+    native writer instead of being left for msconvert. Runs in a worker process of the
+    runner's convert stage, so it only returns plain data, see write_outputs. With
+    profile_dir the whole conversion runs under cProfile, see profile_file. With a
+    ParseCache the parsed matrices are loaded from it, or stored in it after parsing.
+    With memory_budget_mb the file is converted in chunks of scans sized to the budget
+    instead, see write_outputs_chunked. The parse cache only holds whole files, so it is
+    not used then. mzml_backend is the mzML writer, see write_outputs.
+    """
+    metrics = []
+    with profile_file(profile_dir, Path(file_path).stem):
+        if memory_budget_mb is not None:
+            parse = Measurement("parse", str(file_path), bytes_read=os.path.getsize(file_path))
+            try:
+                with accumulate(parse):
+                    survey = survey_msv(file_path)
+            except Exception as e:
+                parse.error = str(e)
+                return [], [f"{file_path} - {str(e)}"], [parse]
+            chunks = iter_msv_chunks(file_path, chunk_rows_for_budget(memory_budget_mb, survey.n_mz))
+            written, errors, write_metrics = write_outputs_chunked(chunks, survey, parse, file_path, Path(file_path).stem,
+                                                                   mlt_folder, mzml_folder, intensity_multiplier, decimal_places,
+                                                                   mzxml_folder, mzml_encoding, peak_threshold, mzml_backend)
+            return written, errors, [parse] + write_metrics
+
+        try:
+            with measure(metrics, "parse", file_path) as m:
+                m.bytes_read = os.path.getsize(file_path)
+                if parse_cache is None:
+                    msv_data = read_msv(file_path)
+                else:
+                    msv_data, cached = parse_cache.read(file_path)
+                    if cached:
+                        m.stage = "cache"
+        except Exception as e:
+            return [], [f"{file_path} - {str(e)}"], metrics
+
+        written, errors, write_metrics = write_outputs(msv_data, Path(file_path).stem, mlt_folder, mzml_folder,
+                                                       intensity_multiplier, decimal_places, mzxml_folder, mzml_encoding,
+                                                       peak_threshold, mzml_backend)
+    return written, errors, metrics + write_metrics
+
+
+def convert_zip_member(zip_path, member, msv_name, mlt_folder, mzml_folder, intensity_multiplier: float = 1e16,
+                       decimal_places: int = 3, mzxml_folder=None, msv_folder=None, profile_dir=None, mzml_encoding=None,
+                       peak_threshold=None, parse_cache=None, memory_budget_mb=None, mzml_backend="psims"):
+    """
+    Converts one .msv member of a ZIP without extracting it first
+
+    The member is parsed as it is decompressed and its outputs are named after msv_name.
+    With msv_folder the raw bytes are also copied to msv_folder/msv_name on the way.
+    With a ParseCache holding the member, it is only decompressed to check its SHA-1
+    against the entry's, and parsed when they differ. memory_budget_mb converts the member in chunks like
+    convert_msv_file, it is then decompressed twice, once to count its scans. Returns
+    write_outputs' messages and errors, the bytes read from the ZIP, the seconds spent
+    reading them and the measurements of the parse and writer calls.
+    """
+    metrics = []
+    stream = sink = None
+    with profile_file(profile_dir, Path(msv_name).stem):
+        if memory_budget_mb is not None:
+            parse = Measurement("parse", msv_name)
+            try:
+                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                    with accumulate(parse), zip_ref.open(member) as raw:
+                        survey = survey_msv(raw)
+                    stream, sink = zip_stream.open_member(zip_ref, member, msv_name, msv_folder)
+                    try:
+                        chunks = iter_msv_chunks(stream, chunk_rows_for_budget(memory_budget_mb, survey.n_mz), source=msv_name)
+                        written, errors, write_metrics = write_outputs_chunked(chunks, survey, parse, msv_name, Path(msv_name).stem,
+                                                                               mlt_folder, mzml_folder, intensity_multiplier,
+                                                                               decimal_places, mzxml_folder, mzml_encoding,
+                                                                               peak_threshold, mzml_backend)
+                        with accumulate(parse):
+                            stream.drain()
+                    finally:
+                        parse.bytes_read = stream.bytes_read
+                        if sink is not None:
+                            sink.close()
+            except Exception as e:
+                parse.error = str(e)
+                read = (stream.bytes_read, stream.seconds) if stream is not None else (0, 0.0)
+                return [], [f"{member} - {str(e)}"], *read, [parse]
+            return written, errors, stream.bytes_read, stream.seconds, [parse] + write_metrics
+
+        try:
+            with measure(metrics, "parse", msv_name) as m, zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                key = msv_data = None
+                if parse_cache is not None:
+                    key = member_key(zip_ref.getinfo(member))
+                    msv_data = parse_cache.load(key, msv_name)
+                if msv_data is not None:
+                    # The key is only the CRC-32 and size, the member is still hashed to make sure the
+                    # entry is this file's. That decompresses it, with the copy to msv_folder on the way
+                    stream, sink = zip_stream.open_member(zip_ref, member, msv_name, msv_folder)
+                    try:
+                        stream.drain()
+                    finally:
+                        m.bytes_read = stream.bytes_read
+                        if sink is not None:
+                            sink.close()
+                    if stream.sha1.hexdigest() == msv_data.source_sha1:
+                        m.stage = "cache"
+                    else:
+                        msv_data = key = None
+                if msv_data is None:
+                    stream, sink = zip_stream.open_member(zip_ref, member, msv_name, msv_folder)
+                    try:
+                        msv_data = read_msv(stream, source=msv_name)
+                        stream.drain()
+                        msv_data.source_sha1 = stream.sha1.hexdigest()
+                    finally:
+                        m.bytes_read = stream.bytes_read
+                        if sink is not None:
+                            sink.close()
+                    if key is not None:
+                        parse_cache.store(key, msv_data)
+        except Exception as e:
+            read = (stream.bytes_read, stream.seconds) if stream is not None else (0, 0.0)
+            return [], [f"{member} - {str(e)}"], *read, metrics
+
+        written, errors, write_metrics = write_outputs(msv_data, Path(msv_name).stem, mlt_folder, mzml_folder,
+                                                       intensity_multiplier, decimal_places, mzxml_folder, mzml_encoding,
+                                                       peak_threshold, mzml_backend)
+    read = (stream.bytes_read, stream.seconds) if stream is not None else (0, 0.0)
+    return written, errors, *read, metrics + write_metrics
@@ -0,0 +1,139 @@
+"""
+Progress accounting for a run, shared by the GUI and the command line
+
+The stages used to emit a percentage and a message for every file against a total of
+len(files) * 4, so skipped and failed files never moved the bar, and a batch of 50k files
+queued hundreds of thousands of cross-thread events on the GUI. A ProgressTracker counts,
+for every stage, the files that completed, failed or were skipped, so each file accounts
+for each of its stages exactly once and the bar ends at 100%. Updates are coalesced: the
+percentage and the latest message, with the file rate and an ETA, are emitted at most every
+min_interval seconds, whatever the number of files.
+
+The tracker is not thread safe. run_pipeline only records from the thread that runs the
+scheduler, where the stage results come in.
+"""
+import time
+from dataclasses import dataclass
+
+COMPLETED = "completed"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# Seconds between emitted updates
+MIN_INTERVAL = 0.25
+
+
+@dataclass
+class StageCounts:
+    """Files a stage completed, failed or skipped"""
+    completed: int = 0
+    failed: int = 0
+    skipped: int = 0
+
+    def total(self):
+        return self.completed + self.failed + self.skipped
+
+
+def format_seconds(seconds):
+    """h:mm:ss, or m:ss below an hour"""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class ProgressTracker:
+    """
+    Counts every file through stages and emits throttled progress
+
+    Parameters:
+        n_files (int): Files of the run, including the ones skipped up front
+        stages (tuple): Names of the stages every file goes through
+        progress_signal: Gets the percentage of file stages accounted for
+        message_signal: Gets the latest message with the file count, files/s and ETA
+        min_interval (float): Seconds between updates, the first and the final one always go out
+    """
+
+    def __init__(self, n_files, stages, progress_signal, message_signal, min_interval=MIN_INTERVAL, clock=time.monotonic):
+        self.n_files = n_files
+        self.stages = {stage: StageCounts() for stage in stages}
+        self.progress_signal = progress_signal
+        self.message_signal = message_signal
+        self.min_interval = min_interval
+        self.clock = clock
+        self.started = clock()
+        # Stages recorded so far of the files that are partway through
+        self.open_files = {}
+        self.files_done = 0
+        # Files skipped up front do not count towards the rate
+        self.files_skipped = 0
+        self.message = ""
+        self._last_emit = None
+
+    def record(self, file, stage, outcome, message=None):
+        """Accounts for one stage of a file, COMPLETED, FAILED or SKIPPED"""
+        counts = self.stages[stage]
+        setattr(counts, outcome, getattr(counts, outcome) + 1)
+        recorded = self.open_files.setdefault(file, set())
+        recorded.add(stage)
+        if len(recorded) == len(self.stages):
+            del self.open_files[file]
+            self.files_done += 1
+        if message is not None:
+            self.message = message
+        self.update()
+
+    def finish(self, file, message=None):
+        """Marks the stages not recorded yet as skipped, for a file that stops early or never started"""
+        recorded = self.open_files.get(file, set())
+        for stage in self.stages:
+            if stage not in recorded:
+                self.record(file, stage, SKIPPED, message)
+
+    def skip_files(self, n, message=None):
+        """Accounts for n files that need none of the stages, such as the ones a resumed run has already"""
+        for counts in self.stages.values():
+            counts.skipped += n
+        self.files_done += n
+        self.files_skipped += n
+        if message is not None:
+            self.message = message
+        self.update()
+
+    def percent(self):
+        total = self.n_files * len(self.stages)
+        return 100 if total == 0 else int(sum(counts.total() for counts in self.stages.values()) * 100 / total)
+
+    def rate(self):
+        """Files finished per second since the tracker started, not counting the ones skipped up front"""
+        elapsed = self.clock() - self.started
+        return (self.files_done - self.files_skipped) / elapsed if elapsed > 0 else 0.0
+
+    def status(self):
+        """The latest message with the file count, rate and ETA"""
+        rate = self.rate()
+        status = f"{self.files_done}/{self.n_files} files, {rate:.1f} files/s"
+        if rate > 0 and self.files_done < self.n_files:
+            status += f", ETA {format_seconds((self.n_files - self.files_done) / rate)}"
+        return f"{self.message} ({status})" if self.message else status
+
+    def update(self, force=False):
+        """Emits the current progress unless the last update went out less than min_interval ago"""
+        now = self.clock()
+        if not force and self._last_emit is not None and now - self._last_emit < self.min_interval:
+            return
+        self._last_emit = now
+        self.progress_signal.emit(self.percent())
+        self.message_signal.emit(self.status())
+
+    def summary(self):
+        """Per-stage counts, for example 'mlt: 39 completed, 1 failed'"""
+        parts = []
+        for stage, counts in self.stages.items():
+            outcomes = [f"{getattr(counts, outcome)} {outcome}" for outcome in (COMPLETED, FAILED, SKIPPED) if getattr(counts, outcome)]
+            parts.append(f"{stage}: {', '.join(outcomes) or 'nothing'}")
+        return "; ".join(parts)
+
+    def close(self):
+        """Emits the final progress and the per-stage summary"""
+        self.update(force=True)
+        self.message_signal.emit(self.summary())
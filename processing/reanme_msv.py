@@ -1,6 +1,33 @@
 import os
 import re
 
+# Files that already carry a 5 digit index are not renamed again
+RENAMED_PATTERN = re.compile(r'^\d{5}_')
+
+
+def is_renamed(fname):
+    return RENAMED_PATTERN.match(fname) is not None
+
+
+def msv_new_name(fname, idx):
+    """Sequential name for a raw .msv file name, without touching the file"""
+    # split at -, --, and _ with regex
+    parts = re.split(r'-{1,2}|_', fname)
+
+    year = parts[0]
+    month = parts[1]
+    day = parts[2]
+    time = parts[3]
+    type = parts[4]
+    #here we skip the rest and just grab the end
+    c_start = parts[-2]
+    c_end = parts[-1]
+
+    #get rid of .msv so it doesnt save .msv.msv
+    c_end = c_end.replace('.msv', '')
+
+    return f"{int(idx):05d}_{year}_{month}_{day}__{time}_{type}_{c_start}_{c_end}.msv"
+
 
 def rename_msv_files(root_dir, start_idx, progress_signal, message_signal, pstart, total_files):
     idx = start_idx
@@ -9,28 +36,12 @@ def rename_msv_files(root_dir, start_idx, progress_signal, message_signal, pstar
     for dirpath, _, filenames in os.walk(root_dir):
         for fname in filenames:
             if fname.lower().endswith(".msv"):
-                if re.match(r'^\d{5}_', fname) or "original_named_files" in dirpath:
+                if is_renamed(fname) or "original_named_files" in dirpath:
                     print(f"Skipping already-renamed or backup file: {fname}")
                     continue
 
                 old_path = os.path.join(dirpath, fname)
-
-                # split at -, --, and _ with regex
-                parts = re.split(r'-{1,2}|_', fname)
-
-                year = parts[0]
-                month = parts[1]
-                day = parts[2]
-                time = parts[3]
-                type = parts[4]
-                #here we skip the rest and just grab the end
-                c_start = parts[-2]
-                c_end = parts[-1]
-
-                #get rid of .msv so it doesnt save .msv.msv
-                c_end = c_end.replace('.msv', '')
-
-                new_name = f"{idx:05d}_{year}_{month}_{day}__{time}_{type}_{c_start}_{c_end}.msv"
+                new_name = msv_new_name(fname, idx)
                 new_path = os.path.join(dirpath, new_name)
 
                 os.rename(old_path, new_path)
@@ -44,4 +55,4 @@ def rename_msv_files(root_dir, start_idx, progress_signal, message_signal, pstar
                 progress = int((processed_files / total_files) * 100)
                 progress_signal.emit(progress)
                 message_signal.emit(f"Processing: {fname} -> {new_name}")
-    return processed_files
\ No newline at end of file
+    return processed_files
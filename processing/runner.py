@@ -0,0 +1,432 @@
+"""
+Qt-free driver for the conversion pipeline
+
+Both the GUI Worker and the command line call run_pipeline. Progress and status go
+through any objects with an emit method, Qt signals in the GUI and console printers on
+the command line. The stage modules pull in pandas, psims and NumPy, so they are only
+imported once the stage that needs them runs.
+"""
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+
+from processing import zip_stream
+from processing.instrumentation import PROFILE_DIR, RunReport, keep_slowest_profiles, measure
+from processing.manifest import STAGES, Manifest
+from processing.mzml_encoding import DEFAULT_ENCODING
+from processing.output_sink import ARCHIVE_FORMATS, archive_path, open_sink
+from processing.progress import ProgressTracker
+
+MSV_DIR = "1-msv"
+MLT_DIR = "3-mlt"
+MZML_DIR = "5-mzmlv2"
+MZXML_DIR = "6-mzxml"
+OUTPUT_DIRS = (MSV_DIR, MLT_DIR, MZML_DIR, MZXML_DIR)
+# Outputs that can be packed into an archive instead of their directory, see output_sink
+STAGE_DIRS = {"msv": MSV_DIR, "mlt": MLT_DIR, "mzml": MZML_DIR, "mzxml": MZXML_DIR}
+OUTPUT_EXTENSIONS = {"msv": ".msv", "mlt": ".mlt", "mzml": ".mzML", "mzxml": ".mzXML"}
+
+# mzXML backends: msconvert converts the written mzML, native writes mzXML from the parsed .msv
+MZXML_BACKENDS = ("msconvert", "native")
+# mzML backends: psims is the reference, template writes the same bytes from precompiled
+# fragments, see mzml_template. The files do not depend on it, so it is not in the manifest
+MZML_BACKENDS = ("psims", "template")
+
+# Files allowed to wait for a stage, per process or thread of that stage
+QUEUE_DEPTH = 2
+
+
+def check_msconvert(ms_convert_path):
+    """Raises FileNotFoundError unless the EXACT path exists (including msconvert.exe)"""
+    print(f"Checking for executable at: {ms_convert_path}")
+    if not ms_convert_path or not os.path.isfile(ms_convert_path):
+        raise FileNotFoundError(f"Executable not found at {ms_convert_path}")
+
+
+def make_output_dirs(extract_dir, resume=False, archives=None):
+    """
+    Creates the stage directories. Raises OSError if any of them already exists,
+    unless resuming a run into the same output root.
+
+    The stages in archives, a dict of stage name to archive format, get no directory.
+    Their archive must not exist yet unless resuming.
+    """
+    archives = archives or {}
+    os.makedirs(extract_dir, exist_ok=True)
+    for stage, name in STAGE_DIRS.items():
+        directory = os.path.join(extract_dir, name)
+        if stage not in archives:
+            os.makedirs(directory, exist_ok=resume)
+        elif not resume and os.path.exists(archive_path(directory, archives[stage])):
+            raise FileExistsError(f"{archive_path(directory, archives[stage])} already exists")
+
+
+def manifest_params(intensity_multiplier, decimal_places, mzxml_backend, mzml_encoding, peak_threshold):
+    """Conversion parameters recorded in the manifest, a file converted with other ones is redone"""
+    return {"intensity_multiplier": intensity_multiplier, "decimal_places": decimal_places, "mzxml_backend": mzxml_backend,
+            "mzml_encoding": mzml_encoding.as_dict(), "peak_threshold": peak_threshold}
+
+
+def run_pipeline(zip_path, extract_dir, start_idx, ms_convert_path, progress_signal, message_signal,
+                 workers=1, msconvert_batch_size=1, mzxml_backend="msconvert", stream_zip=False, keep_msv=True,
+                 intensity_multiplier=1e16, decimal_places=3, run_report=None, profile_slowest=0, mzml_encoding=DEFAULT_ENCODING,
+                 peak_threshold=None, parse_cache_dir=None, parse_cache_max_bytes=None, dry_run=False,
+                 memory_budget_mb=None, pools=None, cancel=None, archives=None, mzml_backend="psims"):
+    """
+    Runs every stage on one ZIP of .msv files. The output directories must already exist
+
+    Parameters:
+        zip_path (str): ZIP with the .msv files in its base folder
+        extract_dir (str): Output root holding the stage directories and the run manifest
+        start_idx (int): Index given to the first renamed file
+        ms_convert_path (str): msconvert executable, only used by the msconvert backend
+        workers (int): Processes for the per-file conversion, also the number of concurrent msconvert runs
+        msconvert_batch_size (int): mzML files handed to each msconvert process
+        mzxml_backend (str): "msconvert" or "native"
+        stream_zip (bool): Read .msv members straight out of the ZIP instead of extracting them to 1-msv first
+        keep_msv (bool): While streaming, still write the renamed raw copy to 1-msv
+        intensity_multiplier (float): Scaling factor for mzML/mzXML intensity values
+        decimal_places (int): Decimal places for rounding mzML/mzXML intensities
+        run_report (RunReport): Receives the stage and per-file measurements, a new one is used when None
+        profile_slowest (int): Profile every file's conversion with cProfile and keep the dumps of
+            the slowest this many in the output root's profiles folder. 0 turns profiling off
+        mzml_encoding (MzMLEncoding): Compression and precision of the mzML binary arrays
+        peak_threshold (float): Sparse peak mode, spectra only hold the peaks above this processed
+            intensity (0 drops the zeros). None writes every spectrum over the full m/z axis
+        parse_cache_dir (str): Cache the parsed .msv matrices here so reruns skip parsing, None turns the cache off
+        parse_cache_max_bytes (int): Size the parse cache is evicted down to after the run, None for its default
+        memory_budget_mb (float): Chunked mode, each file is read and written in chunks of scans that keep
+            a worker's working set within this many MB, whatever the file's size. None converts whole files.
+            The parse cache only holds whole files and is not used in chunked mode
+        dry_run (bool): Only report which members would be converted and their planned names. Nothing
+            is written, so the output directories do not have to exist
+        pools (WorkerPools): Run the stages on these already started executors, whose worker count
+            replaces workers. None starts new ones for this run
+        cancel (threading.Event): Setting it stops the run once the files being worked on are done.
+            The outputs of files that did not get through every stage are removed and the manifest
+            leaves them to be converted again
+        archives (dict): Stages, out of "msv", "mlt", "mzml" and "mzxml", packed into one archive in
+            the output root instead of a file each in their directory, mapped to the archive format,
+            see output_sink. None writes every stage to its directory
+        mzml_backend (str): "psims", or "template" for the faster templated writer with the same output
+
+    The stages are pipelined, see run_stages_pipelined, so the first files are finished while
+    later ones are still being extracted. Members already converted with the same content and
+    parameters according to the output root's manifest are skipped, so rerunning into the same
+    output root only converts new, changed or failed files. The measurements are written to run_report.json and
+    run_report.csv in the output root. Progress goes through a ProgressTracker, throttled and
+    with the file rate and ETA in the messages. Returns the final percentage.
+    """
+    if mzxml_backend not in MZXML_BACKENDS:
+        raise ValueError(f"Unknown mzXML backend: {mzxml_backend}")
+    if mzml_backend not in MZML_BACKENDS:
+        raise ValueError(f"Unknown mzML backend: {mzml_backend}")
+    mzml_encoding.check_available()
+    archives = archives or {}
+    for stage, archive_format in archives.items():
+        if stage not in STAGE_DIRS:
+            raise ValueError(f"Unknown output stage: {stage}")
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {archive_format}")
+
+    native_mzxml = mzxml_backend == "native"
+
+    if pools is not None:
+        workers = pools.workers
+    if run_report is None:
+        run_report = RunReport()
+    run_report.settings.update(zip_path=zip_path, workers=workers, msconvert_batch_size=msconvert_batch_size,
+                               mzxml_backend=mzxml_backend, mzml_backend=mzml_backend, stream_zip=stream_zip, intensity_multiplier=intensity_multiplier,
+                               decimal_places=decimal_places, mzml_encoding=mzml_encoding.as_dict(),
+                               peak_threshold=peak_threshold, parse_cache_dir=parse_cache_dir, memory_budget_mb=memory_budget_mb,
+                               archives=archives)
+    profile_dir = None
+    if profile_slowest > 0 and not dry_run:
+        profile_dir = os.path.join(extract_dir, PROFILE_DIR)
+        os.makedirs(profile_dir, exist_ok=True)
+
+    # Only the members the manifest says are new, changed or incomplete are converted
+    manifest = Manifest.load(extract_dir)
+    params = manifest_params(intensity_multiplier, decimal_places, mzxml_backend, mzml_encoding, peak_threshold)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        infos = zip_stream.base_msv_infos(zip_ref)
+        if not infos:
+            raise ValueError("No .msv files in the base folder")
+        pending = manifest.plan(infos, start_idx, params)
+
+    if dry_run:
+        for member, msv_name in pending:
+            message_signal.emit(f"Would convert: {member} -> {msv_name}")
+        message_signal.emit(f"Dry run: {len(pending)} of {len(infos)} files would be converted")
+        return 0
+    manifest.save()
+
+    if not pending:
+        message_signal.emit(f"All {len(infos)} files are already converted")
+        progress_signal.emit(100)
+        return 0
+    # Every member is accounted for once per stage, the up to date ones as skipped
+    tracker = ProgressTracker(len(infos), (() if stream_zip else ("extract",)) + STAGES, progress_signal, message_signal)
+    if len(pending) < len(infos):
+        tracker.skip_files(len(infos) - len(pending), f"Converting {len(pending)} new or changed files, "
+                                                      f"{len(infos) - len(pending)} up to date")
+
+    members_by_stem = {Path(msv_name).stem: member for member, msv_name in pending}
+
+    parse_cache = None
+    if parse_cache_dir is not None and memory_budget_mb is not None:
+        message_signal.emit("The parse cache is not used when converting in chunks")
+    elif parse_cache_dir is not None:
+        from processing.parse_cache import DEFAULT_MAX_BYTES, ParseCache
+        parse_cache = ParseCache(parse_cache_dir, parse_cache_max_bytes or DEFAULT_MAX_BYTES)
+
+    def on_file(stem, stages, errors=()):
+        manifest.complete(members_by_stem[stem], stages, errors)
+        # An archive is only readable once closed, so with archives the manifest is saved at the
+        # end. A run that dies before then is redone instead of trusting an unfinished archive
+        if not archives:
+            manifest.save(force=False)
+
+    sinks = {}
+    try:
+        # The writers and msconvert write into each sink's staging directory, see output_sink
+        for stage, name in STAGE_DIRS.items():
+            sinks[stage] = open_sink(os.path.join(extract_dir, name), archives.get(stage), resume=True)
+        convert_options = dict(mlt_folder=sinks["mlt"].staging_dir, mzml_folder=sinks["mzml"].staging_dir,
+                               intensity_multiplier=intensity_multiplier, decimal_places=decimal_places,
+                               mzxml_folder=sinks["mzxml"].staging_dir if native_mzxml else None, profile_dir=profile_dir,
+                               mzml_encoding=mzml_encoding, peak_threshold=peak_threshold, parse_cache=parse_cache,
+                               memory_budget_mb=memory_budget_mb, mzml_backend=mzml_backend)
+        if stream_zip:
+            convert_options["msv_folder"] = sinks["msv"].staging_dir if keep_msv else None
+
+        with ExitStack() as stack:
+            if pools is None:
+                pools = stack.enter_context(WorkerPools(workers))
+            with run_report.stage("pipeline"):
+                run_stages_pipelined(zip_path, pending, sinks, ms_convert_path, tracker, message_signal,
+                                     on_file, run_report, pools, msconvert_batch_size, native_mzxml, stream_zip, convert_options,
+                                     cancel)
+        if cancel is not None and cancel.is_set():
+            removed = remove_partial_outputs(sinks, manifest, pending)
+            message_signal.emit(f"Cancelled, removed the partial outputs of {removed} files")
+    finally:
+        tracker.close()
+        for sink in sinks.values():
+            sink.close()
+        manifest.save()
+        if parse_cache is not None:
+            removed, freed = parse_cache.evict()
+            if removed:
+                message_signal.emit(f"Parse cache: evicted {removed} least recently used files ({freed / 1e6:.0f} MB)")
+        run_report.write(extract_dir)
+        if profile_dir is not None:
+            keep_slowest_profiles(profile_dir, run_report, profile_slowest)
+    return tracker.percent()
+
+
+class WorkerPools:
+    """
+    Executors the pipeline stages run on: one thread reading the ZIP, the conversion worker
+    processes and the msconvert threads
+
+    run_pipeline starts its own for a single run. A queue of runs passes the same
+    WorkerPools to each of them, so the worker processes are only started once and keep
+    their imported modules from one archive to the next. The worker processes are spawned
+    on every platform. Forking from the GUI's worker thread would copy Qt's other threads'
+    locks into the children in whatever state they were in.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(workers, 1)
+        self.extract = ThreadPoolExecutor(1)
+        # A single worker converts on a thread, still overlapping the extraction and msconvert
+        self.convert = (ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                        if self.workers > 1 else ThreadPoolExecutor(1))
+        self.msconvert = ThreadPoolExecutor(self.workers)
+
+    def warm_up(self):
+        """Starts the worker processes and imports the conversion modules in them before the first file"""
+        for future in [self.convert.submit(_import_pipeline) for _ in range(self.workers)]:
+            future.result()
+
+    def close(self):
+        for executor in (self.extract, self.convert, self.msconvert):
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_stages_pipelined(zip_path, pending, sinks, ms_convert_path, tracker, message_signal,
+                         on_file, run_report, pools, msconvert_batch_size, native_mzxml, stream_zip, convert_options, cancel=None):
+    """
+    Extracts, converts and msconverts the pending (member, new name) pairs with scheduler.run_stages
+
+    Each file goes on to the next stage as soon as it is done with the last, so extraction
+    on a thread, conversion on the worker processes and the msconvert runs all overlap.
+    Streaming skips the extract stage and the native mzXML backend the msconvert stage.
+    convert_options are the keyword arguments of pipeline.convert_msv_file, or of
+    convert_zip_member when streaming. Every file's extract, mlt, mzml and mzxml stages are
+    recorded in the tracker as completed or failed, and the stages after a failure as skipped.
+    sinks maps "msv", "mlt", "mzml" and "mzxml" to the OutputSink of each output. A file is
+    committed to its sink once no later stage reads it, the .msv and the mzML read by
+    msconvert only after that.
+    """
+    from processing.progress import COMPLETED, FAILED
+    from processing.scheduler import Stage, run_stages
+
+    errors = []
+    zip_read = [0, 0.0]
+
+    def extracted(planned, result):
+        member, msv_name = planned
+        stem = Path(msv_name).stem
+        metrics, error = result if not isinstance(result, Exception) else ([], f"{member} - {result}")
+        run_report.add(metrics)
+        if error is not None:
+            errors.append(error)
+            sinks["msv"].discard(msv_name)
+            on_file(stem, [], [error])
+            tracker.record(stem, "extract", FAILED)
+            tracker.finish(stem)
+            return []
+        tracker.record(stem, "extract", COMPLETED, f"Extracting: {member} -> {msv_name}")
+        return [planned]
+
+    def converted(planned, result):
+        member, msv_name = planned
+        stem = Path(msv_name).stem
+        if isinstance(result, Exception):
+            # The worker process itself died, e.g. out of memory
+            result = ([], [f"{member if stream_zip else sinks['msv'].path(msv_name)} - {result}"], [])
+        written, file_errors, *read, metrics = result
+        if read:
+            zip_read[0] += read[0]
+            zip_read[1] += read[1]
+        run_report.add(metrics)
+        errors.extend(file_errors)
+        messages = dict(written)
+        sinks["msv"].commit(msv_name)
+        # msconvert still needs the mzML
+        for stage in ("mlt", "mzml", "mzxml") if native_mzxml else ("mlt",):
+            if stage in messages:
+                sinks[stage].commit(stem + OUTPUT_EXTENSIONS[stage])
+        on_file(stem, list(messages), file_errors)
+        for stage in ("mlt", "mzml", "mzxml") if native_mzxml else ("mlt", "mzml"):
+            tracker.record(stem, stage, COMPLETED if stage in messages else FAILED, messages.get(stage))
+        if native_mzxml:
+            return []
+        if "mzml" not in messages:
+            tracker.finish(stem)
+            return []
+        return [sinks["mzml"].path(f"{stem}.mzML")]
+
+    def msconverted(batch, result):
+        if isinstance(result, Exception):
+            result = ([], [f"{', '.join(batch)} - {result}"], None)
+        converted_files, batch_errors, measurement = result
+        if measurement is not None:
+            run_report.add([measurement])
+        errors.extend(batch_errors)
+        for mzml_file in batch:
+            stem = Path(mzml_file).stem
+            sinks["mzml"].commit(f"{stem}.mzML")
+            if mzml_file in converted_files:
+                sinks["mzxml"].commit(f"{stem}.mzXML")
+                print(f"Successfully saved {os.path.basename(mzml_file)} to {sinks['mzxml'].location}")
+            on_file(stem, ["mzxml"] if mzml_file in converted_files else [])
+            tracker.record(stem, "mzxml", COMPLETED if mzml_file in converted_files else FAILED,
+                           f"Processing: {os.path.basename(mzml_file)}")
+
+    convert_workers = min(pools.workers, len(pending))
+    with ExitStack() as stack:
+        stages = []
+        if not stream_zip:
+            # One thread reads the ZIP, a ZipFile is not safe to share between threads
+            zip_ref = stack.enter_context(zipfile.ZipFile(zip_path, 'r'))
+            msv_dir = sinks["msv"].staging_dir
+            stages.append(Stage("extract", partial(_extract, zip_ref, msv_dir), pools.extract, extracted, capacity=QUEUE_DEPTH))
+            convert = partial(_convert_extracted, msv_dir, convert_options)
+        else:
+            convert = partial(_convert_member, zip_path, convert_options)
+        stages.append(Stage("convert", convert, pools.convert, converted,
+                            concurrency=convert_workers, capacity=QUEUE_DEPTH * convert_workers))
+        if not native_mzxml:
+            from processing import msconvert_python
+
+            mzxml_dir = sinks["mzxml"].staging_dir
+            stages.append(Stage("msconvert", lambda batch: msconvert_python.run_msconvert(ms_convert_path, batch, mzxml_dir),
+                                pools.msconvert, msconverted, concurrency=pools.workers,
+                                capacity=QUEUE_DEPTH * pools.workers, batch_size=max(msconvert_batch_size, 1)))
+        run_stages(pending, stages, cancel)
+
+    print(f"\nBatch conversion complete")
+    print(f"Errors encountered: {len(errors)}")
+    if errors:
+        print("\nError details:")
+        for error in errors:
+            print(f"• {error}")
+    if zip_read[1] > 0:
+        throughput = f"Read {zip_read[0] / 1e6:.1f} MB from {os.path.basename(zip_path)} at {zip_read[0] / 1e6 / zip_read[1]:.1f} MB/s"
+        print(throughput)
+        message_signal.emit(throughput)
+
+
+def remove_partial_outputs(sinks, manifest, pending):
+    """
+    Deletes the outputs of the pending (member, new name) pairs that did not get through every
+    stage without errors, and clears their completed stages in the manifest. Returns how many
+    files had outputs removed.
+
+    Files already committed to an archive are dropped from it when the sink is closed.
+    """
+    removed = 0
+    for member, msv_name in pending:
+        entry = manifest.files[member]
+        if entry["errors"] or all(stage in entry["stages"] for stage in STAGES):
+            continue
+        stem = Path(msv_name).stem
+        outputs = [("msv", msv_name)] + [(stage, stem + OUTPUT_EXTENSIONS[stage]) for stage in STAGES]
+        removed += any([sinks[stage].discard(name) for stage, name in outputs])
+        entry["stages"] = []
+    return removed
+
+
+def _import_pipeline():
+    from processing import pipeline  # noqa: F401
+
+
+def _extract(zip_ref, msv_dir, planned):
+    """Extracts a (member, new name) pair to msv_dir under its new name. Returns (measurements, error or None)"""
+    member, msv_name = planned
+    metrics = []
+    try:
+        with measure(metrics, "extract", msv_name, bytes_read=zip_ref.getinfo(member).compress_size,
+                     output=os.path.join(msv_dir, msv_name)):
+            zip_stream.extract_member(zip_ref, member, msv_name, msv_dir)
+    except Exception as e:
+        return metrics, f"{member} - {str(e)}"
+    return metrics, None
+
+
+def _convert_extracted(msv_dir, convert_options, planned):
+    """pipeline.convert_msv_file of an extracted pair, module level so the worker processes can unpickle it"""
+    from processing import pipeline
+
+    return pipeline.convert_msv_file(os.path.join(msv_dir, planned[1]), **convert_options)
+
+
+def _convert_member(zip_path, convert_options, planned):
+    """pipeline.convert_zip_member of a pair read straight from the ZIP"""
+    from processing import pipeline
+
+    member, msv_name = planned
+    return pipeline.convert_zip_member(zip_path, member, msv_name, **convert_options)
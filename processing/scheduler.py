@@ -0,0 +1,117 @@
+"""
+Stage-pipelined scheduler
+
+Running each stage over every file before starting the next one means no output exists
+until the whole batch has been extracted, and ZIP reads, parsing and msconvert processes
+never overlap. run_stages instead moves every item through a chain of stages on its own,
+so one file can be in msconvert while the next is being converted and the one after that
+extracted, and the first file is finished within seconds.
+
+Each stage has its own executor and concurrency limit, and the stages are connected by
+bounded queues. A stage only starts an item while the next stage's queue has room for its
+result, so a slow stage holds back the stages before it instead of letting extracted or
+converted files pile up. Only the stage functions run on the executors, the scheduling and
+the on_result callbacks run in the calling thread.
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class Stage:
+    """One step of a run_stages pipeline
+
+    Attributes:
+        name (str): Stage name, for messages
+        function (callable): Called as function(item) on the executor. Must be picklable for a process pool
+        executor (Executor): Pool the stage's items run on
+        on_result (callable): Called as on_result(item, result) in the calling thread as items finish,
+            result is the exception when function raised. Returns the items for the next stage
+        concurrency (int): Items of this stage running at once
+        capacity (int): Items that may wait in this stage's input queue
+        batch_size (int): When set, function gets a list of up to this many queued items per call
+            instead of one item. Partial batches only go once the stages before have finished
+    """
+    name: str
+    function: Callable
+    executor: object
+    on_result: Callable
+    concurrency: int = 1
+    capacity: int = 2
+    batch_size: int = None
+
+    def __post_init__(self):
+        self.concurrency = max(self.concurrency, 1)
+        # A full batch always has to fit in the queue, or the stages before it would wait forever
+        self.capacity = max(self.capacity, self.batch_size or 1)
+
+
+def run_stages(items, stages, cancel=None):
+    """
+    Feeds items through the stages in order and returns once every item has left the last one
+
+    The first stage takes items from the items iterable as its queue has room, so a generator
+    is only consumed as fast as the pipeline moves. Once cancel, a threading.Event, is set no
+    more items are started. The running ones still finish and go through on_result, then
+    run_stages returns False. Returns True when every item went through.
+    """
+    source = iter(items)
+    source_done = False
+    queues = [deque() for _ in stages]
+    running = [{} for _ in stages]
+
+    while True:
+        cancelled = cancel is not None and cancel.is_set()
+        while not cancelled and not source_done and len(queues[0]) < stages[0].capacity:
+            try:
+                queues[0].append(next(source))
+            except StopIteration:
+                source_done = True
+
+        if not cancelled:
+            # Later stages first, so work leaving the pipeline frees room before new work enters it
+            upstream_busy = [not source_done] + [False] * (len(stages) - 1)
+            for k in range(1, len(stages)):
+                upstream_busy[k] = upstream_busy[k - 1] or bool(queues[k - 1]) or bool(running[k - 1])
+            for k in reversed(range(len(stages))):
+                _start(k, stages, queues, running, upstream_busy[k])
+
+        in_flight = {future: k for k, futures in enumerate(running) for future in futures}
+        if not in_flight:
+            if cancelled:
+                return False
+            if source_done and not any(queues):
+                return True
+            continue
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            k = in_flight[future]
+            item = running[k].pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # Includes a worker process that died, e.g. out of memory
+                result = e
+            next_items = stages[k].on_result(item, result)
+            if k + 1 < len(stages) and next_items:
+                queues[k + 1].extend(next_items)
+
+
+def _start(k, stages, queues, running, upstream_busy):
+    """Submits queued items of stage k while it is below its concurrency and the next queue has room"""
+    stage = stages[k]
+    queue = queues[k]
+    while queue and len(running[k]) < stage.concurrency:
+        # Every running item may hand one item on, those need room downstream too
+        if k + 1 < len(stages) and len(queues[k + 1]) + len(running[k]) >= stages[k + 1].capacity:
+            return
+        if stage.batch_size:
+            if len(queue) < stage.batch_size and upstream_busy:
+                return
+            item = [queue.popleft() for _ in range(min(stage.batch_size, len(queue)))]
+        else:
+            item = queue.popleft()
+        running[k][stage.executor.submit(stage.function, item)] = item
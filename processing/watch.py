@@ -0,0 +1,173 @@
+"""
+Watch-folder mode, converting .msv files as the instrument writes them
+
+    python -m processing watch inbox_dir output_dir --msconvert C:/path/to/msconvert.exe
+
+Instead of waiting for a whole batch to be zipped, watch_inbox polls an inbox folder and
+converts each new .msv file on its own once its size and modification time have stopped
+changing for settle_seconds. The file is copied to 1-msv under its sequential name and
+written to .mlt, mzML and mzXML like one member of a ZIP run.
+
+The state lives in the output root's manifest, the same one run_pipeline keeps. Inbox
+files are keyed by their name with the CRC-32 and size of their content as fingerprint, so
+a restarted watcher skips what was converted before, continues the index after the highest
+one given so far and redoes files that changed or did not finish.
+"""
+import os
+import shutil
+import time
+import zipfile
+import zlib
+
+from processing import runner
+from processing.inventory import MSV_FILE, scan_files
+from processing.manifest import Manifest
+from processing.mzml_encoding import DEFAULT_ENCODING
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_info(path):
+    """ZipInfo standing in for an inbox file in Manifest.plan, named after the file with its CRC-32 and size"""
+    crc = 0
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+    info = zipfile.ZipInfo(os.path.basename(path))
+    info.CRC = crc
+    info.file_size = size
+    return info
+
+
+class SettleTracker:
+    """Reports files once their size and modification time have not changed for settle_seconds"""
+
+    def __init__(self, settle_seconds):
+        self.settle_seconds = settle_seconds
+        # path -> ((size, mtime), first time it was seen with them)
+        self.seen = {}
+        # (path, size, mtime) already handed out, so an unchanged file is only reported once per process
+        self.done = set()
+
+    def poll(self, paths, now=None):
+        """Returns the paths that have just settled and whether any other file is still being written"""
+        now = time.monotonic() if now is None else now
+        settled = []
+        waiting = False
+        current = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp = (st.st_size, st.st_mtime_ns)
+            if (path, *stamp) in self.done:
+                continue
+            previous = self.seen.get(path)
+            since = previous[1] if previous is not None and previous[0] == stamp else now
+            current[path] = (stamp, since)
+            if now - since >= self.settle_seconds:
+                settled.append(path)
+                self.done.add((path, *stamp))
+                del current[path]
+            else:
+                waiting = True
+        self.seen = current
+        return settled, waiting
+
+
+def watch_inbox(inbox, extract_dir, start_idx, ms_convert_path, message_signal, mzxml_backend="msconvert",
+                intensity_multiplier=1e16, decimal_places=3, mzml_encoding=DEFAULT_ENCODING, peak_threshold=None,
+                poll_seconds=2.0, settle_seconds=5.0, once=False, stop=None, mzml_backend="psims"):
+    """
+    Converts every .msv file landing in inbox until stop is set
+
+    Parameters:
+        inbox (str): Folder the instrument writes .msv files to, subfolders are not watched
+        extract_dir (str): Output root holding the stage directories and the manifest, created when missing
+        start_idx (int): Index of the first renamed file when the manifest has none yet
+        poll_seconds (float): Seconds between looks at the inbox
+        settle_seconds (float): A file is converted once it has not changed for this long
+        once (bool): Return as soon as no file is left waiting to settle, instead of watching on
+        stop (threading.Event): Ends the watch at the next poll
+
+    The other parameters are those of run_pipeline. Returns the number of files converted.
+    """
+    if mzxml_backend not in runner.MZXML_BACKENDS:
+        raise ValueError(f"Unknown mzXML backend: {mzxml_backend}")
+    if mzml_backend not in runner.MZML_BACKENDS:
+        raise ValueError(f"Unknown mzML backend: {mzml_backend}")
+    mzml_encoding.check_available()
+    if not os.path.isdir(inbox):
+        raise FileNotFoundError(f"Inbox folder not found: {inbox}")
+    runner.make_output_dirs(extract_dir, resume=True)
+
+    native_mzxml = mzxml_backend == "native"
+    manifest = Manifest.load(extract_dir)
+    params = runner.manifest_params(intensity_multiplier, decimal_places, mzxml_backend, mzml_encoding, peak_threshold)
+    tracker = SettleTracker(settle_seconds)
+    converted = 0
+
+    message_signal.emit(f"Watching {inbox} for .msv files")
+    while stop is None or not stop.is_set():
+        settled, waiting = tracker.poll(scan_files(inbox, MSV_FILE, recursive=False))
+        for path in settled:
+            try:
+                if convert_inbox_file(path, manifest, params, start_idx, extract_dir, ms_convert_path, message_signal, native_mzxml,
+                                      intensity_multiplier, decimal_places, mzml_encoding, peak_threshold, mzml_backend):
+                    converted += 1
+            except Exception as e:
+                # A file the watcher cannot name or read must not stop it
+                message_signal.emit(f"Error: {path} - {str(e)}")
+
+        if once and not waiting:
+            break
+        if stop is not None:
+            stop.wait(poll_seconds)
+        else:
+            time.sleep(poll_seconds)
+    return converted
+
+
+def convert_inbox_file(path, manifest, params, start_idx, extract_dir, ms_convert_path, message_signal, native_mzxml,
+                       intensity_multiplier, decimal_places, mzml_encoding, peak_threshold, mzml_backend="psims"):
+    """
+    Copies one settled inbox file to 1-msv under its sequential name and converts it, unless the
+    manifest has it converted already. Returns whether it was converted
+    """
+    from processing import pipeline
+
+    written_at = os.path.getmtime(path)
+    pending = manifest.plan([file_info(path)], start_idx, params)
+    if not pending:
+        return False
+    member, msv_name = pending[0]
+    manifest.save()
+
+    mzml_dir = os.path.join(extract_dir, runner.MZML_DIR)
+    mzxml_dir = os.path.join(extract_dir, runner.MZXML_DIR)
+    # The copy is made from the settled file, a later rewrite shows up as a new fingerprint
+    msv_path = os.path.join(extract_dir, runner.MSV_DIR, msv_name)
+    shutil.copyfile(path, msv_path)
+    written, errors, _ = pipeline.convert_msv_file(msv_path, os.path.join(extract_dir, runner.MLT_DIR), mzml_dir,
+                                                   intensity_multiplier, decimal_places, mzxml_dir if native_mzxml else None,
+                                                   mzml_encoding=mzml_encoding, peak_threshold=peak_threshold,
+                                                   mzml_backend=mzml_backend)
+    stages = [stage for stage, _ in written]
+    if not native_mzxml and "mzml" in stages:
+        from processing import msconvert_python
+
+        mzml_file = os.path.join(mzml_dir, f"{os.path.splitext(msv_name)[0]}.mzML")
+        mzxml_files, mzxml_errors, _ = msconvert_python.run_msconvert(ms_convert_path, [mzml_file], mzxml_dir)
+        stages += ["mzxml"] if mzxml_files else []
+        errors += mzxml_errors
+    manifest.complete(member, stages, errors)
+    manifest.save()
+
+    for error in errors:
+        message_signal.emit(f"Error: {error}")
+    message_signal.emit(f"{'Failed' if errors else 'Converted'}: {member} -> {msv_name}, "
+                        f"{time.time() - written_at:.1f} s after it was written")
+    return True
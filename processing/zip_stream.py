@@ -0,0 +1,87 @@
+"""
+Streaming ingestion of .msv files straight out of the ZIP
+
+Members are read through ZipFile.open and handed to the MSV parser without being
+extracted to 1-msv first. Their renamed file names are planned in memory by the run
+manifest, see manifest.Manifest.plan, and the raw .msv copy is only written when
+asked for.
+"""
+import hashlib
+import os
+import shutil
+import time
+import zipfile
+
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def base_msv_infos(zip_ref: zipfile.ZipFile):
+    """ZipInfo of the .msv members in the base folder of the archive, sorted by name"""
+    return sorted((info for info in zip_ref.infolist()
+                   if not info.is_dir() and '/' not in info.filename and info.filename.lower().endswith('.msv')),
+                  key=lambda info: info.filename)
+
+
+class TimedStream:
+    """
+    Binary line reader over a ZIP member that counts the bytes and the time spent reading
+
+    Every byte read is hashed and can also be copied to a sink, which is how the optional
+    on-disk .msv copy gets written without reading the member twice.
+    """
+
+    def __init__(self, stream, name='', sink=None):
+        self.stream = stream
+        self.name = name
+        self.sink = sink
+        self.bytes_read = 0
+        self.seconds = 0.0
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self._account(data, start)
+        return data
+
+    def readline(self):
+        start = time.perf_counter()
+        line = self.stream.readline()
+        self._account(line, start)
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def drain(self):
+        """Read whatever the parser left after </DATA> so the hash and the sink copy are complete"""
+        while self.read(COPY_BLOCK_SIZE):
+            pass
+
+    def _account(self, data, start):
+        self.seconds += time.perf_counter() - start
+        self.bytes_read += len(data)
+        self.sha1.update(data)
+        if self.sink is not None:
+            self.sink.write(data)
+
+
+def extract_member(zip_ref: zipfile.ZipFile, member, msv_name, msv_folder):
+    """Extracts a member straight to its planned name in msv_folder"""
+    with zip_ref.open(member) as source, open(os.path.join(msv_folder, msv_name), 'wb') as target:
+        shutil.copyfileobj(source, target, COPY_BLOCK_SIZE)
+
+
+def open_member(zip_ref: zipfile.ZipFile, member, msv_name, msv_folder=None):
+    """
+    Opens a member as a TimedStream. With msv_folder the raw bytes are also written
+    to msv_folder/msv_name as they are read. Returns (stream, sink or None).
+    """
+    sink = open(os.path.join(msv_folder, msv_name), 'wb') if msv_folder is not None else None
+    return TimedStream(zip_ref.open(member), msv_name, sink), sink
@@ -0,0 +1,52 @@
+"""
+The command line must answer --help and argument errors quickly, without importing the stage modules
+
+Each case runs in a fresh interpreter, since this test session may already have NumPy loaded.
+benchmarks/bench_startup.py compares the startup time against the GUI's imports.
+"""
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from processing.__main__ import HEAVY_MODULES
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Seconds python -m processing --help may take, well above the ~0.1 s it needs without the stage modules
+MAX_HELP_SECONDS = 3.0
+
+CHECK = (
+    "import sys, contextlib, io\n"
+    "from processing.__main__ import main\n"
+    "with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):\n"
+    "    try:\n"
+    "        main(sys.argv[1:])\n"
+    "    except SystemExit:\n"
+    "        pass\n"
+    f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+)
+
+
+@pytest.mark.parametrize("argv", [
+    ["--help"],
+    ["convert", "--help"],
+    ["watch", "--help"],
+    ["clear-cache", "--help"],
+    ["convert"],
+    ["convert", "data.zip", "out", "--mzml-backend", "other"],
+])
+def test_no_heavy_imports(argv):
+    out = subprocess.run([sys.executable, "-c", CHECK, *argv], cwd=ROOT, check=True, capture_output=True, text=True)
+    assert out.stdout.strip() == ""
+
+
+def test_help_is_fast():
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "processing", "--help"], cwd=ROOT, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    assert min(times) < MAX_HELP_SECONDS
@@ -0,0 +1,26 @@
+"""Ranking files by their time in a RunReport"""
+from processing.instrumentation import Measurement, RunReport, keep_slowest_profiles
+
+
+def report():
+    report = RunReport()
+    report.add([
+        Measurement("parse", "1-msv/00001_a.msv", wall_seconds=1.0),
+        Measurement("mzml", "5-mzmlv2/00001_a.mzML", wall_seconds=1.0),
+        Measurement("parse", "1-msv/00002_b.msv", wall_seconds=1.5),
+        # One msconvert run over three files, labelled after the first
+        Measurement("msconvert", "5-mzmlv2/00002_b.mzML (+2 more)", wall_seconds=30.0, n_files=3),
+        Measurement("msconvert", "5-mzmlv2/00003_c.mzML", wall_seconds=0.5),
+    ])
+    return report
+
+
+def test_batched_calls_are_not_credited_to_one_file():
+    assert report().slowest_files(5) == [("00001_a", 2.0), ("00002_b", 1.5), ("00003_c", 0.5)]
+
+
+def test_keep_slowest_profiles(tmp_path):
+    for name in ("00001_a", "00002_b", "00003_c"):
+        (tmp_path / f"{name}.prof").write_bytes(b"")
+    keep_slowest_profiles(tmp_path, report(), 2)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["00001_a.prof", "00002_b.prof"]
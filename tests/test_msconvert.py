@@ -0,0 +1,137 @@
+"""
+msconvert batching against a stub executable
+
+The stub logs its arguments, and the contents of a -f filelist while it still exists, then
+writes a small mzXML for every input to the -o directory like msconvert. STUB_EXIT makes it
+exit with that status after writing, STUB_SKIP names an input it writes nothing for.
+"""
+import json
+import os
+import sys
+import textwrap
+
+import pytest
+
+from processing.msconvert_python import msconvert_command, run_msconvert
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="the stub msconvert is a script with a shebang line")
+
+STUB = textwrap.dedent("""\
+    import json, os, sys
+
+    args = sys.argv[1:]
+    inputs, output_dir, filelist = [], ".", None
+    i = 0
+    while i < len(args):
+        if args[i] == "-f":
+            filelist = args[i + 1]
+            with open(filelist) as f:
+                inputs += [line.strip() for line in f if line.strip()]
+            i += 2
+        elif args[i] == "-o":
+            output_dir = args[i + 1]
+            i += 2
+        elif args[i].startswith("--"):
+            i += 1
+        else:
+            inputs.append(args[i])
+            i += 1
+    with open(os.environ["STUB_LOG"], "a") as log:
+        log.write(json.dumps({"args": args, "filelist": filelist, "inputs": inputs}) + "\\n")
+    for name in inputs:
+        if os.path.basename(name) != os.environ.get("STUB_SKIP"):
+            with open(os.path.join(output_dir, os.path.splitext(os.path.basename(name))[0] + ".mzXML"), "w") as f:
+                f.write("<mzXML/>")
+    sys.exit(int(os.environ.get("STUB_EXIT", "0")))
+""")
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    path = tmp_path / "msconvert"
+    path.write_text(f"#!{sys.executable}\n{STUB}")
+    path.chmod(0o755)
+    log = tmp_path / "calls.log"
+    monkeypatch.setenv("STUB_LOG", str(log))
+    monkeypatch.delenv("STUB_EXIT", raising=False)
+    monkeypatch.delenv("STUB_SKIP", raising=False)
+
+    def calls():
+        return [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+
+    return str(path), calls
+
+
+@pytest.fixture
+def mzml_files(tmp_path):
+    folder = tmp_path / "mzml"
+    folder.mkdir()
+    files = []
+    for stem in ("00001_a", "00002_b", "00003_c"):
+        path = folder / f"{stem}.mzML"
+        path.write_text("<mzML/>")
+        files.append(str(path))
+    return files
+
+
+@pytest.fixture
+def output_dir(tmp_path):
+    folder = tmp_path / "mzxml"
+    folder.mkdir()
+    return str(folder)
+
+
+def test_single_file_command_line():
+    assert msconvert_command("msconvert", ["a.mzML"], "out") == ["msconvert", "a.mzML", "-o", "out", "--mzXML"]
+    assert msconvert_command("msconvert", ["a.mzML", "b.mzML"], "out", "list.txt") == \
+        ["msconvert", "-f", "list.txt", "-o", "out", "--mzXML"]
+
+
+def test_single_file(stub, mzml_files, output_dir):
+    exe, calls = stub
+    converted, errors, measurement = run_msconvert(exe, mzml_files[:1], output_dir)
+    assert converted == mzml_files[:1] and errors == []
+    assert calls() == [{"args": [mzml_files[0], "-o", output_dir, "--mzXML"], "filelist": None, "inputs": mzml_files[:1]}]
+    assert measurement.bytes_written == len("<mzXML/>")
+
+
+def test_batch_uses_a_filelist_and_removes_it(stub, mzml_files, output_dir):
+    exe, calls = stub
+    converted, errors, _ = run_msconvert(exe, mzml_files, output_dir)
+    assert converted == mzml_files and errors == []
+    [call] = calls()
+    assert call["args"][0] == "-f" and call["args"][2:] == ["-o", output_dir, "--mzXML"]
+    assert call["inputs"] == mzml_files
+    assert not os.path.exists(call["filelist"])
+    assert sorted(os.listdir(output_dir)) == ["00001_a.mzXML", "00002_b.mzXML", "00003_c.mzXML"]
+
+
+def test_nonzero_exit_fails_a_single_file(stub, mzml_files, output_dir, monkeypatch):
+    exe, _ = stub
+    monkeypatch.setenv("STUB_EXIT", "3")
+    converted, errors, measurement = run_msconvert(exe, mzml_files[:1], output_dir)
+    assert converted == []
+    assert errors == [f"{mzml_files[0]} - msconvert exited with 3: "]
+    assert measurement.error == errors[0]
+
+
+def test_missing_output(stub, mzml_files, output_dir, monkeypatch):
+    exe, _ = stub
+    monkeypatch.setenv("STUB_SKIP", "00002_b.mzML")
+    converted, errors, _ = run_msconvert(exe, mzml_files, output_dir)
+    assert converted == [mzml_files[0], mzml_files[2]]
+    assert errors == [f"{mzml_files[1]} - file not created in output directory"]
+
+
+def test_stale_output_is_not_taken_for_a_conversion(stub, mzml_files, output_dir, monkeypatch):
+    exe, _ = stub
+    stale = os.path.join(output_dir, "00002_b.mzXML")
+    with open(stale, "w") as f:
+        f.write("<mzXML")
+    monkeypatch.setenv("STUB_SKIP", "00002_b.mzML")
+    monkeypatch.setenv("STUB_EXIT", "1")
+    converted, errors, _ = run_msconvert(exe, mzml_files, output_dir)
+    assert converted == [mzml_files[0], mzml_files[2]]
+    assert errors == [f"{', '.join(mzml_files)} - msconvert exited with 1: ",
+                      f"{mzml_files[1]} - file not created in output directory"]
+    assert not os.path.exists(stale)
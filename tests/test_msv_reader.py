@@ -0,0 +1,40 @@
+"""Finding the <DATA> table of a .msv file"""
+import io
+
+import numpy as np
+
+from processing.msv_reader import read_msv, survey_msv
+
+HEADER = "RT(milliseconds);RT(minutes) - NOT USED BY IMPORT;RI;50;51"
+ROWS = "1000;0.0167;0;1.5;2.5\n1250;0.0208;0;3.5;-4.5"
+
+
+def msv(before_data, open_tag="<DATA>"):
+    return io.BytesIO(f'<?xml version="1.0" encoding="utf-8"?>\n<MSV>\n{before_data}{open_tag}{HEADER}\n{ROWS}\n'
+                      f'</DATA>\n</MSV>\n'.encode())
+
+
+def check(f):
+    msv_data = read_msv(f, source="test.msv")
+    np.testing.assert_array_equal(msv_data.rt_ms, [1000, 1250])
+    np.testing.assert_array_equal(msv_data.mz, [50, 51])
+    np.testing.assert_array_equal(msv_data.intensities, [[1.5, 2.5], [3.5, -4.5]])
+
+
+def test_plain():
+    check(msv(""))
+
+
+def test_elements_named_like_data_are_skipped():
+    check(msv("<DATAINFO>RT;x</DATAINFO>\n<DATASET/>\n"))
+    assert survey_msv(msv("<DATAINFO>x</DATAINFO>\n")).n_scans == 2
+
+
+def test_opening_tag_over_several_lines():
+    check(msv("", '<DATA\n  version="1"\n  unit="ms">'))
+    check(msv("", "<DATA\n>\n"))
+
+
+def test_empty_element():
+    survey = survey_msv(io.BytesIO(b"<MSV><DATAINFO/><DATA /></MSV>\n"))
+    assert (survey.n_scans, survey.n_mz) == (0, 0)
@@ -0,0 +1,84 @@
+"""
+The template mzML backend has to write byte for byte what psims writes
+
+Covers every array encoding (the numpress ones only with pynumpress installed), dense and
+sparse spectra, a threshold above every intensity so every spectrum is empty, NaN and
+all-negative rows, and chunked writing against MzMLChunkWriter.
+"""
+import importlib.util
+import itertools
+import warnings
+
+import numpy as np
+import pytest
+
+from processing.AMDIS_batch_data_formatterv1 import MzMLChunkWriter, write_mzml
+from processing.msv_reader import MSVData
+from processing.mzml_encoding import INTENSITY_COMPRESSIONS, MZ_COMPRESSIONS, PRECISIONS, MzMLEncoding
+from processing.mzml_template import MzMLTemplateWriter, write_mzml_template
+
+HAS_NUMPRESS = importlib.util.find_spec("pynumpress") is not None
+
+# None writes the full m/z axis, 0 drops the zeros, 1e30 is above every processed intensity
+PEAK_THRESHOLDS = (None, 0.0, 5000.0, 1e30)
+
+
+def all_encodings():
+    for mz_c, int_c, mz_p, int_p in itertools.product(MZ_COMPRESSIONS, INTENSITY_COMPRESSIONS, PRECISIONS, PRECISIONS):
+        # numpress ignores the precision
+        if (mz_c.startswith("numpress") and mz_p != 64) or (int_c.startswith("numpress") and int_p != 64):
+            continue
+        encoding = MzMLEncoding(mz_c, mz_p, int_c, int_p)
+        marks = [pytest.mark.skipif(not HAS_NUMPRESS, reason="needs pynumpress")] if encoding.uses_numpress else []
+        yield pytest.param(encoding, id="-".join(map(str, encoding.as_dict().values())), marks=marks)
+
+
+def synthetic_msv(n_scans=40, n_mz=30, seed=0):
+    rng = np.random.default_rng(seed)
+    intensities = rng.random((n_scans, n_mz)) * 1e-12
+    intensities[rng.random((n_scans, n_mz)) < 0.4] *= -1
+    intensities[3] = -1e-12
+    intensities[5, 7] = np.nan
+    mz = np.arange(50, 50 + n_mz, dtype=np.float64)
+    return MSVData("synthetic.msv", 1000.0 + 250.0 * np.arange(n_scans), mz, [str(int(m)) for m in mz], intensities)
+
+
+@pytest.fixture(autouse=True)
+def quiet_psims():
+    # psims warns about the chromatogram array units on every file
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+
+@pytest.mark.parametrize("peak_threshold", PEAK_THRESHOLDS)
+@pytest.mark.parametrize("encoding", list(all_encodings()))
+def test_template_matches_psims(tmp_path, encoding, peak_threshold):
+    msv_data = synthetic_msv()
+    write_mzml(msv_data, tmp_path / "psims.mzML", 1e16, 3, encoding, peak_threshold)
+    write_mzml_template(msv_data, tmp_path / "template.mzML", 1e16, 3, encoding, peak_threshold)
+    assert (tmp_path / "template.mzML").read_bytes() == (tmp_path / "psims.mzML").read_bytes()
+
+
+@pytest.mark.parametrize("peak_threshold", (None, 0.0))
+def test_template_chunks_match_psims_chunks(tmp_path, peak_threshold):
+    msv_data = synthetic_msv()
+    paths = {}
+    for writer_class in (MzMLChunkWriter, MzMLTemplateWriter):
+        paths[writer_class] = tmp_path / f"{writer_class.__name__}.mzML"
+        writer = writer_class(paths[writer_class], msv_data.mz, msv_data.n_scans, 1e16, 3, peak_threshold=peak_threshold)
+        for start in range(0, msv_data.n_scans, 16):
+            rows = slice(start, start + 16)
+            writer.write(MSVData(msv_data.source, msv_data.rt_ms[rows], msv_data.mz, msv_data.mz_labels,
+                                 msv_data.intensities[rows]))
+        writer.close()
+    assert paths[MzMLTemplateWriter].read_bytes() == paths[MzMLChunkWriter].read_bytes()
+
+
+def test_write_mzml_backend(tmp_path):
+    msv_data = synthetic_msv(n_scans=8)
+    write_mzml(msv_data, tmp_path / "psims.mzML", 1e16, 3)
+    write_mzml(msv_data, tmp_path / "template.mzML", 1e16, 3, backend="template")
+    assert (tmp_path / "template.mzML").read_bytes() == (tmp_path / "psims.mzML").read_bytes()
+    with pytest.raises(ValueError):
+        write_mzml(msv_data, tmp_path / "other.mzML", 1e16, 3, backend="other")
@@ -0,0 +1,74 @@
+"""Archive sinks keep one copy of every member when a resumed run redoes or drops files"""
+import json
+import tarfile
+import zipfile
+
+import pytest
+
+from processing.output_sink import ArchiveSink
+
+FORMATS = ("zip", "zip-stored", "tar")
+
+
+def write(sink, name, data):
+    with open(sink.path(name), "wb") as f:
+        f.write(data)
+    assert sink.commit(name)
+
+
+def read_archive(path, archive_format):
+    if archive_format == "tar":
+        with tarfile.open(path) as archive:
+            return [(m.name, archive.extractfile(m).read()) for m in archive.getmembers()]
+    with zipfile.ZipFile(path) as archive:
+        return [(info.filename, archive.read(info)) for info in archive.infolist()]
+
+
+def read_index(path, archive_format):
+    with open(str(path) + ".index.json", encoding="utf-8") as f:
+        members = json.load(f)["members"]
+    if archive_format == "zip":
+        return sorted(members)
+    # Uncompressed members are read with a plain seek
+    contents = {}
+    with open(path, "rb") as f:
+        for name, entry in members.items():
+            f.seek(entry["offset"])
+            contents[name] = f.read(entry["size"])
+    return contents
+
+
+@pytest.mark.parametrize("archive_format", FORMATS)
+def test_resume_replaces_redone_and_discarded_members(tmp_path, archive_format):
+    path = str(tmp_path / "stage.archive")
+    sink = ArchiveSink(path, archive_format)
+    for name in ("a", "b", "c"):
+        write(sink, name, name.encode() * 10)
+    sink.close()
+
+    sink = ArchiveSink(path, archive_format, resume=True)
+    write(sink, "a", b"new a")
+    write(sink, "d", b"d")
+    assert sink.discard("b")
+    assert not sink.discard("missing")
+    sink.close()
+
+    expected = [("a", b"new a"), ("c", b"c" * 10), ("d", b"d")]
+    assert read_archive(path, archive_format) == expected
+    if archive_format == "zip":
+        assert read_index(path, archive_format) == ["a", "c", "d"]
+    else:
+        assert read_index(path, archive_format) == dict(expected)
+
+
+@pytest.mark.parametrize("archive_format", FORMATS)
+def test_plain_run_is_not_rewritten(tmp_path, archive_format, monkeypatch):
+    path = str(tmp_path / "stage.archive")
+    sink = ArchiveSink(path, archive_format)
+    write(sink, "a", b"a")
+    sink.close()
+    sink = ArchiveSink(path, archive_format, resume=True)
+    write(sink, "b", b"b")
+    monkeypatch.setattr(sink, "_rewrite", lambda: pytest.fail("archive rewritten"))
+    sink.close()
+    assert read_archive(path, archive_format) == [("a", b"a"), ("b", b"b")]